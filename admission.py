@@ -0,0 +1,81 @@
+import shutil
+import threading
+import time
+from collections import deque
+
+"""
+ジョブの受け入れ制御
+ヘッダーのペイロードサイズだけを見て、ボディを受信する前にジョブを受け入れるかどうかを決めます。
+    受信中・処理中のジョブのペイロードの合計（max_bytes）と、作業ディレクトリのあるディスクの
+    空き容量（min_free_bytesを残す）の両方に収まる場合だけ受け入れる。
+    収まらない場合は先に待っているジョブから順に最大timeout秒待ち、それでも収まらなければ
+    断ってクライアントに時間をおいて再送させる。
+"""
+
+# 受け入れの判定結果
+ADMISSION_ADMITTED = "admitted"
+ADMISSION_BUSY = "busy"
+ADMISSION_TOO_LARGE = "too_large"
+
+
+class AdmissionController:
+    """ペイロードのバイト数とディスクの空き容量でジョブの受け入れを制御する"""
+
+    def __init__(
+        self, spool_dir: str, max_bytes: int, min_free_bytes: int, timeout: float
+    ):
+        self.spool_dir = spool_dir
+        # 受け入れたジョブのペイロードの合計の上限（0の場合は制限しない）
+        self.max_bytes = max_bytes
+        # ディスクに残す空き容量
+        self.min_free_bytes = min_free_bytes
+        # 受け入れを待つ秒数
+        self.timeout = timeout
+        self.admitted_bytes = 0
+        # 受け入れを待っているジョブ。先に待ち始めたジョブから受け入れ、大きいジョブが後回しにされ続けないようにする
+        self._waiters: deque[object] = deque()
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int) -> str:
+        """sizeバイトのペイロードを受け入れるまで待つ
+
+        Returns:
+            str: "admitted"（受け入れた。処理が終わったらrelease()する）/
+                "busy"（timeout秒待っても空かなかった）/
+                "too_large"（上限を超えるため受け入れられない）
+        """
+        if self.max_bytes > 0 and size > self.max_bytes:
+            return ADMISSION_TOO_LARGE
+        ticket = object()
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            self._waiters.append(ticket)
+            try:
+                while not (self._waiters[0] is ticket and self._fits(size)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return ADMISSION_BUSY
+                    # ディスクの空き容量は他のプロセスでも変わるため、定期的に確認し直す
+                    self._condition.wait(min(remaining, 1.0))
+                self.admitted_bytes += size
+                return ADMISSION_ADMITTED
+            finally:
+                self._waiters.remove(ticket)
+                self._condition.notify_all()
+
+    def release(self, size: int):
+        """受け入れたジョブの処理が終わった（作業ディレクトリを削除した）ことを反映する"""
+        with self._condition:
+            self.admitted_bytes -= size
+            self._condition.notify_all()
+
+    def _fits(self, size: int) -> bool:
+        if self.max_bytes > 0 and self.admitted_bytes + size > self.max_bytes:
+            return False
+        if self.min_free_bytes > 0:
+            # 受け入れ済みのペイロードは受信途中の場合があるため、空き容量からさらに差し引く
+            # （受信済みの分は二重に数えるが、空き容量を多めに見積もることはない）
+            free_bytes = shutil.disk_usage(self.spool_dir).free
+            if free_bytes - self.admitted_bytes - size < self.min_free_bytes:
+                return False
+        return True
@@ -0,0 +1,4 @@
+"""
+ベンチマーク
+リポジトリのルートから `python -m benchmark.<モジュール名>` で実行します。
+"""
@@ -0,0 +1,343 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import metrics
+from benchmark.bench_protocol import JSON_DATA, MEDIA_TYPE, bench_legacy, bench_parser
+from benchmark.inputs import cached_input, ffmpeg_available
+from custom_protocol import MMPSocketReader, iter_mmp_buffers, pack_mmp_message
+
+"""
+エンドツーエンドのベンチマーク
+lavfiで合成した複数の解像度・長さの動画について、ループバック上で起動したServerに
+5つの操作をそれぞれ送信し、リクエスト全体と段階ごと（metricsのmmp_request_phase_seconds）の
+所要時間を計測します。あわせて、MMPのパック・アンパックと受信ループをbody_bytesごとに計測します。
+結果はJSONで出力するため、--compareで以前の結果と比較して性能の劣化を確認できます。
+
+実行例:
+    python -m benchmark.bench_e2e --output result.json
+    python -m benchmark.bench_e2e --output new.json --compare result.json
+"""
+
+# 計測する操作（名前, json_data）
+ACTIONS = [
+    ("compress", {"action": "1", "quality": "28"}),
+    ("resize", {"action": "2", "resolution": "3"}),
+    ("aspect_ratio", {"action": "3", "aspect_ratio": "3", "fit_mode": "1"}),
+    ("extract_audio", {"action": "4"}),
+    ("trim_gif", {"action": "5", "trim": "gif", "start_time": "2", "duration": "3"}),
+]
+
+# --compareでこの割合以上遅くなった項目を劣化として表示する
+REGRESSION_THRESHOLD = 0.10
+
+
+def free_port() -> int:
+    """ループバックで空いているポート番号を返す"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list[float], ratio: float) -> float:
+    """最近傍法でパーセンタイルを返す"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))]
+
+
+def summarize(values: list[float]) -> dict:
+    """所要時間のリストを統計値にまとめる"""
+    return {
+        "count": len(values),
+        "mean": statistics.fmean(values),
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "min": min(values),
+        "max": max(values),
+    }
+
+
+def phase_totals() -> dict:
+    """サーバーのメトリクスから段階ごとの (合計秒数, 件数) を取得する"""
+    return {key[0]: value for key, value in metrics.PHASE_SECONDS.totals().items()}
+
+
+def run_e2e(args, work_dir: str) -> list[dict]:
+    """Serverをループバックで起動し、入力ごと・操作ごとにリクエストを計測する"""
+    # .envより優先される設定。結果キャッシュは無効にして毎回ffmpegを実行させる
+    os.environ.update(
+        {
+            "ip": "127.0.0.1",
+            "port": str(free_port()),
+            "body_bytes": str(args.body_bytes),
+            "output_dir": os.path.join(work_dir, "output"),
+            "cache_max_bytes": "0",
+            "upload_store_dir": os.path.join(work_dir, "uploads"),
+            "probe_cache_dir": os.path.join(work_dir, "probe_cache"),
+            "metrics_port": "0",
+            "resumable_upload_min_bytes": str(1 << 62),
+        }
+    )
+    from client import Client
+    from server import Server
+
+    server = Server()
+    threading.Thread(target=server.server_start, daemon=True).start()
+
+    results = []
+    try:
+        for size in args.sizes:
+            for duration in args.durations:
+                input_path = cached_input(args.input_dir, duration, size)
+                for name, json_data in ACTIONS:
+                    if args.actions and name not in args.actions:
+                        continue
+                    latencies = []
+                    phases: dict[str, list[float]] = {}
+                    for _ in range(args.repeat):
+                        before = phase_totals()
+                        client = Client()
+                        client.connect()
+                        start = time.perf_counter()
+                        response = client.send_request(input_path, "mp4", json_data)
+                        latencies.append(time.perf_counter() - start)
+                        client.socket.close()
+                        if response.get("status_id") != "200":
+                            raise RuntimeError(f"{name}が失敗しました: {response}")
+                        # 接続の後片付けの記録を待ってから差分を取る
+                        time.sleep(0.05)
+                        after = phase_totals()
+                        for phase, (total, count) in after.items():
+                            before_total, before_count = before.get(phase, (0.0, 0))
+                            if count > before_count:
+                                phases.setdefault(phase, []).append(total - before_total)
+                    result = {
+                        "size": size,
+                        "duration": duration,
+                        "action": name,
+                        "input_bytes": os.path.getsize(input_path),
+                        "latency": summarize(latencies),
+                        "phases": {
+                            phase: statistics.fmean(values)
+                            for phase, values in sorted(phases.items())
+                        },
+                    }
+                    results.append(result)
+                    print(
+                        f"{size:>9} {duration:>4}s {name:>13}: "
+                        f"p50 {result['latency']['p50']:.3f} s",
+                        file=sys.__stdout__,
+                    )
+    finally:
+        server.server_running = False
+        # acceptで待っているサーバーを止める
+        try:
+            server.tcp_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    return results
+
+
+def bench_receive_loop(payload_size: int, body_bytes: int) -> float:
+    """socketpairで送ったMMPメッセージをMMPSocketReaderで受信した場合の所要時間（秒）を返す"""
+    sender, receiver = socket.socketpair()
+    payload = bytes(payload_size)
+
+    def send():
+        for buffer in iter_mmp_buffers(JSON_DATA, MEDIA_TYPE, payload):
+            sender.sendall(buffer)
+
+    thread = threading.Thread(target=send)
+    try:
+        start = time.perf_counter()
+        thread.start()
+        reader = MMPSocketReader(receiver, body_bytes)
+        reader.read_prefix()
+        for _ in reader.iter_payload():
+            pass
+        elapsed = time.perf_counter() - start
+        thread.join()
+        return elapsed
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def run_protocol(args) -> list[dict]:
+    """MMPのパック・アンパックと受信ループをbody_bytesごとに計測する"""
+    payload = bytes(args.protocol_size_mb * 1024 * 1024)
+    message = pack_mmp_message(JSON_DATA, MEDIA_TYPE, payload)
+    results = []
+
+    start = time.perf_counter()
+    pack_mmp_message(JSON_DATA, MEDIA_TYPE, payload)
+    results.append(
+        {
+            "name": "pack_mmp_message",
+            "body_bytes": None,
+            "seconds": time.perf_counter() - start,
+        }
+    )
+    for body_bytes in args.protocol_body_bytes:
+        results.append(
+            {
+                "name": "parser",
+                "body_bytes": body_bytes,
+                "seconds": bench_parser(message, body_bytes),
+            }
+        )
+        # 従来の連結は二乗で遅くなるため、小さいメッセージで計測する
+        legacy_payload = bytes(min(len(payload), 8 * 1024 * 1024))
+        results.append(
+            {
+                "name": "unpack_mmp_message",
+                "body_bytes": body_bytes,
+                "seconds": bench_legacy(
+                    pack_mmp_message(JSON_DATA, MEDIA_TYPE, legacy_payload), body_bytes
+                ),
+                "payload_bytes": len(legacy_payload),
+            }
+        )
+        results.append(
+            {
+                "name": "receive_loop",
+                "body_bytes": body_bytes,
+                "seconds": bench_receive_loop(len(payload), body_bytes),
+            }
+        )
+    for result in results:
+        result.setdefault("payload_bytes", len(payload))
+        print(
+            f"{result['name']:>18} body_bytes={str(result['body_bytes']):>8}: "
+            f"{result['payload_bytes'] / result['seconds'] / 1e9:.2f} GB/s",
+            file=sys.__stdout__,
+        )
+    return results
+
+
+def environment_info() -> dict:
+    """結果を比較する際に必要な実行環境の情報"""
+
+    def command_output(command: list[str]) -> str:
+        try:
+            result = subprocess.run(command, capture_output=True, text=True)
+            return result.stdout.splitlines()[0] if result.stdout else ""
+        except OSError:
+            return ""
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": command_output(["ffmpeg", "-version"]),
+        "git_commit": command_output(["git", "rev-parse", "HEAD"]),
+    }
+
+
+def compare(current: dict, baseline: dict):
+    """以前の結果と比較し、REGRESSION_THRESHOLD以上遅くなった項目を表示する"""
+
+    def e2e_times(report: dict) -> dict:
+        return {
+            (result["size"], result["duration"], result["action"]): result["latency"][
+                "p50"
+            ]
+            for result in report.get("e2e", [])
+        }
+
+    def protocol_times(report: dict) -> dict:
+        return {
+            (result["name"], result["body_bytes"]): result["seconds"]
+            for result in report.get("protocol", [])
+        }
+
+    regressions = 0
+    for label, extract in (("e2e p50", e2e_times), ("protocol", protocol_times)):
+        baseline_times = extract(baseline)
+        for key, seconds in extract(current).items():
+            if key not in baseline_times or baseline_times[key] <= 0:
+                continue
+            change = seconds / baseline_times[key] - 1
+            mark = "劣化" if change >= REGRESSION_THRESHOLD else ""
+            regressions += bool(mark)
+            print(f"{label} {key}: {change * 100:+.1f}% {mark}")
+    print(f"劣化した項目: {regressions}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="エンドツーエンドのベンチマーク")
+    parser.add_argument(
+        "--sizes", nargs="+", default=["640x360", "1280x720", "1920x1080"]
+    )
+    parser.add_argument(
+        "--durations", type=int, nargs="+", default=[10, 60], help="合成動画の長さ(秒)"
+    )
+    parser.add_argument(
+        "--actions",
+        nargs="+",
+        choices=[name for name, _ in ACTIONS],
+        help="計測する操作（省略時はすべて）",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="1条件あたりの計測回数")
+    parser.add_argument(
+        "--body-bytes", type=int, default=65536, help="E2E計測のbody_bytes"
+    )
+    parser.add_argument(
+        "--protocol-body-bytes",
+        type=int,
+        nargs="+",
+        default=[1400, 65536, 1048576],
+        help="プロトコル計測のbody_bytes",
+    )
+    parser.add_argument("--protocol-size-mb", type=int, default=64)
+    parser.add_argument(
+        "--input-dir",
+        default=os.path.join(tempfile.gettempdir(), "mmp_bench_inputs"),
+        help="合成動画の保存先（作成済みの動画は再利用する）",
+    )
+    parser.add_argument("--skip-e2e", action="store_true", help="プロトコル計測だけ行う")
+    parser.add_argument("--output", help="結果を書き込むJSONファイル")
+    parser.add_argument("--compare", help="比較する以前の結果のJSONファイル")
+    args = parser.parse_args()
+    # 計測中は作業ディレクトリへ移動するため絶対パスにしておく
+    args.input_dir = os.path.abspath(args.input_dir)
+
+    report = {"environment": environment_info(), "arguments": vars(args)}
+    report["protocol"] = run_protocol(args)
+
+    if not args.skip_e2e:
+        if not ffmpeg_available():
+            print("ffmpeg / ffprobe が見つからないためE2E計測を行いません")
+        else:
+            with tempfile.TemporaryDirectory(prefix="bench_e2e_") as work_dir:
+                # サーバーとクライアントのログは表示しない
+                with contextlib.redirect_stdout(io.StringIO()):
+                    cwd = os.getcwd()
+                    os.chdir(work_dir)
+                    try:
+                        report["e2e"] = run_e2e(args, work_dir)
+                    finally:
+                        os.chdir(cwd)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を書き込みました: {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
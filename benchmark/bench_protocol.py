@@ -0,0 +1,113 @@
+import argparse
+import time
+
+from custom_protocol import (
+    MMP_EVENT_PAYLOAD,
+    MMPParser,
+    iter_mmp_buffers,
+    pack_mmp_message,
+    parse_mmp_header,
+    unpack_mmp_message,
+)
+
+"""
+MMPコーデックのマイクロベンチマーク
+メモリ上に作成したMMPメッセージを指定したチャンクサイズに分割して解析し、スループット(GB/s)を計測します。
+    parser: MMPParserにmemoryviewの断片を渡してイベントを読み捨てる（ペイロードはコピーしない）
+    legacy: 従来どおり body += chunk で連結してから unpack_mmp_message で切り出す
+    pack:   pack_mmp_message（連結あり）と iter_mmp_buffers（連結なし）の比較
+
+実行例: python -m benchmark.bench_protocol --size-mb 256 --chunk-sizes 1400 65536 1048576
+"""
+
+JSON_DATA = {"action": "1", "quality": "23"}
+MEDIA_TYPE = "mp4"
+
+
+def bench_parser(message: bytes, chunk_size: int) -> float:
+    """MMPParserで解析した場合の所要時間（秒）を返す"""
+    view = memoryview(message)
+    parser = MMPParser()
+    payload_size = 0
+    start = time.perf_counter()
+    for position in range(0, len(view), chunk_size):
+        for kind, value in parser.feed(view[position : position + chunk_size]):
+            if kind == MMP_EVENT_PAYLOAD:
+                payload_size += len(value)
+    elapsed = time.perf_counter() - start
+    assert parser.at_message_boundary()
+    return elapsed
+
+
+def bench_legacy(message: bytes, chunk_size: int) -> float:
+    """従来の連結 + unpack_mmp_message で解析した場合の所要時間（秒）を返す"""
+    json_size, media_type_size, payload_size = parse_mmp_header(message[0:8])
+    start = time.perf_counter()
+    body_data = b""
+    for position in range(8, len(message), chunk_size):
+        body_data += message[position : position + chunk_size]
+    unpack_mmp_message(body_data, json_size, media_type_size, payload_size)
+    return time.perf_counter() - start
+
+
+def bench_pack(payload: bytes) -> tuple[float, float]:
+    """pack_mmp_message と iter_mmp_buffers の所要時間（秒）を返す"""
+    start = time.perf_counter()
+    pack_mmp_message(JSON_DATA, MEDIA_TYPE, payload)
+    packed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in iter_mmp_buffers(JSON_DATA, MEDIA_TYPE, payload):
+        pass
+    iterated = time.perf_counter() - start
+    return packed, iterated
+
+
+def throughput(size: int, elapsed: float) -> str:
+    """GB/s表記の文字列を返す"""
+    if elapsed <= 0:
+        return "inf GB/s"
+    return f"{size / elapsed / 1e9:.2f} GB/s"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MMPコーデックのマイクロベンチマーク")
+    parser.add_argument("--size-mb", type=int, default=256, help="ペイロードサイズ(MB)")
+    parser.add_argument(
+        "--legacy-size-mb",
+        type=int,
+        default=8,
+        help="legacy計測のペイロードサイズ(MB)。連結のコストが二乗で増えるため小さくする",
+    )
+    parser.add_argument(
+        "--chunk-sizes",
+        type=int,
+        nargs="+",
+        default=[1400, 65536, 1048576],
+        help="1回に渡すバイト数",
+    )
+    args = parser.parse_args()
+
+    payload = bytes(args.size_mb * 1024 * 1024)
+    message = pack_mmp_message(JSON_DATA, MEDIA_TYPE, payload)
+    legacy_payload = bytes(args.legacy_size_mb * 1024 * 1024)
+    legacy_message = pack_mmp_message(JSON_DATA, MEDIA_TYPE, legacy_payload)
+
+    for chunk_size in args.chunk_sizes:
+        elapsed = bench_parser(message, chunk_size)
+        print(
+            f"parser chunk={chunk_size:>8}: {elapsed:.3f} s  {throughput(len(message), elapsed)}"
+        )
+        elapsed = bench_legacy(legacy_message, chunk_size)
+        print(
+            f"legacy chunk={chunk_size:>8}: {elapsed:.3f} s  "
+            f"{throughput(len(legacy_message), elapsed)} ({args.legacy_size_mb} MB)"
+        )
+
+    packed, iterated = bench_pack(payload)
+    print(f"pack_mmp_message : {packed:.3f} s  {throughput(len(payload), packed)}")
+    print(f"iter_mmp_buffers : {iterated:.6f} s  {throughput(len(payload), iterated)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import argparse
+import heapq
+import random
+
+from job_scheduler import (
+    SCHEDULER_FIFO,
+    SCHEDULER_SJF,
+    JobOrder,
+    estimate_job_cost,
+    job_class,
+)
+
+"""
+ジョブのスケジューリングのシミュレーション
+音声抽出のような短いジョブと、長い動画の圧縮のような長いジョブが混ざって届く状況を
+ワーカー数分の仮想的なワーカーで処理し、分類ごとのキュー待ち時間(p50 / p99 / 最大)を
+FIFOと、見積もりコストの小さい順（aging_rateとmax_waitを変えたもの）で比較します。
+取り出す順はサーバーと同じjob_scheduler.JobOrderで決め、実際の処理時間は
+見積もりコストに誤差（対数正規分布）を乗せたものとします。ffmpegは使いません。
+
+実行例: python -m benchmark.bench_scheduler --workers 4 --load 0.9 --aging-rates 0 0.1 1 --max-waits 0 600
+"""
+
+# 届くジョブの種類（割合, json_data, probe結果）
+WORKLOAD = [
+    (
+        0.6,
+        {"action": "4"},
+        {"duration": 600.0, "video": {"width": 1920, "height": 1080}},
+    ),
+    (
+        0.25,
+        {"action": "5", "trim": "gif", "start_time": "10", "duration": "3"},
+        {"duration": 600.0, "video": {"width": 1280, "height": 720}},
+    ),
+    (
+        0.1,
+        {"action": "2", "resolution": "3"},
+        {"duration": 30.0, "video": {"width": 1280, "height": 720}},
+    ),
+    (
+        0.05,
+        {"action": "1", "quality": "28"},
+        {"duration": 120.0, "video": {"width": 1920, "height": 1080}},
+    ),
+]
+
+
+def percentile(values: list[float], ratio: float) -> float:
+    """最近傍法でパーセンタイルを返す"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))]
+
+
+def generate_jobs(args) -> list[tuple[float, float, float]]:
+    """(到着時刻, 見積もりコスト, 実際の処理時間) のリストを作る"""
+    rng = random.Random(args.seed)
+    weights = [weight for weight, _, _ in WORKLOAD]
+    costs = [
+        estimate_job_cost(json_data, media_info, 0)
+        for _, json_data, media_info in WORKLOAD
+    ]
+    mean_cost = sum(weight * cost for weight, cost in zip(weights, costs))
+    # 平均到着間隔は、ワーカーの使用率がloadになるように決める
+    arrival_rate = args.load * args.workers / mean_cost
+    jobs = []
+    arrived_at = 0.0
+    for _ in range(args.jobs):
+        arrived_at += rng.expovariate(arrival_rate)
+        cost = rng.choices(costs, weights)[0]
+        # 誤差の平均が1になるようにして、使用率をloadに保つ
+        error = rng.lognormvariate(-(args.estimate_error**2) / 2, args.estimate_error)
+        jobs.append((arrived_at, cost, cost * error))
+    return jobs
+
+
+def simulate(
+    jobs, workers: int, scheduler: str, aging_rate: float, max_wait: float
+) -> dict[str, list]:
+    """ジョブを処理し、分類ごとのキュー待ち時間のリストを返す"""
+    free_at = [0.0] * workers
+    queued = JobOrder(scheduler, aging_rate, max_wait)
+    waits: dict[str, list[float]] = {}
+    index = 0
+    while index < len(jobs) or queued:
+        now = heapq.heappop(free_at)
+        if not queued and jobs[index][0] > now:
+            now = jobs[index][0]
+        while index < len(jobs) and jobs[index][0] <= now:
+            arrived_at, cost, run_seconds = jobs[index]
+            queued.push((arrived_at, cost, run_seconds), cost, arrived_at)
+            index += 1
+        arrived_at, cost, run_seconds = queued.pop(now)
+        waits.setdefault(job_class(cost), []).append(now - arrived_at)
+        heapq.heappush(free_at, now + run_seconds)
+    return waits
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="ジョブのスケジューリングのシミュレーション"
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=20000)
+    parser.add_argument("--load", type=float, default=0.9, help="ワーカーの使用率")
+    parser.add_argument(
+        "--estimate-error",
+        type=float,
+        default=0.5,
+        help="処理時間の誤差（対数の標準偏差）",
+    )
+    parser.add_argument("--aging-rates", type=float, nargs="+", default=[0, 0.1, 1])
+    parser.add_argument("--max-waits", type=float, nargs="+", default=[0, 600])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    jobs = generate_jobs(args)
+    cases = [("fifo", SCHEDULER_FIFO, 0.0, 0.0)] + [
+        (f"sjf aging={rate:g} max_wait={max_wait:g}", SCHEDULER_SJF, rate, max_wait)
+        for rate in args.aging_rates
+        for max_wait in args.max_waits
+    ]
+    print(f"workers: {args.workers}, jobs: {args.jobs}, load: {args.load}")
+    for name, scheduler, aging_rate, max_wait in cases:
+        waits = simulate(jobs, args.workers, scheduler, aging_rate, max_wait)
+        summary = ", ".join(
+            f"{job_class_name} p50={percentile(values, 0.5):7.1f}s "
+            f"p99={percentile(values, 0.99):7.1f}s max={max(values):7.1f}s"
+            for job_class_name, values in sorted(waits.items())
+        )
+        print(f"{name:>26}: {summary}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import os
+import tempfile
+import time
+
+from benchmark.inputs import ffmpeg_available, generate_input
+from ffmpeg_function import compress_video_file, resize_video_resolution
+
+"""
+セグメント並列エンコードのベンチマーク
+ffmpegのlavfi(testsrc2 / sine)で合成した動画を、1プロセスでのエンコードと
+セグメント並列でのエンコードで処理し、所要時間と速度向上率を比較します。
+
+実行例: python -m benchmark.bench_segment_encode --duration 240 --segments 8
+"""
+
+
+def measure(function, *args) -> float:
+    """関数の所要時間（秒）を返す。失敗した場合は例外を送出する"""
+    start = time.perf_counter()
+    if not function(*args):
+        raise RuntimeError(f"{function.__name__}が失敗しました")
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="セグメント並列エンコードのベンチマーク")
+    parser.add_argument("--duration", type=int, default=240, help="合成動画の長さ(秒)")
+    parser.add_argument("--size", default="1920x1080", help="合成動画の解像度")
+    parser.add_argument(
+        "--segments", type=int, default=os.cpu_count() or 1, help="最大分割数"
+    )
+    parser.add_argument(
+        "--min-segment-seconds",
+        type=float,
+        default=10,
+        help="1セグメントの最短の長さ(秒)",
+    )
+    args = parser.parse_args()
+
+    if not ffmpeg_available():
+        print("ffmpeg / ffprobe が見つからないためベンチマークを実行できません")
+        return
+
+    with tempfile.TemporaryDirectory(prefix="bench_segment_") as work_dir:
+        input_path = os.path.join(work_dir, "input.mp4")
+        generate_input(input_path, args.duration, args.size)
+
+        cases = [
+            ("compress", compress_video_file, ["23"]),
+            ("resize", resize_video_resolution, ["2"]),
+        ]
+        for name, function, params in cases:
+            single = measure(
+                function, input_path, *params, os.path.join(work_dir, f"{name}_1.mp4")
+            )
+            parallel = measure(
+                function,
+                input_path,
+                *params,
+                os.path.join(work_dir, f"{name}_n.mp4"),
+                args.segments,
+                args.min_segment_seconds,
+            )
+            print(
+                f"{name:>8}: 1プロセス {single:.2f} s / "
+                f"{args.segments}セグメント {parallel:.2f} s (x{single / parallel:.2f})"
+            )
+
+
+if __name__ == "__main__":
+    main()
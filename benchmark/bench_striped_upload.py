@@ -0,0 +1,184 @@
+import argparse
+import contextlib
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+from collections import deque
+
+from benchmark.bench_e2e import free_port
+
+"""
+分割アップロードのベンチマーク
+ループバック上で起動したServerの手前に、往復遅延と接続ごとのウィンドウサイズを再現する
+プロキシを置き、同じファイルを接続数（upload_stripes）を変えて送信したときの
+転送速度(MB/s)を比較します。1本の接続の転送速度はおよそ ウィンドウサイズ / 遅延 で頭打ちになるため、
+接続数を増やすとその倍数まで速くなることを確認できます。
+処理内容には存在しない操作を指定するため、ffmpegが無い環境でも実行できます。
+
+実行例: python -m benchmark.bench_striped_upload --size-mb 64 --delay-ms 20 --stripes 1 2 4 8
+"""
+
+# 存在しない操作（受信後すぐにエラー応答が返る）
+JSON_DATA = {"action": "0"}
+MEDIA_TYPE = "mp4"
+# プロキシが1回に読み込むサイズ
+PROXY_CHUNK_BYTES = 64 * 1024
+
+
+class DelayLine:
+    """一方向の転送にdelay秒の遅延を加える
+
+    まだ相手に届いていないデータはwindowバイトまでしか溜めないため、
+    TCPのウィンドウサイズと往復遅延で転送速度が決まる回線と同じように振る舞う
+    """
+
+    def __init__(
+        self, source: socket.socket, dest: socket.socket, delay: float, window: int
+    ):
+        self.source = source
+        self.dest = dest
+        self.delay = delay
+        self.window = window
+        self._queue: deque[tuple[float, bytes]] = deque()
+        self._in_flight = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _read_loop(self):
+        try:
+            while data := self.source.recv(PROXY_CHUNK_BYTES):
+                with self._condition:
+                    while self._in_flight >= self.window:
+                        self._condition.wait()
+                    self._queue.append((time.monotonic() + self.delay, data))
+                    self._in_flight += len(data)
+                    self._condition.notify_all()
+        except OSError:
+            pass
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self._condition:
+                    while not self._queue and not self._closed:
+                        self._condition.wait()
+                    if not self._queue:
+                        break
+                    release_at, data = self._queue[0]
+                time.sleep(max(0.0, release_at - time.monotonic()))
+                self.dest.sendall(data)
+                with self._condition:
+                    self._queue.popleft()
+                    self._in_flight -= len(data)
+                    self._condition.notify_all()
+            self.dest.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class LatencyProxy:
+    """接続ごとに上り・下りのDelayLineを挟んでサーバーへ中継する"""
+
+    def __init__(self, target_port: int, delay: float, window: int):
+        self.target_port = target_port
+        self.delay = delay
+        self.window = window
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            client_socket, _ = self.listener.accept()
+            server_socket = socket.create_connection(("127.0.0.1", self.target_port))
+            # 遅延は片道ずつ加えるため、往復でdelay_msになるよう半分にする
+            DelayLine(client_socket, server_socket, self.delay / 2, self.window).start()
+            DelayLine(server_socket, client_socket, self.delay / 2, self.window).start()
+
+
+def bench(args, proxy: LatencyProxy, input_path: str, stripes: int) -> float:
+    """分割数stripesでファイルを送信し、応答を受け取るまでの所要時間（秒）を返す"""
+    from client import Client
+
+    client = Client()
+    client.port = proxy.port
+    client.upload_stripes = stripes
+    client.stripe_min_bytes = 0
+    client.connect()
+    start = time.perf_counter()
+    client.send_request(input_path, MEDIA_TYPE, JSON_DATA)
+    elapsed = time.perf_counter() - start
+    client.socket.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分割アップロードのベンチマーク")
+    parser.add_argument(
+        "--size-mb", type=int, default=64, help="送信するファイルのサイズ(MB)"
+    )
+    parser.add_argument("--delay-ms", type=float, default=20, help="往復遅延(ms)")
+    parser.add_argument(
+        "--window-kb", type=int, default=256, help="接続ごとのウィンドウサイズ(KB)"
+    )
+    parser.add_argument("--stripes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench_striped_") as work_dir:
+        # .envより優先される設定。結果キャッシュと再開用の事前確認は使わない
+        os.environ.update(
+            {
+                "ip": "127.0.0.1",
+                "port": str(free_port()),
+                "output_dir": os.path.join(work_dir, "output"),
+                "cache_max_bytes": "0",
+                "upload_store_dir": os.path.join(work_dir, "uploads"),
+                "probe_cache_dir": os.path.join(work_dir, "probe_cache"),
+                "metrics_port": "0",
+                "resumable_upload_min_bytes": str(1 << 62),
+                "max_connections": str(max(16, max(args.stripes) * 2)),
+            }
+        )
+        from server import Server
+
+        server = Server()
+        threading.Thread(target=server.server_start, daemon=True).start()
+        proxy = LatencyProxy(server.tcp_port, args.delay_ms / 1000, args.window_kb * 1024)
+
+        input_path = os.path.join(work_dir, "input.mp4")
+        with open(input_path, "wb") as f:
+            f.write(os.urandom(args.size_mb * 1024 * 1024))
+
+        print(
+            f"size: {args.size_mb} MB, delay: {args.delay_ms} ms, "
+            f"window: {args.window_kb} KB"
+        )
+        baseline = None
+        for stripes in args.stripes:
+            with contextlib.redirect_stdout(io.StringIO()):
+                elapsed = min(
+                    bench(args, proxy, input_path, stripes) for _ in range(args.repeat)
+                )
+            baseline = baseline or elapsed
+            print(
+                f"stripes={stripes:>2}: {args.size_mb * 1024 * 1024 / elapsed / 1e6:8.1f} MB/s "
+                f"({elapsed:.2f} s, x{baseline / elapsed:.2f})"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import argparse
+import socket
+import threading
+import time
+
+from benchmark.bench_protocol import JSON_DATA, MEDIA_TYPE
+from custom_protocol import MMP_EVENT_END, MMPParser, MMPSocketReader, iter_mmp_buffers
+from transport import BufferPool, configure_socket
+
+"""
+ソケット受信のベンチマーク
+ループバックのTCP接続でMMPメッセージを送り、受信側のスループット(MB/s)と
+受信のシステムコール回数を比較します。
+    recv     : 従来どおり recv(body_bytes) で毎回bytesを作ってMMPParserに渡す
+    recv_into: MMPSocketReaderでプールのバッファへrecv_intoし、受信サイズを
+               body_bytesからバッファのサイズまで増減する
+
+実行例: python -m benchmark.bench_transport --size-mb 256 --buffer-sizes 65536 1048576
+"""
+
+
+def open_connection(rcvbuf: int, sndbuf: int, nodelay: bool):
+    """ループバックでTCP接続を作り、(送信側, 受信側) のソケットを返す"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    configure_socket(listener, rcvbuf, sndbuf, nodelay)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    configure_socket(sender, rcvbuf, sndbuf, nodelay)
+    sender.connect(listener.getsockname())
+    receiver, _ = listener.accept()
+    listener.close()
+    return sender, receiver
+
+
+def receive_with_recv(sock: socket.socket, body_bytes: int) -> int:
+    """従来の受信ループ。recvの呼び出し回数を返す"""
+    parser = MMPParser()
+    recv_calls = 0
+    while True:
+        data = sock.recv(parser.next_read_size(body_bytes))
+        recv_calls += 1
+        if not data:
+            raise ConnectionError("受信途中で接続が閉じられました")
+        for kind, _ in parser.feed(data):
+            if kind == MMP_EVENT_END:
+                return recv_calls
+
+
+def receive_with_recv_into(sock: socket.socket, body_bytes: int, buffer_size: int) -> int:
+    """MMPSocketReaderの受信ループ。recv_intoの呼び出し回数を返す"""
+    reader = MMPSocketReader(sock, body_bytes, BufferPool(buffer_size, 1))
+    reader.read_prefix()
+    for _ in reader.iter_payload():
+        pass
+    reader.close()
+    return reader.recv_calls
+
+
+def bench(args, payload: bytes, receive) -> tuple[float, int]:
+    """1つのメッセージを送受信し、(所要時間, 受信のシステムコール回数) を返す"""
+    sender, receiver = open_connection(args.rcvbuf, args.sndbuf, args.nodelay)
+
+    def send():
+        for buffer in iter_mmp_buffers(JSON_DATA, MEDIA_TYPE, payload):
+            sender.sendall(buffer)
+
+    thread = threading.Thread(target=send)
+    try:
+        start = time.perf_counter()
+        thread.start()
+        recv_calls = receive(receiver)
+        elapsed = time.perf_counter() - start
+        thread.join()
+        return elapsed, recv_calls
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ソケット受信のベンチマーク")
+    parser.add_argument("--size-mb", type=int, default=256, help="ペイロードサイズ(MB)")
+    parser.add_argument("--body-bytes", type=int, default=1400, help="従来の受信サイズ")
+    parser.add_argument(
+        "--buffer-sizes",
+        type=int,
+        nargs="+",
+        default=[65536, 1048576],
+        help="recv_intoの受信バッファのサイズ（recv_buffer_bytes）",
+    )
+    parser.add_argument(
+        "--rcvbuf", type=int, default=0, help="SO_RCVBUF（0はOSの既定値）"
+    )
+    parser.add_argument(
+        "--sndbuf", type=int, default=0, help="SO_SNDBUF（0はOSの既定値）"
+    )
+    parser.add_argument("--nodelay", action="store_true", help="TCP_NODELAYを設定する")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    payload = bytes(args.size_mb * 1024 * 1024)
+    cases = [("recv", None, lambda sock: receive_with_recv(sock, args.body_bytes))]
+    for buffer_size in args.buffer_sizes:
+        cases.append(
+            (
+                "recv_into",
+                buffer_size,
+                lambda sock, size=buffer_size: receive_with_recv_into(
+                    sock, args.body_bytes, size
+                ),
+            )
+        )
+
+    print(
+        f"payload: {args.size_mb} MB, body_bytes: {args.body_bytes}, "
+        f"rcvbuf: {args.rcvbuf or 'default'}, sndbuf: {args.sndbuf or 'default'}, "
+        f"nodelay: {args.nodelay}"
+    )
+    for name, buffer_size, receive in cases:
+        results = [bench(args, payload, receive) for _ in range(args.repeat)]
+        elapsed, recv_calls = min(results)
+        print(
+            f"{name:>10} buffer={str(buffer_size):>8}: "
+            f"{len(payload) / elapsed / 1e6:8.1f} MB/s, {recv_calls:>9} syscalls"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+from benchmark.inputs import ffmpeg_available, generate_input
+from ffmpeg_function import trim_video_to_gif_webm
+
+"""
+切り取り(GIF/WEBM)のシーク方法のベンチマーク
+長い合成動画の先頭付近と末尾付近を切り取り、従来の出力側シーク（-iの後に-ss）と
+キーフレームへの入力側シーク＋出力側の差分シークの所要時間を比較します。
+入力側シークでは、切り取る位置が後ろでも所要時間がほとんど変わらないことを確認できます。
+
+実行例: python -m benchmark.bench_trim --duration 1800 --clip 5 --format gif
+"""
+
+
+def legacy_trim(
+    input_path: str, start_time: str, duration: str, output_path: str, output_format: str
+) -> bool:
+    """従来の出力側シークで切り取る（先頭から開始時刻までをすべてデコードする）"""
+    if output_format == "gif":
+        codec_args = ["-vf", "fps=10,scale=320:-1:flags=lanczos", "-c:v", "gif"]
+    else:
+        codec_args = ["-c:v", "libvpx-vp9", "-crf", "30", "-b:v", "0", "-an"]
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-i",
+            input_path,
+            "-ss",
+            start_time,
+            "-t",
+            duration,
+            *codec_args,
+            "-y",
+            output_path,
+        ],
+        capture_output=True,
+    )
+    return result.returncode == 0
+
+
+def measure(function, *args) -> float:
+    """関数の所要時間（秒）を返す。失敗した場合は例外を送出する"""
+    start = time.perf_counter()
+    if not function(*args):
+        raise RuntimeError(f"{function.__name__}が失敗しました")
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="切り取りのシーク方法のベンチマーク")
+    parser.add_argument("--duration", type=int, default=1800, help="合成動画の長さ(秒)")
+    parser.add_argument("--size", default="1280x720", help="合成動画の解像度")
+    parser.add_argument("--clip", type=int, default=5, help="切り取る長さ(秒)")
+    parser.add_argument("--format", choices=("gif", "webm"), default="gif")
+    args = parser.parse_args()
+
+    if not ffmpeg_available():
+        print("ffmpeg / ffprobe が見つからないためベンチマークを実行できません")
+        return
+
+    with tempfile.TemporaryDirectory(prefix="bench_trim_") as work_dir:
+        input_path = os.path.join(work_dir, "input.mp4")
+        # 5秒ごとにキーフレーム、音声なし
+        generate_input(input_path, args.duration, args.size, 150, audio=False)
+
+        positions = [
+            ("先頭付近", 3.5),
+            ("末尾付近", args.duration - args.clip - 3.5),
+        ]
+        output_path = os.path.join(work_dir, f"output.{args.format}")
+        for name, start in positions:
+            start_time = f"{start:.1f}"
+            legacy = measure(
+                legacy_trim,
+                input_path,
+                start_time,
+                str(args.clip),
+                output_path,
+                args.format,
+            )
+            fast = measure(
+                trim_video_to_gif_webm,
+                input_path,
+                start_time,
+                str(args.clip),
+                output_path,
+                args.format,
+            )
+            print(
+                f"{name} ({start_time} s): 出力側シーク {legacy:.2f} s / "
+                f"入力側シーク {fast:.2f} s (x{legacy / fast:.2f})"
+            )
+
+
+if __name__ == "__main__":
+    main()
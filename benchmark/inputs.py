@@ -0,0 +1,66 @@
+import os
+import shutil
+import subprocess
+
+"""
+ベンチマーク用の合成動画
+ffmpegのlavfi(testsrc2 / sine)で作成するため、同じ引数からは同じ内容の動画が作られ、
+どの環境でも同じ条件で計測できます。
+"""
+
+
+def ffmpeg_available() -> bool:
+    """ffmpegとffprobeが使えるかどうか"""
+    return shutil.which("ffmpeg") is not None and shutil.which("ffprobe") is not None
+
+
+def generate_input(
+    path: str, duration: int, size: str, keyframe_interval: int = 60, audio: bool = True
+):
+    """ffmpegのlavfiで30fpsの合成動画を作成する
+
+    Args:
+        path: 出力ファイルのパス
+        duration: 長さ（秒）
+        size: 解像度（例: "1280x720"）
+        keyframe_interval: キーフレームの間隔（フレーム数）
+        audio: Trueの場合は440Hzの正弦波の音声を含める
+    """
+    command = [
+        "ffmpeg",
+        "-f",
+        "lavfi",
+        "-i",
+        f"testsrc2=size={size}:rate=30:duration={duration}",
+    ]
+    if audio:
+        command += ["-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}"]
+    command += [
+        "-c:v",
+        "libx264",
+        "-preset",
+        "ultrafast",
+        "-g",
+        str(keyframe_interval),
+        "-pix_fmt",
+        "yuv420p",
+    ]
+    if audio:
+        command += ["-c:a", "aac", "-shortest"]
+    command += ["-y", path]
+    subprocess.run(command, capture_output=True, check=True)
+
+
+def cached_input(
+    cache_dir: str, duration: int, size: str, keyframe_interval: int = 60
+) -> str:
+    """同じ条件の合成動画が作成済みであれば再利用し、無ければ作成してパスを返す"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(
+        cache_dir, f"testsrc2_{size}_{duration}s_g{keyframe_interval}.mp4"
+    )
+    if not os.path.exists(path):
+        tmp_path = f"{path}.tmp.mp4"
+        generate_input(tmp_path, duration, size, keyframe_interval)
+        os.replace(tmp_path, path)
+    return path
@@ -1,9 +1,28 @@
+import argparse
+import glob
+import hashlib
+import json
 import os
+import shutil
 import socket
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 from dotenv import load_dotenv
 
-from custom_protocol import pack_mmp_message, unpack_mmp_message
+from custom_protocol import (
+    MMPSocketReader,
+    MMPSocketWriter,
+    send_mmp_file,
+    send_mmp_message,
+)
+from ffmpeg_function import cut_keyframe_segment, extract_audio_stream_copy
+from media_probe import parse_timestamp
+from transport import DEFAULT_RECV_BUFFER_BYTES, BufferPool, configure_socket
+from upload_store import UPLOAD_STATUS_RECEIVING
 
 # 環境変数を読み込む
 load_dotenv()
@@ -11,18 +30,56 @@ load_dotenv()
 
 class Client:
     def __init__(self) -> None:
-        # バッファサイズ
-        self.header_bytes: int = int(os.getenv("header_bytes", 8))
+        # 受信バッファサイズ（1回に受信する最小のサイズ）
         self.body_bytes: int = int(os.getenv("body_bytes", 1400))
+        # 受信サイズを増やす上限と、ソケットのバッファサイズ・Nagleアルゴリズムの無効化
+        self.recv_buffer_pool = BufferPool(
+            int(os.getenv("recv_buffer_bytes", DEFAULT_RECV_BUFFER_BYTES)), 1
+        )
+        self.socket_rcvbuf: int = int(os.getenv("socket_rcvbuf", 0))
+        self.socket_sndbuf: int = int(os.getenv("socket_sndbuf", 0))
+        self.tcp_nodelay: bool = os.getenv("tcp_nodelay", "0") == "1"
         self.port: int = int(os.getenv("port", 8888))
         self.ip: str = os.getenv("ip", "127.0.0.1")
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # このサイズ以上のファイルは事前確認を行い、重複送信の省略と中断からの再開を行う
+        self.resumable_upload_min_bytes: int = int(
+            os.getenv("resumable_upload_min_bytes", 64 * 1024 * 1024)
+        )
+        # このサイズ以上のファイルはupload_stripes本の接続に分けて並行して送信する（1は分割しない）
+        self.upload_stripes: int = int(os.getenv("upload_stripes", 1))
+        self.stripe_min_bytes: int = int(os.getenv("stripe_min_bytes", 64 * 1024 * 1024))
+        # 事前確認で同じファイルを他の接続が受信中と返された場合に、確認し直しながら待つ秒数
+        self.upload_receiving_wait: float = float(os.getenv("upload_receiving_wait", 90))
+        # 送信中に接続が切れた場合に再接続する回数
+        self.upload_retries: int = int(os.getenv("upload_retries", 3))
+        # 1の場合、音声抽出と切り取りではローカルのffmpegで必要な部分だけを取り出して送信する
+        self.client_pre_cut: bool = os.getenv("client_pre_cut", "0") == "1"
+        # 1の場合、処理結果をffmpegの処理中から順に受け取るストリーミング応答を要求する
+        self.stream_response: bool = os.getenv("stream_response", "0") == "1"
+        # 処理結果を保存するディレクトリ
+        self.output_dir: str = "./client_received_data"
+        # keep-aliveの接続で応答を待っているリクエスト（request_id -> (Future, 保存ファイル名の接頭辞)）
+        self._pending: dict[int, tuple[Future, str | None]] = {}
+        self._pending_lock = threading.Lock()
+        self._next_request_id = 0
+        self._writer: MMPSocketWriter | None = None
+        self._receiver: threading.Thread | None = None
 
     def connect(self):
         """サーバーに接続する"""
         print("サーバーに接続中です....")
+        configure_socket(
+            self.socket, self.socket_rcvbuf, self.socket_sndbuf, self.tcp_nodelay
+        )
         self.socket.connect((self.ip, self.port))
 
+    def reconnect(self):
+        """ソケットを作り直してサーバーに再接続する"""
+        self.socket.close()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect()
+
     def send_and_recieve_processing(self):
         """送信と受信の処理"""
 
@@ -31,11 +88,9 @@ class Client:
         while True:
             # file_path = input()
             file_path = "Azki.mp4"  # デバッグ
-            # ファイル読み込み
-            with open(file_path, "rb") as f:
-                file_data = f.read()
             # ファイルサイズが4GB以上の場合エラー
-            if len(file_data) > 4 * 1024 * 1024 * 1024:
+            # 内容はメモリに読み込まず、送信時にファイルから直接送る
+            if os.path.getsize(file_path) > 4 * 1024 * 1024 * 1024:
                 print("ファイルサイズが4GBを超えています。別のファイルを選んでください")
             else:
                 break
@@ -53,6 +108,22 @@ class Client:
             else:
                 break
 
+        json_data = self.input_json_data()
+
+        if self.client_pre_cut and shutil.which("ffmpeg"):
+            with tempfile.TemporaryDirectory(prefix="pre_cut_") as work_dir:
+                upload_path, json_data = self.pre_cut(
+                    file_path, file_extension, json_data, work_dir
+                )
+                self.send_request(upload_path, file_extension, json_data)
+        else:
+            self.send_request(file_path, file_extension, json_data)
+
+        # ソケットを閉じる
+        self.socket.close()
+
+    def input_json_data(self) -> dict:
+        """操作内容と必要な要件を入力し、送信するjsonデータを作成する"""
         # 操作内容を表示
         operation_list = {
             "1": "Compress Video",
@@ -65,16 +136,31 @@ class Client:
         for key, value in operation_list.items():
             print(f"{key}: {value}")
         # 操作内容を入力
-        print("操作内容の数字を入力してください")
+        # カンマ区切りで複数指定すると、1回のffmpeg処理でまとめて実行する（例: 2,3,1）
+        print(
+            "操作内容の数字を入力してください。複数の場合はカンマ区切りで入力してください"
+        )
         while True:
-            operation = input()
+            operations = [operation.strip() for operation in input().split(",")]
             # 操作内容の整合性確認
-            if operation not in operation_list:
-                print(f"入力した値:{operation}が不正です。再度入力してください。")
+            invalid = [
+                operation for operation in operations if operation not in operation_list
+            ]
+            if invalid:
+                print(f"入力した値:{','.join(invalid)}が不正です。再度入力してください。")
             else:
                 break
 
         # 処理の引数を含むボディデータのjsonを作成
+        operation_json_list = [
+            self.input_operation_params(operation) for operation in operations
+        ]
+        if len(operation_json_list) == 1:
+            return operation_json_list[0]
+        return {"operations": operation_json_list}
+
+    def input_operation_params(self, operation: str) -> dict:
+        """操作内容に応じて必要な要件を入力し、1つの操作のjsonデータを作成する"""
         json_data = {"action": operation}
 
         while True:
@@ -137,51 +223,611 @@ class Client:
                 else:
                     print("未入力は認めれません。再度入力してください。")
 
+        return json_data
+
+    def pre_cut(
+        self, file_path: str, file_extension: str, json_data: dict, work_dir: str
+    ) -> tuple[str, dict]:
+        """サーバーが必要とする部分だけをストリームコピーで取り出し、送信するファイルを作成する
+
+        音声抽出(4)では音声トラックだけを、切り取り(5)では指定範囲を含むキーフレーム区間だけを
+        送信する。切り出した区間はキーフレームから始まるため、start_timeは区間の先頭からの
+        時刻に置き換える。それ以外の操作や取り出しに失敗した場合は元のファイルをそのまま送る
+
+        Returns:
+            tuple[str, dict]: 送信するファイルのパスと、送信するJSONデータ
+        """
+        operations = json_data.get("operations") or [json_data]
+        last_operation = operations[-1]
+        upload_path = os.path.join(work_dir, f"upload.{file_extension}")
+
+        if len(operations) == 1 and last_operation.get("action") == "4":
+            if not extract_audio_stream_copy(file_path, upload_path):
+                return file_path, json_data
+            new_json_data = json_data
+        elif last_operation.get("action") == "5":
+            start_seconds = parse_timestamp(last_operation.get("start_time"))
+            duration_seconds = parse_timestamp(last_operation.get("duration"))
+            if start_seconds is None or duration_seconds is None:
+                return file_path, json_data
+            keyframe_time = cut_keyframe_segment(
+                file_path, start_seconds, duration_seconds, upload_path
+            )
+            if keyframe_time is None:
+                return file_path, json_data
+            # 切り出した区間の先頭からの時刻に置き換える
+            trim_operation = {
+                **last_operation,
+                "start_time": f"{start_seconds - keyframe_time:.3f}",
+            }
+            if "operations" in json_data:
+                new_json_data = {
+                    **json_data,
+                    "operations": [*operations[:-1], trim_operation],
+                }
+            else:
+                new_json_data = trim_operation
+        else:
+            return file_path, json_data
+
+        print(
+            f"必要な部分だけを送信します: {os.path.getsize(file_path)} bytes -> "
+            f"{os.path.getsize(upload_path)} bytes"
+        )
+        return upload_path, new_json_data
+
+    def send_request(self, file_path: str, file_extension: str, json_data: dict) -> dict:
+        """ファイルを送信して処理結果を受信する
+
+        resumable_upload_min_bytes以上のファイルはコンテンツハッシュを付けて事前確認を行い、
+        サーバーが既に持っている部分は送信しない。送信中に接続が切れた場合は
+        再接続して、サーバーが受信済みの位置から続きを送信する。
+        upload_stripesが2以上でstripe_min_bytes以上のファイルは分割して送信する
+
+        Returns:
+            dict: サーバーから返されたJSONデータ
+        """
+        if self.stream_response:
+            json_data = {**json_data, "stream": True}
+        file_size = os.path.getsize(file_path)
+        if self.upload_stripes > 1 and file_size >= self.stripe_min_bytes:
+            return self.send_striped(file_path, file_extension, json_data, file_size)
+        if file_size < self.resumable_upload_min_bytes:
+            return self.send_and_receive(file_path, file_extension, json_data)
+
+        json_data = {
+            **json_data,
+            "upload_hash": self.hash_file(file_path),
+            "upload_size": file_size,
+        }
+        for attempt in range(self.upload_retries + 1):
+            try:
+                if attempt > 0:
+                    self.reconnect()
+                upload_offset = self.preflight(json_data, file_extension)
+                return self.send_and_receive(
+                    file_path,
+                    file_extension,
+                    {**json_data, "upload_offset": upload_offset},
+                    upload_offset,
+                )
+            except OSError as e:
+                if attempt == self.upload_retries:
+                    raise
+                print(f"接続が切断されました。再接続して続きから送信します: {e}")
+
+    def send_striped(
+        self, file_path: str, file_extension: str, json_data: dict, file_size: int
+    ) -> dict:
+        """ファイルをupload_stripes個のバイト範囲に分け、複数の接続から並行して送信する
+
+        すべての範囲をそれぞれ別の接続でstripeのメッセージとして送り、受信応答が揃ってから
+        この接続でペイロードの無いジョブのリクエストを送る。1本の接続の転送速度が往復遅延と
+        ウィンドウサイズで頭打ちになる回線でも、接続の本数分まで転送速度を上げられる。
+        送信中はこの接続を閉じておき、サーバーの接続数の上限を範囲の送信に使えるようにする。
+        分割したアップロードは中断からの再開を行わない。
+        送信できなかった範囲がある場合は、ジョブのリクエストを送らずにその範囲への応答を返す
+
+        Returns:
+            dict: サーバーから返されたJSONデータ
+
+        Raises:
+            OSError: upload_retries回再接続しても範囲を送信できなかった場合
+        """
+        upload_id = uuid.uuid4().hex
+        stripe_size = -(-file_size // self.upload_stripes)
+        offsets = list(range(0, file_size, stripe_size))
+        print(f"{len(offsets)}本の接続に分けて送信します")
+        self.socket.close()
+        with ThreadPoolExecutor(max_workers=len(offsets)) as executor:
+            futures = [
+                executor.submit(
+                    self.send_stripe,
+                    upload_id,
+                    file_path,
+                    file_extension,
+                    file_size,
+                    offset,
+                    min(stripe_size, file_size - offset),
+                )
+                for offset in offsets
+            ]
+        self.reconnect()
+        for future in futures:
+            response_json_data = future.result()
+            if response_json_data.get("status_id") != "200":
+                print("範囲を送信できなかったため、ジョブのリクエストを送りません")
+                print(response_json_data.get("message"))
+                print(response_json_data.get("solution"))
+                return response_json_data
+        return self.send_and_receive(
+            file_path,
+            file_extension,
+            {**json_data, "upload_id": upload_id, "upload_size": file_size},
+            upload_count=0,
+        )
+
+    def send_stripe(
+        self,
+        upload_id: str,
+        file_path: str,
+        file_extension: str,
+        file_size: int,
+        offset: int,
+        length: int,
+    ) -> dict:
+        """分割アップロードの1つの範囲を新しい接続で送信し、サーバーの応答を返す
+
+        ビジー応答が返った場合や接続が切れた場合は、upload_retries回まで時間をおいて送り直す
+
+        Returns:
+            dict: サーバーから返されたJSONデータ（受信できた場合はstatus_idが"200"）
+
+        Raises:
+            OSError: upload_retries回送り直しても接続が切れた場合
+        """
+        for attempt in range(self.upload_retries + 1):
+            if attempt > 0:
+                time.sleep(attempt)
+            try:
+                response_json_data = self.send_stripe_once(
+                    upload_id, file_path, file_extension, file_size, offset, length
+                )
+            except OSError as e:
+                if attempt == self.upload_retries:
+                    raise
+                print(f"範囲の送信中に接続が切断されました。送り直します: {e}")
+                continue
+            if (
+                response_json_data.get("status_id") != "503"
+                or attempt == self.upload_retries
+            ):
+                break
+            print(f"サーバーが混雑しているため範囲を送り直します: {offset}")
+        return response_json_data
+
+    def send_stripe_once(
+        self,
+        upload_id: str,
+        file_path: str,
+        file_extension: str,
+        file_size: int,
+        offset: int,
+        length: int,
+    ) -> dict:
+        """分割アップロードの1つの範囲を新しい接続で1回送信し、サーバーの応答を返す"""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            configure_socket(
+                sock, self.socket_rcvbuf, self.socket_sndbuf, self.tcp_nodelay
+            )
+            sock.connect((self.ip, self.port))
+            send_mmp_file(
+                sock,
+                {
+                    "action": "stripe",
+                    "upload_id": upload_id,
+                    "upload_size": file_size,
+                    "stripe_offset": offset,
+                },
+                file_extension,
+                file_path,
+                offset,
+                length,
+            )
+            reader = MMPSocketReader(sock, self.body_bytes)
+            response_json_data, _, _ = reader.read_prefix()
+            reader.read_payload()
+            return response_json_data
+
+    def preflight(self, json_data: dict, file_extension: str) -> int:
+        """送信前にサーバーへコンテンツハッシュとサイズを伝え、送信を始めるオフセットを受け取る
+
+        切断前の接続がまだ受信中と返された場合は、サーバーがその接続の切断を検知して
+        受信済みの位置から再開できるようになるまで、upload_receiving_wait秒を上限に確認し直す
+        """
+        deadline = time.monotonic() + self.upload_receiving_wait
+        while True:
+            send_mmp_message(
+                self.socket,
+                {
+                    "action": "preflight",
+                    "upload_hash": json_data["upload_hash"],
+                    "upload_size": json_data["upload_size"],
+                },
+                file_extension,
+            )
+            reader = MMPSocketReader(self.socket, self.body_bytes)
+            response_json_data, _, _ = reader.read_prefix()
+            reader.read_payload()
+            if (
+                response_json_data.get("upload_status") != UPLOAD_STATUS_RECEIVING
+                or time.monotonic() >= deadline
+            ):
+                break
+            print("同じファイルを受信中の接続があるため、待ってから再度確認します")
+            time.sleep(2)
+        upload_offset = int(response_json_data.get("upload_offset", 0))
+        print(
+            f"事前確認: {response_json_data.get('upload_status')} (オフセット: {upload_offset})"
+        )
+        return upload_offset
+
+    @staticmethod
+    def hash_file(file_path: str) -> str:
+        """ファイルのSHA-256を一定のメモリで計算する"""
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            while data := f.read(1024 * 1024):
+                hasher.update(data)
+        return hasher.hexdigest()
+
+    def send_and_receive(
+        self,
+        file_path: str,
+        file_extension: str,
+        json_data: dict,
+        upload_offset: int = 0,
+        upload_count: int | None = None,
+    ) -> dict:
+        """ファイルのupload_offsetから後ろ（upload_countを指定した場合はそのバイト数）を
+        送信して処理結果を受信する
+
+        送信はsocket.sendfileでファイルから直接行い、受信したペイロードは
+        到着した順にoutput_dir（client_received_data/）へ書き込むため、ファイルサイズに関わらず
+        メモリ使用量は一定になる
+
+        Returns:
+            dict: サーバーから返されたJSONデータ
+        """
         # サーバーへ送信
-        send_data = pack_mmp_message(json_data, file_extension, file_data)
-        print(f"send_data: {len(send_data)}")
-        self.socket.sendall(send_data)
-
-        # ヘッダーを取得
-        header_data_bytes = self.socket.recv(self.header_bytes)
-        # ヘッダーから各サイズを取得
-        json_size = int.from_bytes(header_data_bytes[0:2], byteorder="big")
-        media_type_size = int.from_bytes(header_data_bytes[2:3], byteorder="big")
-        payload_size = int.from_bytes(header_data_bytes[3:9], byteorder="big")
-        body_data_size = json_size + media_type_size + payload_size
-
-        # 動画データ受信
-        # 設計として基本的に1400バイトずつ受信する
-        body_data = b""
-        remaining = body_data_size
-        while remaining > 0:
-            # 効率よく受信するため受信データの残りが設定値より小さい場合そちらを採用
-            received_data = self.socket.recv(min(remaining, self.body_bytes))
-            remaining -= len(received_data)
-            body_data += received_data
-        print(f"動画データの受信完了しました。動画データのサイズ: {len(body_data)} bytes")
-
-        # ボディデータを解析
-        json_data, media_type, payload_data = unpack_mmp_message(
-            body_data, json_size, media_type_size, payload_size
+        payload_size = send_mmp_file(
+            self.socket, json_data, file_extension, file_path, upload_offset, upload_count
         )
-        # デバッグ
-        print(f"json_data: {json_data}")
-        print(f"media_type: {media_type}")
-        print(f"payload_data: {len(payload_data)}")
-
-        if json_data.get("status_id") == "200":
-            # 受信したバイナリデータから動画を作成して保存
-            output_file_path = f"./client_received_data/{json_data.get('file_name')}"
-            with open(output_file_path, "wb") as f:
-                f.write(payload_data)
-        elif json_data.get("status_id") == "400":
-            print(json_data.get("message"))
-            print(json_data.get("solution"))
+        print(f"send_data: {payload_size}")
 
-        # ソケットを閉じる
+        # ヘッダーとJSONデータ、メディアタイプを先に受信して解析する
+        reader = MMPSocketReader(self.socket, self.body_bytes, self.recv_buffer_pool)
+        stream_file = None
+        try:
+            response_json_data, media_type, payload_size = reader.read_prefix()
+            # 処理が終わるまでは途中経過のメッセージと、ストリーミング応答のチャンクが届く
+            while response_json_data.get("status_id") in ("102", "206"):
+                if response_json_data.get("status_id") == "206":
+                    if stream_file is None:
+                        stream_file = self.open_output_file(
+                            response_json_data.get("file_name")
+                        )
+                        print("処理結果の受信を開始しました")
+                    reader.read_payload_into(stream_file)
+                else:
+                    reader.read_payload()
+                    self.print_progress(response_json_data.get("progress", {}))
+                response_json_data, media_type, payload_size = reader.read_prefix()
+            if stream_file is not None:
+                stream_file.close()
+            # デバッグ
+            print(f"json_data: {response_json_data}")
+            print(f"media_type: {media_type}")
+
+            if response_json_data.get("stream") == "end":
+                reader.read_payload()
+                if response_json_data.get("status_id") == "200":
+                    print(
+                        "動画データの受信完了しました。動画データのサイズ: "
+                        f"{response_json_data.get('stream_size')} bytes"
+                    )
+                else:
+                    # 途中まで受け取った処理結果は破棄する
+                    if stream_file is not None:
+                        os.remove(stream_file.name)
+                    print(response_json_data.get("message"))
+                    print(response_json_data.get("solution"))
+            elif response_json_data.get("status_id") == "200":
+                # 受信したペイロードはメモリに溜めずにそのままファイルへ書き込む
+                output_file_path = os.path.join(
+                    self.output_dir,
+                    os.path.basename(response_json_data.get("file_name")),
+                )
+                received_size = reader.read_payload_to_file(output_file_path)
+                print(
+                    f"動画データの受信完了しました。動画データのサイズ: {received_size} bytes"
+                )
+            else:
+                # エラー応答にはペイロードが無いが、念のため読み捨てる
+                reader.read_payload()
+                if response_json_data.get("status_id") in ("400", "503"):
+                    print(response_json_data.get("message"))
+                    print(response_json_data.get("solution"))
+
+            return response_json_data
+        finally:
+            if stream_file is not None:
+                stream_file.close()
+            reader.close()
+
+    def open_output_file(self, file_name: str, prefix: str = ""):
+        """処理結果を書き込むファイルをoutput_dirに開く（ストリーミング応答用）"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        return open(
+            os.path.join(self.output_dir, prefix + os.path.basename(file_name)), "wb"
+        )
+
+    def start_keep_alive(self):
+        """接続を維持して複数のリクエストを送るための受信スレッドを開始する
+
+        connect()の後に呼び出す。以降はsubmit_request()でリクエストを送信でき、
+        応答はサーバーで処理が終わった順にrequest_idで対応付けて受け取る
+        """
+        self._writer = MMPSocketWriter(self.socket)
+        self._receiver = threading.Thread(target=self._receive_loop, daemon=True)
+        self._receiver.start()
+
+    def submit_request(
+        self,
+        file_path: str,
+        file_extension: str,
+        json_data: dict,
+        output_prefix: str | None = None,
+    ) -> Future:
+        """keep-aliveの接続でファイルを送信し、処理結果を受け取るFutureを返す
+
+        前のリクエストの応答を待たずに続けて送信できる。処理結果は
+        output_dirに「output_prefix（省略時は "<request_id>_"）+ サーバーのファイル名」で保存する
+
+        Returns:
+            Future: サーバーから返されたJSONデータを結果に持つFuture
+        """
+        future: Future = Future()
+        with self._pending_lock:
+            request_id = self._next_request_id
+            self._next_request_id += 1
+            self._pending[request_id] = (future, output_prefix)
+        try:
+            request_json_data = {
+                **json_data,
+                "keep_alive": True,
+                "request_id": request_id,
+            }
+            if self.stream_response:
+                request_json_data["stream"] = True
+            payload_size = self._writer.send_file(
+                request_json_data, file_extension, file_path
+            )
+        except OSError as e:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            future.set_exception(e)
+            return future
+        print(f"send_data: {payload_size} (request_id: {request_id})")
+        return future
+
+    def close_keep_alive(self):
+        """送信済みのリクエストの応答をすべて受け取ってから接続を閉じる"""
+        with self._pending_lock:
+            futures = [future for future, _ in self._pending.values()]
+        wait(futures)
+        # 送信側だけを閉じるとサーバーは処理中の応答を送り終えてから接続を閉じる
+        try:
+            self.socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        if self._receiver is not None:
+            self._receiver.join()
+            self._receiver = None
+        self._writer = None
         self.socket.close()
 
+    def _receive_loop(self):
+        """keep-aliveの接続で届いた応答をrequest_idごとに振り分ける"""
+        reader = MMPSocketReader(self.socket, self.body_bytes, self.recv_buffer_pool)
+        # ストリーミング応答を受信中のリクエストのファイル（request_id -> ファイル）
+        stream_files = {}
+        try:
+            while True:
+                response_json_data, _, _ = reader.read_prefix()
+                request_id = response_json_data.get("request_id")
+                with self._pending_lock:
+                    entry = self._pending.get(request_id)
+                status_id = response_json_data.get("status_id")
+                if status_id == "102":
+                    reader.read_payload()
+                    self.print_progress(response_json_data.get("progress", {}))
+                    continue
+                if entry is None:
+                    # 対応するリクエストが無い応答は読み捨てる
+                    print(f"不明なrequest_idの応答です: {response_json_data}")
+                    reader.read_payload()
+                    continue
+
+                future, output_prefix = entry
+                prefix = output_prefix if output_prefix is not None else f"{request_id}_"
+                if status_id == "206":
+                    stream_file = stream_files.get(request_id)
+                    if stream_file is None:
+                        stream_file = stream_files[request_id] = self.open_output_file(
+                            response_json_data.get("file_name"), prefix
+                        )
+                    reader.read_payload_into(stream_file)
+                    continue
+
+                stream_file = stream_files.pop(request_id, None)
+                if stream_file is not None:
+                    stream_file.close()
+                if response_json_data.get("stream") == "end":
+                    reader.read_payload()
+                    if status_id == "200":
+                        print(
+                            f"動画データの受信完了しました (request_id: {request_id}): "
+                            f"{response_json_data.get('stream_size')} bytes"
+                        )
+                    else:
+                        # 途中まで受け取った処理結果は破棄する
+                        if stream_file is not None:
+                            os.remove(stream_file.name)
+                        print(response_json_data.get("message"))
+                        print(response_json_data.get("solution"))
+                elif status_id == "200":
+                    output_file_path = os.path.join(
+                        self.output_dir,
+                        prefix + os.path.basename(response_json_data.get("file_name")),
+                    )
+                    received_size = reader.read_payload_to_file(output_file_path)
+                    print(
+                        f"動画データの受信完了しました (request_id: {request_id}): "
+                        f"{received_size} bytes"
+                    )
+                else:
+                    reader.read_payload()
+                    if status_id in ("400", "503"):
+                        print(response_json_data.get("message"))
+                        print(response_json_data.get("solution"))
+                with self._pending_lock:
+                    self._pending.pop(request_id, None)
+                future.set_result(response_json_data)
+        except OSError as e:
+            # 接続が閉じられた場合は応答を待っているリクエストをすべて失敗にする
+            with self._pending_lock:
+                pending = list(self._pending.values())
+                self._pending.clear()
+            for future, _ in pending:
+                future.set_exception(ConnectionError(f"接続が閉じられました: {e}"))
+        finally:
+            for stream_file in stream_files.values():
+                stream_file.close()
+            reader.close()
+
+    @staticmethod
+    def print_progress(progress: dict):
+        """サーバーから届いたffmpegの進捗と残り時間の見積もりを表示する"""
+        out_time = progress.get("out_time")
+        speed = progress.get("speed")
+        total_seconds = progress.get("total_seconds")
+        message = f"処理中: {progress.get('frame', 0)} frames"
+        if progress.get("fps"):
+            message += f", {progress['fps']:.1f} fps"
+        if speed:
+            message += f", x{speed:.2f}"
+        if out_time is not None and total_seconds:
+            message += f", {min(out_time / total_seconds, 1.0) * 100:.1f}%"
+            if speed:
+                eta = max(total_seconds - out_time, 0.0) / speed
+                message += f", 残り約{eta:.0f}秒"
+        print(message)
+
+    def run_batch(self, pattern: str, json_data: dict) -> dict:
+        """ディレクトリまたはglobに一致するファイルを、同じ操作でまとめて処理する
+
+        keep-aliveの1つの接続で送信し、前のファイルをサーバーがエンコードしている間に
+        次のファイルを送信する。処理結果は届いた順にoutput_dirへ「元のファイル名_処理結果のファイル名」で
+        保存し、最後に全体のスループットを表示する
+
+        Returns:
+            dict: 件数・送受信バイト数・経過時間・スループットの集計
+        """
+        if os.path.isdir(pattern):
+            file_paths = sorted(
+                entry.path for entry in os.scandir(pattern) if entry.is_file()
+            )
+        else:
+            file_paths = sorted(
+                path for path in glob.glob(pattern) if os.path.isfile(path)
+            )
+        if not file_paths:
+            print(f"送信するファイルが見つかりません: {pattern}")
+            return {}
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        start = time.perf_counter()
+        sent_bytes = 0
+        submitted: list[tuple[str, str, Future]] = []
+        self.connect()
+        self.start_keep_alive()
+        try:
+            with tempfile.TemporaryDirectory(prefix="pre_cut_") as work_dir:
+                for file_path in file_paths:
+                    if os.path.getsize(file_path) > 4 * 1024 * 1024 * 1024:
+                        print(
+                            f"ファイルサイズが4GBを超えているため送信しません: {file_path}"
+                        )
+                        continue
+                    file_extension = os.path.splitext(file_path)[1].lstrip(".")
+                    upload_path, upload_json_data = file_path, json_data
+                    if self.client_pre_cut and shutil.which("ffmpeg"):
+                        upload_path, upload_json_data = self.pre_cut(
+                            file_path, file_extension, json_data, work_dir
+                        )
+                    output_prefix = os.path.splitext(os.path.basename(file_path))[0] + "_"
+                    # 送信が終わった時点で戻るため、サーバーの処理を待たずに次のファイルを送信できる
+                    future = self.submit_request(
+                        upload_path, file_extension, upload_json_data, output_prefix
+                    )
+                    sent_bytes += os.path.getsize(upload_path)
+                    if upload_path != file_path:
+                        os.remove(upload_path)
+                    future.add_done_callback(
+                        lambda f, path=file_path: print(
+                            f"処理が完了しました: {path}"
+                            if not f.exception() and f.result().get("status_id") == "200"
+                            else f"処理に失敗しました: {path}"
+                        )
+                    )
+                    submitted.append((file_path, output_prefix, future))
+        finally:
+            self.close_keep_alive()
+        elapsed = time.perf_counter() - start
+
+        succeeded = 0
+        received_bytes = 0
+        for file_path, output_prefix, future in submitted:
+            if future.exception() or future.result().get("status_id") != "200":
+                continue
+            succeeded += 1
+            received_bytes += os.path.getsize(
+                os.path.join(
+                    self.output_dir,
+                    output_prefix + os.path.basename(future.result()["file_name"]),
+                )
+            )
+        summary = {
+            "files": len(submitted),
+            "succeeded": succeeded,
+            "failed": len(submitted) - succeeded,
+            "sent_bytes": sent_bytes,
+            "received_bytes": received_bytes,
+            "elapsed": elapsed,
+            "files_per_second": succeeded / elapsed if elapsed > 0 else 0.0,
+            "mb_per_second": (
+                (sent_bytes + received_bytes) / elapsed / 1e6 if elapsed > 0 else 0.0
+            ),
+        }
+        print(
+            f"{summary['succeeded']}/{summary['files']} 件成功, "
+            f"送信 {sent_bytes / 1e6:.1f} MB, 受信 {received_bytes / 1e6:.1f} MB, "
+            f"{elapsed:.1f} s ({summary['files_per_second']:.2f} files/s, "
+            f"{summary['mb_per_second']:.1f} MB/s)"
+        )
+        return summary
+
     def run(self):
         """メイン処理"""
         try:
@@ -198,6 +844,29 @@ class Client:
             self.socket.close()
 
 
-if __name__ == "__main__":
+def main():
+    parser = argparse.ArgumentParser(description="動画処理サーバーのクライアント")
+    parser.add_argument(
+        "--batch",
+        help="まとめて処理するディレクトリまたはglob（例: 'videos/*.mp4'）。省略時は対話モード",
+    )
+    parser.add_argument(
+        "--json",
+        help='バッチで送信する操作のJSON（例: \'{"action": "1", "quality": "23"}\'）。'
+        "省略時は操作内容を入力する",
+    )
+    args = parser.parse_args()
+
     client = Client()
-    client.run()
+    if args.batch is None:
+        client.run()
+        return
+    json_data = json.loads(args.json) if args.json else client.input_json_data()
+    try:
+        client.run_batch(args.batch, json_data)
+    except KeyboardInterrupt:
+        print("ctrl + c 操作を受け付けました")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,10 @@
 import json
+import os
+import threading
+import time
+from collections import deque
+
+from transport import AdaptiveChunkSize, BufferPool
 
 """
 カスタムプロトコル：Multiple Media Protocol（MMP）
@@ -10,6 +16,50 @@ import json
     ペイロードは常にファイルとして格納され、メディアタイプに基づいたファイルタイプを持ち、メディアタイプに従って読み込まれることに注意しましょう。
 """
 
+# MNPプロトコル定数
+# ヘッダー各部のバイトサイズ
+JSON_SIZE_BYTES = 2
+MEDIA_TYPE_SIZE_BYTES = 1
+PAYLOAD_SIZE_BYTES = 5
+# ヘッダー全体のバイトサイズ 8バイト
+MMP_HEADER_SIZE = JSON_SIZE_BYTES + MEDIA_TYPE_SIZE_BYTES + PAYLOAD_SIZE_BYTES
+
+# 各要素の最大サイズ
+# JSONサイズ(約64KB)
+MAX_JSON_SIZE = (1 << (JSON_SIZE_BYTES * 8)) - 1
+# メディアタイプサイズ（255バイト）
+MAX_MEDIA_TYPE_SIZE = (1 << (MEDIA_TYPE_SIZE_BYTES * 8)) - 1
+# ペイロードサイズ(約1TB)
+MAX_PAYLOAD_SIZE = (1 << (PAYLOAD_SIZE_BYTES * 8)) - 1
+
+# MMPParserが出力するイベントの種類
+# ("header", (json_size, media_type_size, payload_size))
+MMP_EVENT_HEADER = "header"
+# ("json", dict)
+MMP_EVENT_JSON = "json"
+# ("media_type", str)
+MMP_EVENT_MEDIA_TYPE = "media_type"
+# ("payload", memoryview) ペイロードの一部。feedに渡したデータを参照する
+MMP_EVENT_PAYLOAD = "payload"
+# ("end", None) 1メッセージの終わり
+MMP_EVENT_END = "end"
+
+# メトリクス用のフック。payload_sizeを引数に呼ばれる。
+# 未設定（None）の間はNoneとの比較だけで、追加のコストは無い
+_pack_hook = None
+_unpack_hook = None
+
+
+class MMPConnectionClosed(ConnectionError):
+    """メッセージの区切りで接続が閉じられた（正常な切断）"""
+
+
+def set_mmp_hooks(pack_hook=None, unpack_hook=None):
+    """メッセージのパック・アンパック時に呼ばれるフックを設定する（Noneで解除）"""
+    global _pack_hook, _unpack_hook
+    _pack_hook = pack_hook
+    _unpack_hook = unpack_hook
+
 
 def pack_mmp_message(json_data: dict, media_type: str, payload: bytes):
     """
@@ -27,33 +77,16 @@ def pack_mmp_message(json_data: dict, media_type: str, payload: bytes):
     Raises:
         ValueError: データサイズがプロトコルで定義された最大値を超過した場合
     """
-    # MNPプロトコル定数
-    # ヘッダー各部のバイトサイズ
-    JSON_SIZE_BYTES = 2
-    MEDIA_TYPE_SIZE_BYTES = 1
-    PAYLOAD_SIZE_BYTES = 5
-    # ヘッダー全体のバイトサイズ 8バイト
-    # MMP_HEADER_SIZE = JSON_SIZE_BYTES + MEDIA_TYPE_SIZE_BYTES + PAYLOAD_SIZE_BYTES
-
-    # 各要素の最大サイズ
-    # JSONサイズ(約64KB)
-    MAX_JSON_SIZE = (1 << (JSON_SIZE_BYTES * 8)) - 1
-    # メディアタイプサイズ（255バイト）
-    MAX_MEDIA_TYPE_SIZE = (1 << (MEDIA_TYPE_SIZE_BYTES * 8)) - 1
-    # ペイロードサイズ(約1TB)
-    MAX_PAYLOAD_SIZE = (1 << (PAYLOAD_SIZE_BYTES * 8)) - 1
+    return b"".join(iter_mmp_buffers(json_data, media_type, payload))
 
-    # jsonデータをバイト列にエンコードしてサイズを取得
-    json_bytes = json.dumps(json_data).encode("utf-8")
-    json_size = len(json_bytes)
-    # メディアタイプをバイト列にエンコードしてサイズを取得
-    media_type_bytes = media_type.encode("utf-8")
-    media_type_size = len(media_type_bytes)
-    # ペイロードデータのサイズを取得
-    payload_size = len(payload)
-    # デバッグ
-    print(f"payload_size: {payload_size}")
 
+def pack_mmp_header(json_size: int, media_type_size: int, payload_size: int) -> bytes:
+    """
+    MMPヘッダー（8バイト）をパックする関数
+
+    Raises:
+        ValueError: データサイズがプロトコルで定義された最大値を超過した場合
+    """
     # サイズ制限のチェック
     if json_size > MAX_JSON_SIZE:
         raise ValueError(
@@ -68,18 +101,124 @@ def pack_mmp_message(json_data: dict, media_type: str, payload: bytes):
             f"ペイロードサイズが最大値を超過しました: {payload_size} > {MAX_PAYLOAD_SIZE}"
         )
 
-    # ヘッダーの構築
     # 各サイズをビッグエンディアン形式のバイト列に変換して連結
-    header = bytearray()
-    header += json_size.to_bytes(JSON_SIZE_BYTES, byteorder="big")
-    header += media_type_size.to_bytes(MEDIA_TYPE_SIZE_BYTES, byteorder="big")
-    header += payload_size.to_bytes(PAYLOAD_SIZE_BYTES, byteorder="big")
+    return (
+        json_size.to_bytes(JSON_SIZE_BYTES, byteorder="big")
+        + media_type_size.to_bytes(MEDIA_TYPE_SIZE_BYTES, byteorder="big")
+        + payload_size.to_bytes(PAYLOAD_SIZE_BYTES, byteorder="big")
+    )
+
 
-    # ボディの構築
-    body = json_bytes + media_type_bytes + payload
+def parse_mmp_header(header_data: bytes) -> tuple[int, int, int]:
+    """
+    MMPヘッダー（8バイト）を解析する関数
 
-    # ヘッダーとボディを連結して返す
-    return header + body
+    Returns:
+        tuple[int, int, int]: JSONサイズ、メディアタイプサイズ、ペイロードサイズ
+    """
+    json_size = int.from_bytes(header_data[0:JSON_SIZE_BYTES], byteorder="big")
+    media_type_size = int.from_bytes(
+        header_data[JSON_SIZE_BYTES : JSON_SIZE_BYTES + MEDIA_TYPE_SIZE_BYTES],
+        byteorder="big",
+    )
+    payload_size = int.from_bytes(
+        header_data[JSON_SIZE_BYTES + MEDIA_TYPE_SIZE_BYTES : MMP_HEADER_SIZE],
+        byteorder="big",
+    )
+    return json_size, media_type_size, payload_size
+
+
+def pack_mmp_prefix(json_data: dict, media_type: str, payload_size: int) -> bytes:
+    """
+    MMPメッセージのうちペイロードより前の部分（ヘッダー + JSON + メディアタイプ）をパックする関数
+    ペイロードをメモリに載せずにファイルから直接送信する場合に使用します
+
+    Args:
+        json_data: dict: すべての引数を含むjsonデータ
+        media_type: str: メディアタイプ。UTF-8でエンコードされる
+        payload_size: int: 後に続くペイロードのバイトサイズ
+
+    Returns:
+        bytes: ヘッダー、JSONデータ、メディアタイプを連結したバイト列
+
+    Raises:
+        ValueError: データサイズがプロトコルで定義された最大値を超過した場合
+    """
+    header, body_prefix = _pack_mmp_header_and_body_prefix(
+        json_data, media_type, payload_size
+    )
+    return header + body_prefix
+
+
+def iter_mmp_buffers(json_data: dict, media_type: str, payload: bytes):
+    """
+    MMPメッセージをヘッダー、JSON + メディアタイプ、ペイロードの3つのバッファとして順に返す関数
+    ペイロードはコピーせずmemoryviewとして返すため、socket.sendmsgなどで連結せずに送信できます
+
+    Yields:
+        bytes | memoryview: ヘッダー、JSONとメディアタイプ、ペイロードの順
+    """
+    header, body_prefix = _pack_mmp_header_and_body_prefix(
+        json_data, media_type, len(payload)
+    )
+    yield header
+    yield body_prefix
+    yield memoryview(payload)
+
+
+def _pack_mmp_header_and_body_prefix(
+    json_data: dict, media_type: str, payload_size: int
+) -> tuple[bytes, bytes]:
+    """ヘッダーと、ボディのうちペイロードより前の部分をそれぞれパックする"""
+    # jsonデータをバイト列にエンコードしてサイズを取得
+    json_bytes = json.dumps(json_data).encode("utf-8")
+    # メディアタイプをバイト列にエンコードしてサイズを取得
+    media_type_bytes = media_type.encode("utf-8")
+    if _pack_hook is not None:
+        _pack_hook(payload_size)
+
+    header = pack_mmp_header(len(json_bytes), len(media_type_bytes), payload_size)
+    return header, json_bytes + media_type_bytes
+
+
+def send_mmp_message(sock, json_data: dict, media_type: str, payload: bytes = b""):
+    """
+    MMPメッセージを送信する関数
+    ヘッダー・JSON・メディアタイプとペイロードを連結せずに順に送信します
+    """
+    for buffer in iter_mmp_buffers(json_data, media_type, payload):
+        if len(buffer):
+            sock.sendall(buffer)
+
+
+def send_mmp_file(
+    sock,
+    json_data: dict,
+    media_type: str,
+    file_path: str,
+    offset: int = 0,
+    count: int | None = None,
+) -> int:
+    """
+    ファイルをペイロードとするMMPメッセージを送信する関数
+    ヘッダーとJSON・メディアタイプだけを組み立てて送信し、ペイロードはsocket.sendfileで
+    カーネルから直接送信するため、ファイルの内容をPythonのメモリに読み込みません
+
+    Args:
+        offset: int: ペイロードとして送信を始めるファイル内の位置（中断したアップロードの再開用）
+        count: int | None: 送信するバイト数（省略時はファイルの終わりまで。分割アップロード用）
+
+    Returns:
+        int: 送信したペイロードのバイト数
+    """
+    payload_size = os.path.getsize(file_path) - offset
+    if count is not None:
+        payload_size = min(payload_size, count)
+    sock.sendall(pack_mmp_prefix(json_data, media_type, payload_size))
+    if payload_size == 0:
+        return 0
+    with open(file_path, "rb") as f:
+        return sock.sendfile(f, offset, payload_size)
 
 
 def unpack_mmp_message(
@@ -98,8 +237,8 @@ def unpack_mmp_message(
     payload_data = body_data[
         json_size + media_type_size : json_size + media_type_size + payload_size
     ]
-    # デバッグ
-    print(f"payload_data: {len(payload_data)}")
+    if _unpack_hook is not None:
+        _unpack_hook(len(payload_data))
 
     # バイト列を元の形式にデコード
     try:
@@ -113,3 +252,299 @@ def unpack_mmp_message(
     media_type = media_type_bytes.decode("utf-8")
 
     return json_data, media_type, payload_data
+
+
+def unpack_mmp_prefix(prefix_data: bytes, json_size: int, media_type_size: int):
+    """
+    ボディ先頭のJSONデータとメディアタイプだけを解析する関数
+    ペイロードをメモリに載せずに受信するため、ペイロードより前の部分だけを扱います
+
+    Args:
+        prefix_data: bytes: JSONデータとメディアタイプを連結したバイト列
+        json_size: int: JSONデータのバイトサイズ
+        media_type_size: int: メディアタイプのバイトサイズ
+
+    Returns:
+        tuple[dict, str]: JSONデータとメディアタイプ
+    """
+    try:
+        json_data = json.loads(prefix_data[0:json_size].decode("utf-8"))
+    except json.JSONDecodeError as e:
+        raise json.JSONDecodeError(
+            f"unpack_mmp_prefix関数でJSONデータのデコードに失敗しました: {e}",
+            e.doc,
+            e.pos,
+        )
+    media_type = prefix_data[json_size : json_size + media_type_size].decode("utf-8")
+
+    return json_data, media_type
+
+
+class MMPParser:
+    """MMPメッセージのインクリメンタルパーサー（sans-IO）
+
+    任意の長さに分割されたバイト列（bytes / bytearray / memoryview）を feed() に渡すと、
+    解析できた分だけイベントのリストを返す。ソケットなどの入出力は一切行わない。
+
+    ヘッダーとJSON・メディアタイプは小さいので内部バッファに溜めてから解析するが、
+    ペイロードはコピーせず、渡されたデータのmemoryviewをそのままイベントとして返す。
+    そのためペイロードイベントは、元のバッファを再利用する前に消費する必要がある。
+    1つのメッセージの終わりで状態は初期化され、続けて次のメッセージを解析できる。
+    """
+
+    _STATE_HEADER = 0
+    _STATE_PREFIX = 1
+    _STATE_PAYLOAD = 2
+
+    def __init__(self):
+        self._state = self._STATE_HEADER
+        self._buffer = bytearray()
+        self._needed = MMP_HEADER_SIZE
+        self.json_size = 0
+        self.media_type_size = 0
+        self.payload_size = 0
+        self._payload_remaining = 0
+
+    def at_message_boundary(self) -> bool:
+        """メッセージの区切り（次のヘッダーを1バイトも受け取っていない状態）かどうか"""
+        return self._state == self._STATE_HEADER and not self._buffer
+
+    def next_read_size(self, max_size: int) -> int:
+        """次に受信すべきバイト数を返す
+
+        この値を上限に受信すれば、次のメッセージのバイトを先読みしないため、
+        ヘッダーを受け取った時点でボディを読む前に判断を挟むことができる
+        """
+        if self._state == self._STATE_PAYLOAD:
+            return min(self._payload_remaining, max_size)
+        return self._needed - len(self._buffer)
+
+    def feed(self, data) -> list[tuple[str, object]]:
+        """受信したバイト列を渡して、解析できたイベントのリストを返す
+
+        空のバイト列を渡すと、サイズ0の要素による状態遷移だけを進める
+
+        Raises:
+            json.JSONDecodeError: JSONデータのデコードに失敗した場合
+        """
+        view = memoryview(data)
+        data_size = len(view)
+        position = 0
+        events = []
+
+        while True:
+            if self._state == self._STATE_PAYLOAD:
+                if self._payload_remaining == 0:
+                    events.append((MMP_EVENT_END, None))
+                    self._reset()
+                    if position >= data_size:
+                        break
+                    continue
+                if position >= data_size:
+                    break
+                take = min(self._payload_remaining, data_size - position)
+                events.append((MMP_EVENT_PAYLOAD, view[position : position + take]))
+                position += take
+                self._payload_remaining -= take
+                continue
+
+            # ヘッダーとJSON・メディアタイプは必要なサイズが揃うまで内部バッファに溜める
+            take = min(self._needed - len(self._buffer), data_size - position)
+            if take:
+                self._buffer += view[position : position + take]
+                position += take
+            if len(self._buffer) < self._needed:
+                break
+
+            if self._state == self._STATE_HEADER:
+                self.json_size, self.media_type_size, self.payload_size = (
+                    parse_mmp_header(self._buffer)
+                )
+                if _unpack_hook is not None:
+                    _unpack_hook(self.payload_size)
+                events.append(
+                    (
+                        MMP_EVENT_HEADER,
+                        (self.json_size, self.media_type_size, self.payload_size),
+                    )
+                )
+                self._state = self._STATE_PREFIX
+                self._needed = self.json_size + self.media_type_size
+                self._buffer = bytearray()
+            else:
+                if self.json_size:
+                    json_data, media_type = unpack_mmp_prefix(
+                        self._buffer, self.json_size, self.media_type_size
+                    )
+                else:
+                    json_data = {}
+                    media_type = self._buffer.decode("utf-8")
+                events.append((MMP_EVENT_JSON, json_data))
+                events.append((MMP_EVENT_MEDIA_TYPE, media_type))
+                self._state = self._STATE_PAYLOAD
+                self._payload_remaining = self.payload_size
+                self._buffer = bytearray()
+
+        return events
+
+    def _reset(self):
+        """次のメッセージを解析できるよう状態を初期化する"""
+        self._state = self._STATE_HEADER
+        self._needed = MMP_HEADER_SIZE
+        self._buffer = bytearray()
+        self._payload_remaining = 0
+
+
+class MMPSocketReader:
+    """MMPParserを使ってソケットからMMPメッセージを受信するクラス
+
+    MMPParser.next_read_size() を上限に受信するため、ヘッダーやJSONより先の
+    バイトを読み過ぎることはなく、同じ接続で続くメッセージにも影響しない。
+    受信は使い回すバッファへのrecv_intoで行うため、iter_payload() が返す断片は
+    次の断片を受け取る前に消費する必要がある。
+    """
+
+    def __init__(self, sock, chunk_size: int, buffer_pool: BufferPool | None = None):
+        """
+        Args:
+            sock: 受信するソケット
+            chunk_size: 1回に受信するサイズ
+            buffer_pool: 受信バッファのプール。指定した場合はプールからバッファを取り出し、
+                受信サイズをchunk_sizeからバッファのサイズまで受信状況に合わせて増減する
+        """
+        self.sock = sock
+        self.chunk_size = chunk_size
+        self.parser = MMPParser()
+        self._events: deque = deque()
+        self._buffer_pool = buffer_pool
+        if buffer_pool is not None:
+            self._buffer = buffer_pool.acquire()
+        else:
+            self._buffer = bytearray(chunk_size)
+        self._view = memoryview(self._buffer)
+        self._read_size = AdaptiveChunkSize(
+            min(chunk_size, len(self._buffer)), len(self._buffer)
+        )
+        # recv_intoを呼び出した回数（ベンチマークでシステムコールの回数を比べるために使う）
+        self.recv_calls = 0
+        # read_payload_into でファイルへの書き込みにかかった合計秒数
+        self.write_seconds = 0.0
+
+    def close(self):
+        """受信バッファをプールに戻す（ソケットは閉じない）"""
+        if self._buffer_pool is not None and self._buffer is not None:
+            self._buffer_pool.release(self._buffer)
+        self._buffer = None
+        self._view = None
+
+    def next_event(self) -> tuple[str, object]:
+        """次のイベントを1つ返す。必要な分だけソケットから受信する
+
+        Raises:
+            MMPConnectionClosed: メッセージの区切りで接続が閉じられた場合
+            ConnectionError: メッセージの途中で接続が閉じられた場合
+        """
+        while not self._events:
+            # ヘッダーとJSON・メディアタイプは必要なバイト数がバッファより大きい場合があるが、
+            # パーサーが複数回の受信に分けて溜めるので、バッファのサイズまでに抑える
+            read_size = min(
+                self.parser.next_read_size(self._read_size.size), len(self._view)
+            )
+            received = self.sock.recv_into(self._view, read_size) if read_size else 0
+            if read_size:
+                self.recv_calls += 1
+                if not received:
+                    if self.parser.at_message_boundary():
+                        raise MMPConnectionClosed("接続が閉じられました")
+                    raise ConnectionError("受信途中で接続が閉じられました")
+                self._read_size.update(read_size, received)
+            self._events.extend(self.parser.feed(self._view[:received]))
+        return self._events.popleft()
+
+    def read_prefix(self) -> tuple[dict, str, int]:
+        """ヘッダーとJSONデータ、メディアタイプまでを受信する
+
+        Returns:
+            tuple[dict, str, int]: JSONデータ、メディアタイプ、ペイロードサイズ
+        """
+        json_data = None
+        media_type = None
+        while media_type is None:
+            kind, value = self.next_event()
+            if kind == MMP_EVENT_JSON:
+                json_data = value
+            elif kind == MMP_EVENT_MEDIA_TYPE:
+                media_type = value
+        return json_data, media_type, self.parser.payload_size
+
+    def read_payload_to_file(self, file_path: str, on_chunk=None) -> int:
+        """ペイロードを受信しながらファイルへ書き込む
+
+        受信したデータを溜め込まずに逐次書き込むため、
+        ペイロードサイズに関わらずメモリ使用量は受信バッファ分で一定になる
+
+        Args:
+            file_path: str: 書き込み先のファイルパス
+            on_chunk: 受信した断片ごとに呼び出す関数（ハッシュ計算など）。不要な場合はNone
+
+        Returns:
+            int: 書き込んだバイト数
+        """
+        # 出力先ディレクトリが存在しない場合は作成
+        output_dir = os.path.dirname(file_path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        with open(file_path, "wb") as f:
+            return self.read_payload_into(f, on_chunk)
+
+    def read_payload_into(self, f, on_chunk=None) -> int:
+        """ペイロードを受信しながら開いているファイルの現在位置から書き込む
+
+        Returns:
+            int: 書き込んだバイト数
+        """
+        received_size = 0
+        for chunk in self.iter_payload():
+            write_start = time.perf_counter()
+            f.write(chunk)
+            self.write_seconds += time.perf_counter() - write_start
+            if on_chunk is not None:
+                on_chunk(chunk)
+            received_size += len(chunk)
+        return received_size
+
+    def read_payload(self) -> bytes:
+        """ペイロードを受信してバイト列として返す（エラー応答など小さいペイロード用）"""
+        return b"".join(bytes(chunk) for chunk in self.iter_payload())
+
+    def iter_payload(self):
+        """メッセージの終わりまでペイロードの断片（受信バッファのmemoryview）を順に返す"""
+        while True:
+            kind, value = self.next_event()
+            if kind == MMP_EVENT_END:
+                return
+            if kind == MMP_EVENT_PAYLOAD:
+                yield value
+
+
+class MMPSocketWriter:
+    """複数のスレッドから同じソケットへMMPメッセージを送信するクラス
+
+    1メッセージ（ヘッダーからペイロードの最後まで）を送り終えるまでロックするため、
+    keep-aliveの接続で複数の応答を同時に送っても、メッセージが混ざることはない
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = threading.Lock()
+
+    def send_message(self, json_data: dict, media_type: str, payload: bytes = b""):
+        with self._lock:
+            send_mmp_message(self.sock, json_data, media_type, payload)
+
+    def send_file(
+        self, json_data: dict, media_type: str, file_path: str, offset: int = 0
+    ) -> int:
+        with self._lock:
+            return send_mmp_file(self.sock, json_data, media_type, file_path, offset)
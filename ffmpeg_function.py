@@ -1,28 +1,179 @@
 import os
+import shutil
 import subprocess
 
+from ffmpeg_runner import run_ffmpeg
+from media_probe import display_aspect_ratio, find_preceding_keyframe, parse_timestamp
+from segment_encoder import encode_video_in_segments
 
-def decode_and_save_video(video_data: bytes, output_path: str) -> bool:
-    """バイナリデータをffmpegでデコードして動画ファイルとして保存する"""
+# 解像度の選択肢（resolution -> (幅, 高さ)）
+RESOLUTION_SIZES = {
+    "1": (1920, 1080),
+    "2": (1280, 720),
+    "3": (640, 480),
+    "4": (320, 240),
+}
+
+# アスペクト比の選択肢（aspect_ratio -> (幅の比, 高さの比)）
+ASPECT_RATIOS = {
+    "1": (16, 9),
+    "2": (4, 3),
+    "3": (1, 1),
+}
+
+
+def build_resize_filter(resolution: str) -> str | None:
+    """解像度変更用のビデオフィルタを作成する。不正なresolutionの場合はNone"""
+    if resolution not in RESOLUTION_SIZES:
+        return None
+    width, height = RESOLUTION_SIZES[resolution]
+    return f"scale={width}:{height}"
+
+
+def build_aspect_ratio_filter(aspect_ratio: str, fit_mode: str) -> str | None:
+    """アスペクト比変更用のビデオフィルタを作成する。不正な指定の場合はNone
+
+    Args:
+        aspect_ratio: 目標アスペクト比 ("1": 16:9, "2": 4:3, "3": 1:1)
+        fit_mode: フィット方法 ("1": letterbox, "2": crop, "3": stretch)
+    """
+    if aspect_ratio not in ASPECT_RATIOS:
+        return None
+    width_ratio, height_ratio = ASPECT_RATIOS[aspect_ratio]
+    # アスペクト比を計算
+    target_aspect = float(width_ratio) / float(height_ratio)
+
+    if fit_mode == "1":
+        # letterbox: 元の映像を維持し、余白を黒で埋める
+        return f"scale=iw*min(1\\,if(sar\\,1/sar\\,1)*{target_aspect}/dar):ih*min(1\\,dar/({target_aspect}*if(sar\\,sar\\,1))),pad=iw*{target_aspect}/dar:ih:x=(ow-iw)/2:y=(oh-ih)/2:color=black"
+    elif fit_mode == "2":
+        # crop: 元の映像をクロップして目標アスペクト比に合わせる
+        return f"scale=iw*max(1\\,if(sar\\,1/sar\\,1)*{target_aspect}/dar):ih*max(1\\,dar/({target_aspect}*if(sar\\,sar\\,1))),crop=iw*{target_aspect}/dar:ih"
+    elif fit_mode == "3":
+        # stretch: 元の映像を引き延ばして目標アスペクト比に合わせる
+        return f"scale=iw:ih,setsar={aspect_ratio}"
+    return None
+
+
+def build_trim_input_args(
+    input_path: str, start_time: str, duration: str, media_info: dict | None = None
+) -> list[str]:
+    """切り取り用の入力・シーク引数（-iを含む）を作成する
+
+    -ssを-iの後に置くと先頭から開始時刻までをすべてデコードして捨てるため、
+    開始時刻の直前のキーフレームへ入力側でシークし、残りの差分だけを出力側の-ssで
+    正確に読み飛ばす。デコード量は動画内の位置ではなく切り取る長さに比例する。
+    キーフレームはfind_preceding_keyframe()で開始時刻の手前の範囲だけを調べる。
+    media_infoにファイルの開始時刻がある場合は、取得し直さずにキーフレームの時刻の変換に使う。
+    キーフレームを取得できない場合は入力側の-ssだけでシークする
+
+    Returns:
+        list[str]: ["-ss", キーフレーム時刻, "-i", 入力, "-ss", 差分, "-t", 長さ]
+    """
+    start_seconds = parse_timestamp(start_time)
+    if start_seconds is None:
+        # 解釈できない時刻はffmpegにそのまま渡し、従来どおり出力側でシークする
+        return ["-i", input_path, "-ss", start_time, "-t", duration]
+    if start_seconds == 0:
+        return ["-i", input_path, "-t", duration]
+
+    keyframe_time = find_preceding_keyframe(
+        input_path, start_seconds, (media_info or {}).get("start_time")
+    )
+    if keyframe_time is None:
+        return ["-ss", f"{start_seconds:.3f}", "-i", input_path, "-t", duration]
+    return [
+        "-ss",
+        f"{keyframe_time:.6f}",
+        "-i",
+        input_path,
+        "-ss",
+        f"{start_seconds - keyframe_time:.6f}",
+        "-t",
+        duration,
+    ]
+
+
+def is_h264_video(media_info: dict | None) -> bool:
+    """映像がH.264かどうか（libx264で再エンコードした出力と同じコーデックか）"""
+    video = (media_info or {}).get("video")
+    return bool(video) and video.get("codec_name") == "h264"
+
+
+def copy_as_mp4(input_path: str, output_path: str, media_info: dict) -> bool:
+    """再エンコードせずに入力を出力にする
+
+    入力がmp4の場合はハードリンク（できない場合はコピー）し、
+    それ以外のコンテナはストリームコピーでmp4に多重化する
+    """
+    try:
+        if "mp4" in media_info.get("format_name", "").split(","):
+            try:
+                os.link(input_path, output_path)
+            except OSError:
+                shutil.copyfile(input_path, output_path)
+            return True
+
+        result = run_ffmpeg(
+            ["ffmpeg", "-i", input_path, "-c", "copy", "-f", "mp4", "-y", output_path],
+        )
+        if result.returncode == 0:
+            return True
+        else:
+            print(f"copy_as_mp4関数でffmpegエラーが発生しました: {result.stderr}")
+            return False
+
+    except Exception as e:
+        print(f"copy_as_mp4関数でエラーが発生しました: {e}")
+        return False
+
+
+def needs_container_fix(input_path: str) -> bool:
+    """ffprobeでコンテナを確認し、そのままでは読み込めない場合にTrueを返す
+
+    ヘッダー部分だけを読むため、ファイル全体を読み書きする再多重化より大幅に軽い
+    """
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=format_name",
+                "-of",
+                "default=noprint_wrappers=1:nokey=1",
+                input_path,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        return result.returncode != 0 or bool(result.stderr.strip())
+
+    except Exception as e:
+        print(f"needs_container_fix関数でエラーが発生しました: {e}")
+        return True
+
+
+def decode_and_save_video(input_path: str, output_path: str) -> bool:
+    """コンテナに問題がある受信ファイルをffmpegでmp4に再多重化して保存する"""
     try:
         # outputディレクトリが存在しない場合は作成
         output_dir = os.path.dirname(output_path)
         if output_dir and not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-        result = subprocess.run(
+        result = run_ffmpeg(
             [
                 "ffmpeg",
                 "-i",
-                "pipe:0",
+                input_path,
                 "-c",
                 "copy",
                 "-f",
                 "mp4",
                 output_path,
             ],
-            input=video_data,
-            capture_output=True,
         )
 
         if result.returncode == 0:
@@ -30,7 +181,7 @@ def decode_and_save_video(video_data: bytes, output_path: str) -> bool:
             return True
         else:
             print(
-                f"decode_and_save_video関数でffmpegエラーが発生しました: {result.stderr.decode('utf-8', errors='ignore')}"
+                f"decode_and_save_video関数でffmpegエラーが発生しました: {result.stderr}"
             )
             return False
 
@@ -39,10 +190,45 @@ def decode_and_save_video(video_data: bytes, output_path: str) -> bool:
         return False
 
 
-def compress_video_file(input_path: str, crf_number: str, output_path: str) -> bool:
-    """ファイルパスを指定して動画を圧縮する"""
+def compress_video_file(
+    input_path: str,
+    crf_number: str,
+    output_path: str,
+    segment_count: int = 1,
+    min_segment_seconds: float = 30,
+    media_info: dict | None = None,
+) -> bool:
+    """ファイルパスを指定して動画を圧縮する
+
+    segment_countが2以上で動画が十分長い場合は、キーフレームで分割して並列にエンコードする。
+    動画の長さはmedia_info（probe結果）があればそれを使う
+    """
     try:
-        result = subprocess.run(
+        if segment_count > 1:
+            segmented = encode_video_in_segments(
+                input_path,
+                output_path,
+                [
+                    "-vcodec",
+                    "libx264",
+                    "-crf",
+                    crf_number,
+                    "-preset",
+                    "medium",
+                    "-tune",
+                    "film",
+                ],
+                False,  # 音声を削除
+                segment_count,
+                min_segment_seconds,
+                (media_info or {}).get("duration"),
+            )
+            if segmented is not None:
+                if segmented:
+                    print(f"圧縮成功（セグメント並列）: {output_path}")
+                return segmented
+
+        result = run_ffmpeg(
             [
                 "ffmpeg",
                 "-i",
@@ -60,8 +246,6 @@ def compress_video_file(input_path: str, crf_number: str, output_path: str) -> b
                 "mp4",
                 output_path,
             ],
-            capture_output=True,
-            text=True,
         )
 
         if result.returncode == 0:
@@ -79,7 +263,7 @@ def compress_video_file(input_path: str, crf_number: str, output_path: str) -> b
 def convert_to_mp3file(input_path: str, output_path: str, target_format: str) -> bool:
     """動画フォーマットを変換する"""
     try:
-        result = subprocess.run(
+        result = run_ffmpeg(
             [
                 "ffmpeg",
                 "-i",
@@ -90,8 +274,6 @@ def convert_to_mp3file(input_path: str, output_path: str, target_format: str) ->
                 target_format,
                 output_path,
             ],
-            capture_output=True,
-            text=True,
         )
 
         if result.returncode == 0:
@@ -112,6 +294,7 @@ def trim_video_to_gif_webm(
     duration: str,
     output_path: str,
     output_format: str,
+    media_info: dict | None = None,
 ) -> bool:
     """時間範囲を指定して動画を切り取り、GIFまたはWEBMフォーマットに変換する
 
@@ -121,6 +304,7 @@ def trim_video_to_gif_webm(
         duration: 切り取り時間の長さ (例: "00:00:05" または "5")
         output_path: 出力ファイルのパス
         output_format: 出力フォーマット ("gif" または "webm")
+        media_info: probe結果。開始時刻をシーク位置の決定に使う
 
     Returns:
         bool: 成功時True、失敗時False
@@ -131,17 +315,17 @@ def trim_video_to_gif_webm(
         if output_dir and not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
+        if output_format.lower() not in ("gif", "webm"):
+            print(f"サポートされていないフォーマット: {output_format}")
+            return False
+        seek_args = build_trim_input_args(input_path, start_time, duration, media_info)
+
         if output_format.lower() == "gif":
             # GIF変換用のffmpegコマンド
-            result = subprocess.run(
+            result = run_ffmpeg(
                 [
                     "ffmpeg",
-                    "-i",
-                    input_path,
-                    "-ss",
-                    start_time,
-                    "-t",
-                    duration,
+                    *seek_args,
                     "-vf",
                     "fps=10,scale=320:-1:flags=lanczos",
                     "-c:v",
@@ -149,20 +333,13 @@ def trim_video_to_gif_webm(
                     "-y",  # 既存ファイルを上書き
                     output_path,
                 ],
-                capture_output=True,
-                text=True,
             )
-        elif output_format.lower() == "webm":
+        else:
             # WEBM変換用のffmpegコマンド
-            result = subprocess.run(
+            result = run_ffmpeg(
                 [
                     "ffmpeg",
-                    "-i",
-                    input_path,
-                    "-ss",
-                    start_time,
-                    "-t",
-                    duration,
+                    *seek_args,
                     "-c:v",
                     "libvpx-vp9",
                     "-crf",
@@ -173,12 +350,7 @@ def trim_video_to_gif_webm(
                     "-y",  # 既存ファイルを上書き
                     output_path,
                 ],
-                capture_output=True,
-                text=True,
             )
-        else:
-            print(f"サポートされていないフォーマット: {output_format}")
-            return False
 
         if result.returncode == 0:
             print(f"動画切り取り・変換成功: {output_path}")
@@ -194,34 +366,78 @@ def trim_video_to_gif_webm(
         return False
 
 
-def resize_video_resolution(input_path: str, resolution: str, output_path: str) -> bool:
-    """動画の解像度を変更する"""
+def resize_video_resolution(
+    input_path: str,
+    resolution: str,
+    output_path: str,
+    segment_count: int = 1,
+    min_segment_seconds: float = 30,
+    media_info: dict | None = None,
+) -> bool:
+    """動画の解像度を変更する
+
+    segment_countが2以上で動画が十分長い場合は、キーフレームで分割して並列にエンコードする。
+    media_info（probe結果）から元の動画が既に指定の解像度のH.264だと分かる場合は再エンコードしない。
+    分割する際の動画の長さもmedia_infoから取得する
+    """
     try:
         # outputディレクトリが存在しない場合は作成
         output_dir = os.path.dirname(output_path)
         if output_dir and not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-        if resolution == "1":
-            width = 1920
-            height = 1080
-        elif resolution == "2":
-            width = 1280
-            height = 720
-        elif resolution == "3":
-            width = 640
-            height = 480
-        elif resolution == "4":
-            width = 320
-            height = 240
-
-        result = subprocess.run(
+        scale_filter = build_resize_filter(resolution)
+        if scale_filter is None:
+            print(f"不正なresolution: {resolution}")
+            return False
+        width, height = RESOLUTION_SIZES[resolution]
+
+        video = (media_info or {}).get("video") or {}
+        if (
+            is_h264_video(media_info)
+            and video.get("width") == width
+            and video.get("height") == height
+        ):
+            succeeded = copy_as_mp4(input_path, output_path, media_info)
+            if succeeded:
+                print(
+                    f"解像度変更不要（再エンコードなし）: {output_path} ({width}x{height})"
+                )
+            return succeeded
+
+        if segment_count > 1:
+            segmented = encode_video_in_segments(
+                input_path,
+                output_path,
+                [
+                    "-vf",
+                    scale_filter,
+                    "-c:v",
+                    "libx264",
+                    "-preset",
+                    "medium",
+                    "-crf",
+                    "23",
+                ],
+                True,
+                segment_count,
+                min_segment_seconds,
+                (media_info or {}).get("duration"),
+            )
+            if segmented is not None:
+                if segmented:
+                    print(
+                        f"解像度変更成功（セグメント並列）: {output_path} ({width}x{height})"
+                    )
+                return segmented
+
+        result = run_ffmpeg(
             [
                 "ffmpeg",
                 "-i",
                 input_path,
                 "-vf",
-                f"scale={width}:{height}",
+                scale_filter,
                 "-c:v",
                 "libx264",
                 "-preset",
@@ -234,8 +450,6 @@ def resize_video_resolution(input_path: str, resolution: str, output_path: str)
                 "mp4",
                 output_path,
             ],
-            capture_output=True,
-            text=True,
         )
 
         if result.returncode == 0:
@@ -253,7 +467,13 @@ def resize_video_resolution(input_path: str, resolution: str, output_path: str)
 
 
 def change_video_aspect_ratio(
-    input_path: str, aspect_ratio: str, output_path: str, fit_mode: str
+    input_path: str,
+    aspect_ratio: str,
+    output_path: str,
+    fit_mode: str,
+    segment_count: int = 1,
+    min_segment_seconds: float = 30,
+    media_info: dict | None = None,
 ) -> bool:
     """動画のアスペクト比を変更する
 
@@ -265,43 +485,67 @@ def change_video_aspect_ratio(
             - "letterbox": 元の映像を維持し、余白を黒で埋める
             - "crop": 元の映像をクロップして目標アスペクト比に合わせる
             - "stretch": 元の映像を引き延ばして目標アスペクト比に合わせる
+        segment_count: 2以上で動画が十分長い場合は、キーフレームで分割して並列にエンコードする
+        min_segment_seconds: 並列エンコード時の1セグメントの最短の長さ（秒）
+        media_info: probe結果。letterbox/cropで元の動画が既に目標アスペクト比のH.264の場合は
+            フィルタが何もしないため、再エンコードせずに出力する。分割する際の動画の長さにも使う
     """
 
-    if aspect_ratio == "1":
-        width_ratio = 16
-        height_ratio = 9
-    elif aspect_ratio == "2":
-        width_ratio = 4
-        height_ratio = 3
-    elif aspect_ratio == "3":
-        width_ratio = 1
-        height_ratio = 1
-
     try:
         # outputディレクトリが存在しない場合は作成
         output_dir = os.path.dirname(output_path)
         if output_dir and not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-        # アスペクト比を計算
-        target_aspect = float(width_ratio) / float(height_ratio)
-
-        if fit_mode == "1":
-            # letterbox: 元の映像を維持し、余白を黒で埋める
-            scale_filter = f"scale=iw*min(1\\,if(sar\\,1/sar\\,1)*{target_aspect}/dar):ih*min(1\\,dar/({target_aspect}*if(sar\\,sar\\,1))),pad=iw*{target_aspect}/dar:ih:x=(ow-iw)/2:y=(oh-ih)/2:color=black"
-        elif fit_mode == "2":
-            # crop: 元の映像をクロップして目標アスペクト比に合わせる
-            scale_filter = f"scale=iw*max(1\\,if(sar\\,1/sar\\,1)*{target_aspect}/dar):ih*max(1\\,dar/({target_aspect}*if(sar\\,sar\\,1))),crop=iw*{target_aspect}/dar:ih"
-        elif fit_mode == "3":
-            # stretch: 元の映像を引き延ばして目標アスペクト比に合わせる
-            scale_filter = f"scale=iw:ih,setsar={aspect_ratio}"
-        else:
+        scale_filter = build_aspect_ratio_filter(aspect_ratio, fit_mode)
+        if scale_filter is None:
             print(
                 f"不正なfit_mode: {fit_mode}. 'letterbox', 'crop', 'stretch'のいずれかを指定してください"
             )
             return False
 
-        result = subprocess.run(
+        source_aspect = display_aspect_ratio(media_info)
+        width_ratio, height_ratio = ASPECT_RATIOS[aspect_ratio]
+        if (
+            fit_mode in ("1", "2")
+            and is_h264_video(media_info)
+            and source_aspect is not None
+            and abs(source_aspect / (width_ratio / height_ratio) - 1) < 0.005
+        ):
+            succeeded = copy_as_mp4(input_path, output_path, media_info)
+            if succeeded:
+                print(
+                    f"アスペクト比変更不要（再エンコードなし）: {output_path} (アスペクト比: {aspect_ratio})"
+                )
+            return succeeded
+
+        if segment_count > 1:
+            segmented = encode_video_in_segments(
+                input_path,
+                output_path,
+                [
+                    "-vf",
+                    scale_filter,
+                    "-c:v",
+                    "libx264",
+                    "-preset",
+                    "medium",
+                    "-crf",
+                    "23",
+                ],
+                True,
+                segment_count,
+                min_segment_seconds,
+                (media_info or {}).get("duration"),
+            )
+            if segmented is not None:
+                if segmented:
+                    print(
+                        f"アスペクト比変更成功（セグメント並列）: {output_path} (アスペクト比: {aspect_ratio}, モード: {fit_mode})"
+                    )
+                return segmented
+
+        result = run_ffmpeg(
             [
                 "ffmpeg",
                 "-i",
@@ -320,8 +564,6 @@ def change_video_aspect_ratio(
                 "mp4",
                 output_path,
             ],
-            capture_output=True,
-            text=True,
         )
 
         if result.returncode == 0:
@@ -338,3 +580,321 @@ def change_video_aspect_ratio(
     except Exception as e:
         print(f"change_video_aspect_ratio関数でエラーが発生しました: {e}")
         return False
+
+
+def build_pipeline_command(
+    input_path: str,
+    operations: list[dict],
+    output_path: str,
+    media_info: dict | None = None,
+) -> list[str] | None:
+    """複数の操作を1回のffmpeg実行にまとめたコマンドを作成する
+
+    解像度変更(2)とアスペクト比変更(3)のフィルタは指定順に1つのフィルタグラフへ連結し、
+    圧縮(1)の品質設定はエンコーダー設定にまとめるため、デコードとエンコードは1回で済む。
+    切り取り(5)は最後の操作としてのみ指定でき、それまでのフィルタを適用してからGIF/WEBMに変換する。
+    音声抽出(4)はストリームコピーのため組み合わせられない
+
+    Args:
+        input_path: 入力動画ファイルのパス
+        operations: 操作のリスト。各要素は単一操作のjson_dataと同じ形式
+            例: [{"action": "2", "resolution": "2"}, {"action": "1", "quality": "28"}]
+        output_path: 出力ファイルのパス
+        media_info: probe結果。切り取りのシーク位置の決定に使う
+
+    Returns:
+        list[str] | None: ffmpegコマンド。組み合わせられない操作が含まれる場合はNone
+    """
+    video_filters = []
+    crf_number = "23"
+    compress = False
+    trim_operation = None
+
+    for index, operation in enumerate(operations):
+        action = operation.get("action")
+        if action == "1":
+            crf_number = operation.get("quality")
+            compress = True
+        elif action == "2":
+            scale_filter = build_resize_filter(operation.get("resolution"))
+            if scale_filter is None:
+                print(f"不正なresolution: {operation.get('resolution')}")
+                return None
+            video_filters.append(scale_filter)
+        elif action == "3":
+            scale_filter = build_aspect_ratio_filter(
+                operation.get("aspect_ratio"), operation.get("fit_mode")
+            )
+            if scale_filter is None:
+                print(
+                    f"不正なアスペクト比の指定: {operation.get('aspect_ratio')}, {operation.get('fit_mode')}"
+                )
+                return None
+            video_filters.append(scale_filter)
+        elif action == "5" and index == len(operations) - 1:
+            trim_operation = operation
+        else:
+            print(f"パイプラインで指定できない操作です: {action} ({index + 1}番目)")
+            return None
+
+    if trim_operation is None:
+        command = ["ffmpeg", "-i", input_path]
+        if video_filters:
+            command += ["-vf", ",".join(video_filters)]
+        command += ["-c:v", "libx264", "-preset", "medium", "-crf", crf_number]
+        if compress:
+            # 圧縮を含む場合は単体の圧縮と同じく音声を削除する
+            command += ["-tune", "film", "-an"]
+        else:
+            command += ["-c:a", "copy"]
+        command += ["-f", "mp4", output_path]
+        return command
+
+    if compress:
+        print("圧縮(1)と切り取り(5)は同時に指定できません")
+        return None
+    output_format = str(trim_operation.get("trim")).lower()
+    if output_format not in ("gif", "webm"):
+        print(f"サポートされていないフォーマット: {output_format}")
+        return None
+    command = [
+        "ffmpeg",
+        *build_trim_input_args(
+            input_path,
+            trim_operation.get("start_time"),
+            trim_operation.get("duration"),
+            media_info,
+        ),
+    ]
+    if output_format == "gif":
+        video_filters.append("fps=10,scale=320:-1:flags=lanczos")
+        command += ["-vf", ",".join(video_filters), "-c:v", "gif"]
+    elif output_format == "webm":
+        if video_filters:
+            command += ["-vf", ",".join(video_filters)]
+        command += ["-c:v", "libvpx-vp9", "-crf", "30", "-b:v", "0", "-an"]
+    command += ["-y", output_path]
+    return command
+
+
+def pipeline_output_file_name(operations: list[dict]) -> str:
+    """パイプラインの出力ファイル名を返す。最後が切り取りの場合はGIF/WEBMになる"""
+    last_operation = operations[-1] if operations else {}
+    if last_operation.get("action") == "5":
+        return (
+            "output_trimmed.gif"
+            if str(last_operation.get("trim")).lower() == "gif"
+            else "output_trimmed.webm"
+        )
+    return "output_pipeline.mp4"
+
+
+def run_operation_pipeline(
+    input_path: str,
+    operations: list[dict],
+    output_path: str,
+    media_info: dict | None = None,
+) -> bool:
+    """複数の操作を1回のffmpeg実行でまとめて処理する"""
+    try:
+        # outputディレクトリが存在しない場合は作成
+        output_dir = os.path.dirname(output_path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        command = build_pipeline_command(input_path, operations, output_path, media_info)
+        if command is None:
+            return False
+
+        result = run_ffmpeg(command)
+
+        if result.returncode == 0:
+            actions = ",".join(str(operation.get("action")) for operation in operations)
+            print(f"パイプライン処理成功: {output_path} (操作: {actions})")
+            return True
+        else:
+            print(
+                f"run_operation_pipeline関数でffmpegエラーが発生しました: {result.stderr}"
+            )
+            return False
+
+    except Exception as e:
+        print(f"run_operation_pipeline関数でエラーが発生しました: {e}")
+        return False
+
+
+# ストリーミング応答での単一操作の出力ファイル名（action -> ファイル名）
+STREAM_OUTPUT_FILE_NAMES = {
+    "1": "output_compressed.mp4",
+    "2": "output_resized.mp4",
+    "3": "output_aspect_ratio.mp4",
+    "4": "output.mp3",
+}
+
+
+def stream_output_file_name(json_data: dict) -> str | None:
+    """ストリーミング応答で送る処理結果のファイル名を返す。不正なactionの場合はNone"""
+    operations = json_data.get("operations") or [json_data]
+    if len(operations) > 1 or operations[0].get("action") == "5":
+        return pipeline_output_file_name(operations)
+    return STREAM_OUTPUT_FILE_NAMES.get(operations[0].get("action"))
+
+
+def build_stream_command(
+    input_path: str,
+    json_data: dict,
+    output_path: str,
+    media_info: dict | None = None,
+) -> list[str] | None:
+    """処理結果をシークできない出力（名前付きパイプ）へ先頭から順に書き出すffmpegコマンドを作成する
+
+    単一の操作も1つの操作のパイプラインとして組み立てる。mp4は断片化MP4
+    (frag_keyframe+empty_moov) にし、GIF・WEBMは出力ファイル名の拡張子でフォーマットを明示する。
+    音声抽出(4)はmp3にエンコードする
+
+    Returns:
+        list[str] | None: ffmpegコマンド。組み合わせられない操作が含まれる場合はNone
+    """
+    operations = json_data.get("operations") or [json_data]
+    if len(operations) == 1 and operations[0].get("action") == "4":
+        return [
+            "ffmpeg",
+            "-i",
+            input_path,
+            "-vn",
+            "-c:a",
+            "libmp3lame",
+            "-f",
+            "mp3",
+            "-y",
+            output_path,
+        ]
+
+    command = build_pipeline_command(input_path, operations, output_path, media_info)
+    if command is None:
+        return None
+    # 出力ファイルの指定を外してから、パイプへ書き出せるフォーマットの指定を付け直す
+    command = command[:-1]
+    if command[-1] == "-y":
+        command = command[:-1]
+    if command[-2:] == ["-f", "mp4"]:
+        command += ["-movflags", "frag_keyframe+empty_moov+default_base_moof"]
+    else:
+        command += ["-f", os.path.splitext(output_path)[1].lstrip(".")]
+    # 名前付きパイプは既に存在するため上書きを指定する
+    command += ["-y", output_path]
+    return command
+
+
+def run_stream_operation(
+    input_path: str,
+    json_data: dict,
+    output_path: str,
+    media_info: dict | None = None,
+) -> bool:
+    """処理結果を名前付きパイプへ書き出しながらffmpegで処理する"""
+    try:
+        command = build_stream_command(input_path, json_data, output_path, media_info)
+        if command is None:
+            return False
+
+        result = run_ffmpeg(command)
+
+        if result.returncode == 0:
+            print(f"ストリーミング処理成功: {output_path}")
+            return True
+        else:
+            print(
+                f"run_stream_operation関数でffmpegエラーが発生しました: {result.stderr}"
+            )
+            return False
+
+    except Exception as e:
+        print(f"run_stream_operation関数でエラーが発生しました: {e}")
+        return False
+
+
+def extract_audio_stream_copy(input_path: str, output_path: str) -> bool:
+    """音声トラックだけをストリームコピーで取り出す（クライアントでの送信前の分離用）
+
+    出力のコンテナは出力ファイルの拡張子から決まる
+    """
+    try:
+        result = run_ffmpeg(
+            [
+                "ffmpeg",
+                "-i",
+                input_path,
+                "-map",
+                "0:a",
+                "-c",
+                "copy",
+                "-y",
+                output_path,
+            ],
+        )
+
+        if result.returncode == 0:
+            return True
+        else:
+            print(
+                f"extract_audio_stream_copy関数でffmpegエラーが発生しました: {result.stderr}"
+            )
+            return False
+
+    except Exception as e:
+        print(f"extract_audio_stream_copy関数でエラーが発生しました: {e}")
+        return False
+
+
+def cut_keyframe_segment(
+    input_path: str, start_seconds: float, duration_seconds: float, output_path: str
+) -> float | None:
+    """start_secondsからduration_seconds分を含む区間をストリームコピーで切り出す
+    （クライアントでの送信前の切り出し用）
+
+    ストリームコピーはキーフレームでしか切れないため、start_seconds直前のキーフレームから切り出す。
+    start_secondsと戻り値はどちらもファイルの開始時刻からの秒数（入力側の-ssと同じ）のため、
+    開始時刻が0でないファイルでも、切り出したファイルの先頭はそのキーフレームになり、
+    元の開始時刻は start_seconds - 戻り値 の位置になる
+
+    Returns:
+        float | None: 切り出しを始めたキーフレームの時刻（秒）。失敗した場合はNone
+    """
+    try:
+        keyframe_time = find_preceding_keyframe(input_path, start_seconds)
+        if keyframe_time is None:
+            keyframe_time = 0.0
+        # 末尾もパケット単位で切れるため、1秒余分に含める
+        cut_duration = start_seconds - keyframe_time + duration_seconds + 1
+        result = run_ffmpeg(
+            [
+                "ffmpeg",
+                "-ss",
+                f"{keyframe_time:.6f}",
+                "-i",
+                input_path,
+                "-t",
+                f"{cut_duration:.6f}",
+                "-map",
+                "0",
+                "-c",
+                "copy",
+                "-avoid_negative_ts",
+                "make_zero",
+                "-y",
+                output_path,
+            ],
+        )
+
+        if result.returncode == 0:
+            return keyframe_time
+        else:
+            print(
+                f"cut_keyframe_segment関数でffmpegエラーが発生しました: {result.stderr}"
+            )
+            return None
+
+    except Exception as e:
+        print(f"cut_keyframe_segment関数でエラーが発生しました: {e}")
+        return None
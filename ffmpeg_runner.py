@@ -0,0 +1,83 @@
+import subprocess
+import threading
+
+"""
+ffmpegの実行と進捗の通知
+ffmpeg_functionの各処理とsegment_encoderのセグメントごとのエンコードは、どちらもrun_ffmpegで
+ffmpegを実行します。進捗コールバックが設定されている場合は -progress の出力を解析して通知し、
+サーバーはそれを途中経過のメッセージと処理速度のメトリクスに使います。
+"""
+
+# ffmpegの進捗を受け取るコールバック。ワーカープロセスがジョブごとに設定する
+_progress_callback = None
+
+
+def set_progress_callback(callback):
+    """ffmpegの進捗を受け取るコールバックを設定する（Noneで解除）
+
+    callbackは frame / fps / out_time（出力済みの秒数）/ speed（実時間比）を持つdictを受け取る
+    """
+    global _progress_callback
+    _progress_callback = callback
+
+
+def get_progress_callback():
+    """設定されている進捗コールバックを返す。設定されていない場合はNone"""
+    return _progress_callback
+
+
+def parse_progress(values: dict) -> dict:
+    """ffmpegの-progress出力の1ブロック（key=valueの集まり）を進捗のdictに変換する"""
+
+    def to_float(value) -> float | None:
+        try:
+            return float(str(value).rstrip("x"))
+        except ValueError:
+            return None
+
+    out_time_us = to_float(values.get("out_time_us", "N/A"))
+    return {
+        "frame": int(to_float(values.get("frame", "0")) or 0),
+        "fps": to_float(values.get("fps", "N/A")),
+        "out_time": out_time_us / 1_000_000 if out_time_us is not None else None,
+        "speed": to_float(values.get("speed", "N/A")),
+    }
+
+
+def run_ffmpeg(command: list[str], progress_callback=None) -> subprocess.CompletedProcess:
+    """ffmpegを実行する。戻り値は subprocess.run(capture_output=True, text=True) と同じ
+
+    進捗コールバックが設定されている場合は -progress pipe:1 を付けて実行し、
+    処理中に出力される進捗を解析してコールバックへ渡す。
+    progress_callbackを指定した場合は、設定されているコールバックの代わりにそれへ渡す
+    """
+    callback = progress_callback or _progress_callback
+    if callback is None:
+        return subprocess.run(command, capture_output=True, text=True)
+
+    command = [command[0], "-progress", "pipe:1", "-nostats", *command[1:]]
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    # 標準エラーは別スレッドで読み続け、パイプが詰まって止まらないようにする
+    stderr_chunks = []
+    stderr_reader = threading.Thread(
+        target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True
+    )
+    stderr_reader.start()
+
+    values = {}
+    for line in process.stdout:
+        key, _, value = line.strip().partition("=")
+        values[key] = value
+        # 1ブロックの最後は progress=continue / progress=end
+        if key == "progress":
+            try:
+                callback(parse_progress(values))
+            except Exception as e:
+                print(f"進捗の通知でエラーが発生しました: {e}")
+            values = {}
+
+    returncode = process.wait()
+    stderr_reader.join()
+    return subprocess.CompletedProcess(command, returncode, "", "".join(stderr_chunks))
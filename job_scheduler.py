@@ -0,0 +1,199 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+
+from media_probe import estimate_output_seconds
+
+"""
+ジョブのスケジューリング
+actionとprobe結果（長さ・解像度）、ペイロードサイズからジョブの処理コストを見積もり、
+ワーカーのキューから見積もりコストが小さいジョブを先に取り出します（shortest-expected-job-first）。
+    キューで待った秒数 × aging_rate だけコストを割り引くため、大きいジョブも待つほど前に進み、
+    小さいジョブが続いても後回しにされ続けない。
+    全てのジョブが同じ速さで割り引かれるので、取り出す順は
+    「見積もりコスト + aging_rate × キューに積んだ時刻」の小さい順と等しく、積んだ時点で決まる。
+    コストはメガピクセル秒のため長い動画では割り引きより桁違いに大きく、割り引きだけでは
+    数時間待たされることがある。そこでmax_wait秒以上待ったジョブがある場合は、コストによらず
+    その中で最も早く積まれたジョブを先に取り出し、待ち時間を直接抑える。
+    max_wait秒に達するまではコストの順序をそのまま使うため、短いジョブは大きいジョブを追い越せる。
+    代わりに、混雑が続いて多くのジョブがmax_wait秒を超える間は、それらの間では受信順（FIFO）になり、
+    短いジョブもその後ろで待つ。
+"""
+
+# スケジューリングの方式
+SCHEDULER_SJF = "sjf"
+SCHEDULER_FIFO = "fifo"
+
+# 出力1秒・1メガピクセルあたりの処理コスト（libx264のCRFエンコードを1とした相対値）
+ACTION_COST_FACTORS = {
+    "1": 1.0,  # 圧縮
+    "2": 1.0,  # 解像度変更
+    "3": 1.0,  # アスペクト比変更
+    "4": 0.01,  # 音声抽出（解像度によらない）
+    "5": 1.5,  # GIF・WEBMへの切り取り
+}
+# 長さや解像度がわからない場合に仮定する値
+DEFAULT_MEGAPIXELS = 1920 * 1080 / 1e6
+DEFAULT_BIT_RATE = 5_000_000
+# ffmpegの起動などジョブごとにかかるコスト
+JOB_OVERHEAD_COST = 0.1
+
+# メトリクスのラベルに使うジョブの分類（見積もりコストの上限, 分類名）
+JOB_CLASS_BOUNDS = ((5.0, "short"), (60.0, "medium"))
+JOB_CLASS_LONG = "long"
+
+
+def estimate_job_cost(
+    json_data: dict, media_info: dict | None, payload_size: int
+) -> float:
+    """ジョブの処理コストを見積もる（libx264で1メガピクセルの映像を1秒エンコードするコストが1）
+
+    出力の長さはestimate_output_secondsで求め、probe結果に長さが無い場合は
+    ペイロードサイズとビットレートから推定する
+    """
+    operations = json_data.get("operations") or [json_data]
+    actions = [str(operation.get("action")) for operation in operations]
+    factor = max(ACTION_COST_FACTORS.get(action, 1.0) for action in actions)
+
+    output_seconds = estimate_output_seconds(json_data, media_info)
+    if output_seconds is None:
+        bit_rate = (media_info or {}).get("bit_rate") or DEFAULT_BIT_RATE
+        output_seconds = payload_size * 8 / bit_rate
+
+    if all(action == "4" for action in actions):
+        megapixels = 1.0
+    else:
+        video = (media_info or {}).get("video") or {}
+        if video.get("width") and video.get("height"):
+            megapixels = video["width"] * video["height"] / 1e6
+        else:
+            megapixels = DEFAULT_MEGAPIXELS
+    return JOB_OVERHEAD_COST + factor * output_seconds * megapixels
+
+
+def job_class(cost: float) -> str:
+    """見積もりコストからジョブの分類（short / medium / long）を返す"""
+    for bound, name in JOB_CLASS_BOUNDS:
+        if cost < bound:
+            return name
+    return JOB_CLASS_LONG
+
+
+def schedule_key(
+    scheduler: str, cost: float, queued_at: float, aging_rate: float
+) -> float:
+    """キューから取り出す順を決める値（小さいほど先）"""
+    if scheduler == SCHEDULER_FIFO:
+        return queued_at
+    return cost + aging_rate * queued_at
+
+
+class JobOrder:
+    """積まれたジョブを取り出す順に並べる（スレッドセーフではない）
+
+    max_wait秒以上待ったジョブがある場合はその中で最も早く積まれたジョブを、
+    無い場合はschedule_key()の小さいジョブを取り出す。max_waitが0の場合は待ち時間を見ない
+    """
+
+    def __init__(self, scheduler: str, aging_rate: float, max_wait: float):
+        self.scheduler = scheduler
+        self.aging_rate = aging_rate
+        self.max_wait = max_wait
+        # (schedule_key, 積んだ順)。同じ値のジョブは積んだ順に取り出す
+        self._by_key: list = []
+        # (キューに積んだ時刻, 積んだ順)。積んだ時刻の順に並ぶ
+        self._by_arrival: deque[tuple[float, int]] = deque()
+        self._sequence = itertools.count()
+        # 片方の並びから取り出し済みで、もう片方にまだ残っているジョブの積んだ順
+        self._taken: set[int] = set()
+        self._items: dict[int, object] = {}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def push(self, item, cost: float, queued_at: float):
+        """ジョブを積む。queued_atは取り出すときに渡すnowと同じ時計の時刻"""
+        sequence = next(self._sequence)
+        key = schedule_key(self.scheduler, cost, queued_at, self.aging_rate)
+        heapq.heappush(self._by_key, (key, sequence))
+        # 積む時刻はほぼ単調に増えるため、前後した場合だけ挿入位置を探す
+        if self._by_arrival and self._by_arrival[-1][0] > queued_at:
+            index = len(self._by_arrival)
+            while index > 0 and self._by_arrival[index - 1][0] > queued_at:
+                index -= 1
+            self._by_arrival.insert(index, (queued_at, sequence))
+        else:
+            self._by_arrival.append((queued_at, sequence))
+        self._items[sequence] = item
+
+    def pop(self, now: float):
+        """次に実行するジョブを取り出す（空でないときに呼ぶ）"""
+        self._drop_taken()
+        if self.max_wait > 0 and now - self._by_arrival[0][0] >= self.max_wait:
+            _, sequence = self._by_arrival.popleft()
+        else:
+            _, sequence = heapq.heappop(self._by_key)
+        self._taken.add(sequence)
+        self._drop_taken()
+        return self._items.pop(sequence)
+
+    def _drop_taken(self):
+        """両方の並びの先頭から、取り出し済みのジョブを取り除く"""
+        while self._by_key and self._by_key[0][1] in self._taken:
+            self._taken.discard(heapq.heappop(self._by_key)[1])
+        while self._by_arrival and self._by_arrival[0][1] in self._taken:
+            self._taken.discard(self._by_arrival.popleft()[1])
+
+
+class JobQueue:
+    """有限長のジョブキュー。JobOrderの順に取り出す
+
+    queue.Queueと同じく、満杯の間はput()がtimeout秒まで待ってqueue.Fullを送出する
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        scheduler: str = SCHEDULER_SJF,
+        aging_rate: float = 0.1,
+        max_wait: float = 600.0,
+    ):
+        self.maxsize = maxsize
+        self._order = JobOrder(scheduler, aging_rate, max_wait)
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def put(self, item, cost: float, queued_at: float, timeout: float):
+        """ジョブを積む。満杯のままtimeout秒を過ぎた場合はqueue.Fullを送出する
+
+        queued_atはtime.perf_counter()の時刻
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self.maxsize > 0 and len(self._order) >= self.maxsize:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise queue.Full
+                self._condition.wait(remaining)
+            self._order.push(item, cost, queued_at)
+            self._condition.notify_all()
+
+    def get(self):
+        """次に実行するジョブを取り出す。close()された後はNoneを返す"""
+        with self._condition:
+            while not self._order and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return None
+            item = self._order.pop(time.perf_counter())
+            self._condition.notify_all()
+            return item
+
+    def close(self):
+        """待っているget()を終了させる（積まれているジョブは取り出さない）"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
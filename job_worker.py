@@ -0,0 +1,268 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from ffmpeg_function import (
+    change_video_aspect_ratio,
+    compress_video_file,
+    convert_to_mp3file,
+    decode_and_save_video,
+    needs_container_fix,
+    pipeline_output_file_name,
+    resize_video_resolution,
+    run_operation_pipeline,
+    run_stream_operation,
+    trim_video_to_gif_webm,
+)
+from ffmpeg_runner import set_progress_callback
+from job_scheduler import SCHEDULER_SJF, JobQueue, estimate_job_cost, job_class
+
+"""
+トランスコード用ワーカー層
+ネットワーク処理（受信・送信）とffmpeg処理を分離します。
+受信が完了したジョブは有限長のキューに積まれ、ワーカープロセスのプールがffmpeg処理を行います。
+キューからは見積もりコストが小さいジョブから取り出します（job_scheduler）。
+キューが満杯の場合は投入がタイムアウトし、サーバーはビジー応答を返します。
+"""
+
+
+def run_job(job: dict) -> dict:
+    """ワーカープロセス上でJSONデータのactionに応じてffmpegで動画を処理する
+
+    Args:
+        job: dict: 以下のキーを持つジョブ
+            - json_data: クライアントから受け取ったJSONデータ。
+                operationsに操作のリストがある場合は1回のffmpeg実行にまとめて処理する
+            - media_type: メディアタイプ
+            - spool_file_path: 受信したペイロードを書き込んだファイルのパス（ジョブの入力ファイル）
+            - workspace_dir: ジョブ専用の作業ディレクトリ
+            - segment_count: セグメント並列エンコードの最大分割数（省略時は分割しない）
+            - segment_min_seconds: 1セグメントの最短の長さ（秒）
+            - media_info: 入力ファイルのprobe結果（省略可）。コンテナの確認と
+                再エンコード不要の判定、切り取りのシーク位置の決定に使う
+            - progress_queue: ffmpegの進捗を送るキュー（省略可）
+            - stream_path: 処理結果を書き出す名前付きパイプのパス（省略可）。
+                指定した場合はサーバーがパイプから読みながらクライアントへ送る
+
+    Returns:
+        dict: status（"success" または "failure"）と処理後のファイルパス output_path
+    """
+    json_data = job["json_data"]
+    media_type = job["media_type"]
+    workspace_dir = job["workspace_dir"]
+    # 長い動画をセグメント並列でエンコードする設定（1以下の場合は分割しない）
+    segment_count = job.get("segment_count", 1)
+    min_segment_seconds = job.get("segment_min_seconds", 30)
+    media_info = job.get("media_info")
+    # ffmpegの進捗をサーバーへ送る（キューが無い場合は進捗を取得しない）
+    progress_queue = job.get("progress_queue")
+    set_progress_callback(progress_queue.put if progress_queue is not None else None)
+
+    # 受信したファイルをそのまま入力にする。コンテナに問題がある場合だけmp4へ再多重化する
+    uploaded_file_path = job["spool_file_path"]
+    # probe結果がある場合はffprobeを再実行せずにその結果で判断する
+    container_ok = (
+        media_info["container_ok"]
+        if media_info
+        else not needs_container_fix(uploaded_file_path)
+    )
+    if not container_ok:
+        remuxed_file_path = os.path.join(workspace_dir, "remuxed.mp4")
+        if not decode_and_save_video(uploaded_file_path, remuxed_file_path):
+            return {"status": "failure", "output_path": ""}
+        # 元のファイルは再多重化後に不要になるので削除する
+        os.remove(uploaded_file_path)
+        uploaded_file_path = remuxed_file_path
+
+    # ストリーミング応答の場合は処理結果を名前付きパイプへ書き出す
+    stream_path = job.get("stream_path")
+    if stream_path:
+        succeeded = run_stream_operation(
+            uploaded_file_path, json_data, stream_path, media_info
+        )
+        return {
+            "status": "success" if succeeded else "failure",
+            "output_path": stream_path,
+        }
+
+    # 複数の操作が指定された場合は1回のffmpeg実行にまとめて処理する
+    operations = json_data.get("operations")
+    if operations:
+        if len(operations) > 1:
+            output_path = os.path.join(
+                workspace_dir, pipeline_output_file_name(operations)
+            )
+            succeeded = run_operation_pipeline(
+                uploaded_file_path, operations, output_path, media_info
+            )
+            return {
+                "status": "success" if succeeded else "failure",
+                "output_path": output_path,
+            }
+        # 操作が1つだけの場合は単一操作と同じ処理を行う
+        json_data = operations[0]
+
+    # 動画ファイルに対する処理内容を確認して処理する
+    action = json_data.get("action")
+    if action == "1":
+        # 動画ファイルの自動圧縮
+        output_path = os.path.join(workspace_dir, "output_compressed.mp4")
+        succeeded = compress_video_file(
+            uploaded_file_path,
+            json_data.get("quality"),
+            output_path,
+            segment_count,
+            min_segment_seconds,
+            media_info,
+        )
+    elif action == "2":
+        # 動画の解像度変更
+        output_path = os.path.join(workspace_dir, "output_resized.mp4")
+        succeeded = resize_video_resolution(
+            uploaded_file_path,
+            json_data.get("resolution"),
+            output_path,
+            segment_count,
+            min_segment_seconds,
+            media_info,
+        )
+    elif action == "3":
+        # 動画のアスペクト比変更
+        output_path = os.path.join(workspace_dir, "output_aspect_ratio.mp4")
+        succeeded = change_video_aspect_ratio(
+            uploaded_file_path,
+            json_data.get("aspect_ratio"),
+            output_path,
+            json_data.get("fit_mode"),
+            segment_count,
+            min_segment_seconds,
+            media_info,
+        )
+    elif action == "4":
+        # mp4ファイルをmp3ファイルに変換
+        output_path = os.path.join(workspace_dir, "output.mp3")
+        succeeded = convert_to_mp3file(
+            uploaded_file_path,
+            output_path,
+            media_type,
+        )
+    elif action == "5":
+        # 動画を切り取る
+        output_path = os.path.join(
+            workspace_dir,
+            (
+                "output_trimmed.gif"
+                if json_data.get("trim") == "gif"
+                else "output_trimmed.webm"
+            ),
+        )
+        succeeded = trim_video_to_gif_webm(
+            uploaded_file_path,
+            json_data.get("start_time"),
+            json_data.get("duration"),
+            output_path,
+            json_data.get("trim"),
+            media_info,
+        )
+    else:
+        print(f"不正なaction: {action}")
+        return {"status": "failure", "output_path": ""}
+
+    return {"status": "success" if succeeded else "failure", "output_path": output_path}
+
+
+class TranscodeWorkerPool:
+    """有限長のジョブキューとワーカープロセスのプール
+
+    受信スレッドは submit() でジョブをキューに積み、返されたFutureで結果を待つ。
+    結果にはキューで待った秒数 queue_seconds と処理にかかった秒数 run_seconds、
+    見積もりコスト estimated_cost とその分類 job_class が加わる。
+    ディスパッチャースレッドがワーカー数分だけ存在し、キューからジョブを取り出して
+    プロセスプールで実行するため、同時に実行されるffmpeg処理はワーカー数に制限される。
+    schedulerが"sjf"の場合は見積もりコストが小さいジョブから、"fifo"の場合は積んだ順に取り出す。
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_queued_jobs: int,
+        scheduler: str = SCHEDULER_SJF,
+        aging_rate: float = 0.1,
+        max_wait: float = 600.0,
+    ):
+        self.max_workers = max_workers
+        # スレッドを持つサーバープロセスからforkしないようにspawnで起動する
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self._job_queue = JobQueue(max_queued_jobs, scheduler, aging_rate, max_wait)
+        # ワーカープロセスからffmpegの進捗を受け取るキューを作成するためのマネージャー
+        self._manager = multiprocessing.get_context("spawn").Manager()
+        self._dispatchers = [
+            threading.Thread(target=self._dispatch_loop, daemon=True)
+            for _ in range(max_workers)
+        ]
+        for dispatcher in self._dispatchers:
+            dispatcher.start()
+
+    def submit(self, job: dict, timeout: float) -> Future | None:
+        """ジョブをキューに積む
+
+        キューが満杯の間は最大timeout秒待機する。この間、受信スレッドは次の接続を
+        受け付けないため、新しいアップロードの読み込みも抑制される
+
+        Returns:
+            Future | None: 処理結果を受け取るFuture。キューが満杯のままタイムアウトした場合はNone
+        """
+        future: Future = Future()
+        cost = estimate_job_cost(
+            job["json_data"],
+            job.get("media_info"),
+            os.path.getsize(job["spool_file_path"]),
+        )
+        queued_at = time.perf_counter()
+        try:
+            self._job_queue.put((job, future, queued_at, cost), cost, queued_at, timeout)
+        except queue.Full:
+            return None
+        return future
+
+    def create_progress_queue(self):
+        """ワーカープロセスからffmpegの進捗を受け取るキューを作成する（ジョブのprogress_queueに渡す）"""
+        return self._manager.Queue()
+
+    def _dispatch_loop(self):
+        """キューからジョブを取り出してワーカープロセスで実行する"""
+        while True:
+            item = self._job_queue.get()
+            if item is None:
+                break
+            job, future, queued_at, cost = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            started_at = time.perf_counter()
+            try:
+                result = self._executor.submit(run_job, job).result()
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                # キューで待った時間とワーカーでの処理時間を結果に含める
+                future.set_result(
+                    {
+                        **result,
+                        "queue_seconds": started_at - queued_at,
+                        "run_seconds": time.perf_counter() - started_at,
+                        "estimated_cost": cost,
+                        "job_class": job_class(cost),
+                    }
+                )
+
+    def shutdown(self):
+        """ディスパッチャーを停止してプロセスプールを閉じる"""
+        self._job_queue.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._manager.shutdown()
@@ -0,0 +1,264 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from client import Client
+
+"""
+Clientの負荷試験モード（ロードジェネレーター）
+対話入力を使わず、ジョブの組み合わせ（操作・パラメータ・入力ファイル）を並行して送信し続け、
+操作ごとのレイテンシ（p50/p95/p99）、スループット（jobs/s・MB/s）、エラー率を集計します。
+    同時接続数モード: --concurrency 本の接続がそれぞれ応答を受け取るたびに次のジョブを送る
+    到着率モード    : --rate 件/秒で一定間隔にジョブを開始する（同時接続数は --concurrency まで）。
+                      レイテンシは予定開始時刻から計るため、サーバーが詰まった場合の待ちも含まれる
+
+ジョブの組み合わせはJSONのリストで指定します（weightは選ばれる比率、省略時1）。
+    [
+        {"file": "sample.mp4", "extension": "mp4",
+         "json_data": {"action": "1", "quality": "28"}, "weight": 3},
+        {"name": "trim", "file": "sample.mp4", "extension": "mp4",
+         "json_data": {"action": "5", "trim": "gif", "start_time": "5", "duration": "3"}}
+    ]
+
+実行例: python load_generator.py --jobs jobs.json --concurrency 16 --duration 60 --output report.json
+"""
+
+# ステータスごとの結果の分類
+RESULT_OK = "ok"
+RESULT_BUSY = "busy"
+RESULT_ERROR = "error"
+
+
+def load_job_mix(path: str) -> list[dict]:
+    """ジョブの組み合わせのJSONを読み込み、入力ファイルの存在を確認する"""
+    with open(path, encoding="utf-8") as f:
+        jobs = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for job in jobs:
+        # 入力ファイルはJSONファイルからの相対パスでも指定できる
+        job["file"] = os.path.join(base_dir, job["file"])
+        if not os.path.isfile(job["file"]):
+            raise FileNotFoundError(f"入力ファイルが見つかりません: {job['file']}")
+        job.setdefault("extension", os.path.splitext(job["file"])[1].lstrip("."))
+        job.setdefault("weight", 1)
+        job.setdefault("name", job_name(job["json_data"]))
+    return jobs
+
+
+def job_name(json_data: dict) -> str:
+    """集計に使う操作名。複数操作のパイプラインは操作番号をつなげる"""
+    operations = json_data.get("operations")
+    if operations:
+        return "pipeline_" + "_".join(
+            str(operation.get("action")) for operation in operations
+        )
+    return f"action_{json_data.get('action')}"
+
+
+def percentile(values: list[float], ratio: float) -> float | None:
+    """最近傍法でパーセンタイルを返す。値が無い場合はNone"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))]
+
+
+class LoadGenerator:
+    """ジョブの組み合わせを並行して送信し、結果を集計する"""
+
+    def __init__(
+        self,
+        jobs: list[dict],
+        concurrency: int,
+        duration: float,
+        rate: float = 0.0,
+        seed: int | None = None,
+    ):
+        self.jobs = jobs
+        self.concurrency = concurrency
+        self.duration = duration
+        self.rate = rate
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._results_lock = threading.Lock()
+        # (操作名, 分類, レイテンシ, 送信バイト数, 受信バイト数)
+        self._results: list[tuple[str, str, float, int, int]] = []
+        self._local = threading.local()
+        self._work_dir = tempfile.mkdtemp(prefix="load_generator_")
+
+    def choose_job(self) -> dict:
+        """weightの比率でジョブを選ぶ"""
+        with self._random_lock:
+            return self._random.choices(
+                self.jobs, weights=[job["weight"] for job in self.jobs]
+            )[0]
+
+    def run_one(self, job: dict, scheduled_at: float | None = None):
+        """1つのジョブを新しい接続で送信し、結果を記録する
+
+        scheduled_atを指定した場合は、その時刻からの経過時間をレイテンシとする
+        """
+        # 同じファイル名の結果を同時に書き込まないよう、スレッドごとに保存先を分ける
+        output_dir = getattr(self._local, "output_dir", None)
+        if output_dir is None:
+            output_dir = tempfile.mkdtemp(dir=self._work_dir)
+            self._local.output_dir = output_dir
+
+        start = scheduled_at if scheduled_at is not None else time.perf_counter()
+        sent_size = received_size = 0
+        client = Client()
+        client.output_dir = output_dir
+        try:
+            client.connect()
+            response = client.send_request(
+                job["file"], job["extension"], job["json_data"]
+            )
+            status_id = response.get("status_id")
+            if status_id == "200":
+                result = RESULT_OK
+                sent_size = os.path.getsize(job["file"])
+                output_path = os.path.join(
+                    output_dir, os.path.basename(response.get("file_name"))
+                )
+                received_size = os.path.getsize(output_path)
+                os.remove(output_path)
+            elif status_id == "503":
+                result = RESULT_BUSY
+            else:
+                result = RESULT_ERROR
+        except Exception as e:
+            print(f"ジョブの送信中にエラーが発生しました: {e}")
+            result = RESULT_ERROR
+        finally:
+            client.socket.close()
+        latency = time.perf_counter() - start
+
+        with self._results_lock:
+            self._results.append((job["name"], result, latency, sent_size, received_size))
+
+    def _closed_loop_worker(self, deadline: float):
+        """応答を受け取るたびに次のジョブを送る"""
+        while time.perf_counter() < deadline:
+            self.run_one(self.choose_job())
+
+    def run(self) -> dict:
+        """負荷をかけて集計結果を返す"""
+        start = time.perf_counter()
+        deadline = start + self.duration
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                if self.rate > 0:
+                    # 到着率モード: 予定時刻になったジョブを順に投入する
+                    index = 0
+                    while True:
+                        scheduled_at = start + index / self.rate
+                        if scheduled_at >= deadline:
+                            break
+                        time.sleep(max(0.0, scheduled_at - time.perf_counter()))
+                        executor.submit(self.run_one, self.choose_job(), scheduled_at)
+                        index += 1
+                else:
+                    for _ in range(self.concurrency):
+                        executor.submit(self._closed_loop_worker, deadline)
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> dict:
+        """操作ごとと全体のレイテンシ・スループット・エラー率を集計する"""
+        with self._results_lock:
+            results = list(self._results)
+
+        def summarize(rows: list[tuple]) -> dict:
+            latencies = [row[2] for row in rows if row[1] == RESULT_OK]
+            transferred = sum(row[3] + row[4] for row in rows)
+            count = len(rows)
+            return {
+                "requests": count,
+                "ok": len(latencies),
+                "busy": sum(row[1] == RESULT_BUSY for row in rows),
+                "errors": sum(row[1] == RESULT_ERROR for row in rows),
+                "error_rate": (count - len(latencies)) / count if count else 0.0,
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "jobs_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+                "mb_per_second": transferred / elapsed / 1e6 if elapsed > 0 else 0.0,
+            }
+
+        names = sorted({row[0] for row in results})
+        return {
+            "elapsed": elapsed,
+            "concurrency": self.concurrency,
+            "rate": self.rate,
+            "total": summarize(results),
+            "actions": {
+                name: summarize([row for row in results if row[0] == name])
+                for name in names
+            },
+        }
+
+
+def print_report(report: dict):
+    """集計結果を表形式で表示する"""
+
+    def seconds(value: float | None) -> str:
+        return f"{value:.3f}" if value is not None else "-"
+
+    print(
+        f"経過時間: {report['elapsed']:.1f} s, 同時接続数: {report['concurrency']}, "
+        f"到着率: {report['rate'] or '-'} 件/s"
+    )
+    print(
+        f"{'操作':<20}{'件数':>7}{'成功':>7}{'busy':>7}{'error':>7}{'エラー率':>9}"
+        f"{'p50':>9}{'p95':>9}{'p99':>9}{'jobs/s':>9}{'MB/s':>9}"
+    )
+    for name, summary in [*report["actions"].items(), ("合計", report["total"])]:
+        print(
+            f"{name:<20}{summary['requests']:>7}{summary['ok']:>7}{summary['busy']:>7}"
+            f"{summary['errors']:>7}{summary['error_rate'] * 100:>8.1f}%"
+            f"{seconds(summary['p50']):>9}{seconds(summary['p95']):>9}"
+            f"{seconds(summary['p99']):>9}{summary['jobs_per_second']:>9.2f}"
+            f"{summary['mb_per_second']:>9.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clientの負荷試験モード")
+    parser.add_argument("--jobs", required=True, help="ジョブの組み合わせのJSONファイル")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時接続数")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0.0,
+        help="1秒あたりの開始件数（0の場合は同時接続数モード）",
+    )
+    parser.add_argument("--duration", type=float, default=60.0, help="負荷をかける秒数")
+    parser.add_argument("--seed", type=int, help="ジョブを選ぶ乱数のシード")
+    parser.add_argument("--output", help="集計結果を書き込むJSONファイル")
+    args = parser.parse_args()
+
+    generator = LoadGenerator(
+        load_job_mix(args.jobs), args.concurrency, args.duration, args.rate, args.seed
+    )
+    print(f"負荷試験を開始します: {args.duration} s", file=sys.stderr)
+    # 各リクエストのログは表示せず、集計結果だけを表示する
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        report = generator.run()
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+import bisect
+import json
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+
+"""
+ffprobeによる動画情報の取得
+動画の情報（コーデック、解像度、SAR/DAR、長さ、ビットレート）は
+コンテンツハッシュをキーにMediaProbeCacheへ保存し、同じ動画を再度probeしないようにします。
+ffmpeg処理の高速化（ストリームコピー・処理不要の判定）や、ジョブのコスト見積もりに使います。
+"""
+
+# キーフレームを探す範囲（秒）。開始時刻の手前のこの範囲だけをffprobeで読む
+KEYFRAME_SEARCH_WINDOW = 60.0
+
+
+def parse_timestamp(value) -> float | None:
+    """ "00:00:10"、"01:30"、"10"、"10.5" 形式の時刻を秒に変換する。変換できない場合はNone"""
+    try:
+        seconds = 0.0
+        for part in str(value).strip().split(":"):
+            seconds = seconds * 60 + float(part)
+        return seconds if seconds >= 0 else None
+    except ValueError:
+        return None
+
+
+def probe_keyframe_times(
+    input_path: str, read_interval: tuple[float, float] | None = None
+) -> list[float] | None:
+    """映像のキーフレームの時刻（秒）を昇順で返す
+
+    パケットのフラグだけを見るためデコードは行わない。read_intervalを指定した場合は
+    その範囲だけをシークして読むので、長い動画でもファイル全体を走査しない。
+    時刻とread_intervalはどちらもパケットのタイムスタンプそのもの（ファイルの開始時刻を含む）
+
+    Args:
+        input_path: 入力動画ファイルのパス
+        read_interval: (開始秒, 終了秒)。Noneの場合はファイル全体
+
+    Returns:
+        list[float] | None: キーフレームの時刻。取得できない場合はNone
+    """
+    command = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=print_section=0",
+    ]
+    if read_interval is not None:
+        command += ["-read_intervals", f"{read_interval[0]:.3f}%{read_interval[1]:.3f}"]
+    command.append(input_path)
+
+    try:
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(
+                f"probe_keyframe_times関数でffprobeエラーが発生しました: {result.stderr}"
+            )
+            return None
+
+        keyframe_times = []
+        for line in result.stdout.splitlines():
+            pts_time, _, flags = line.partition(",")
+            if "K" in flags and pts_time not in ("", "N/A"):
+                keyframe_times.append(float(pts_time))
+        return sorted(keyframe_times)
+
+    except Exception as e:
+        print(f"probe_keyframe_times関数でエラーが発生しました: {e}")
+        return None
+
+
+def probe_start_time(input_path: str) -> float:
+    """ファイルの開始時刻（コンテナのstart_time、秒）を返す。取得できない場合は0"""
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=start_time",
+                "-of",
+                "csv=print_section=0",
+                input_path,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        return float(result.stdout.strip())
+    except (OSError, ValueError):
+        return 0.0
+
+
+def find_preceding_keyframe(
+    input_path: str, target_time: float, start_time: float | None = None
+) -> float | None:
+    """target_time以前で最も近いキーフレームの時刻を返す。見つからない場合はNone
+
+    target_timeと戻り値は、ffmpegの入力側の-ssと同じくファイルの開始時刻からの秒数。
+    パケットのタイムスタンプは開始時刻を含むため、start_time（probe結果のstart_time。
+    Noneの場合はffprobeで取得する）を足して調べ、差し引いて返す。
+    まず開始時刻の手前KEYFRAME_SEARCH_WINDOW秒だけを調べ、見つからない場合は先頭から調べる
+    """
+    if start_time is None:
+        start_time = probe_start_time(input_path)
+    window_start = max(0.0, target_time - KEYFRAME_SEARCH_WINDOW)
+    target_end = start_time + target_time + 0.001
+    keyframe_times = probe_keyframe_times(
+        input_path, (start_time + window_start, target_end)
+    )
+    if not keyframe_times or keyframe_times[0] > start_time + target_time:
+        if window_start == 0.0:
+            return None
+        keyframe_times = probe_keyframe_times(input_path, (start_time, target_end))
+    keyframe_time = preceding_keyframe(keyframe_times or [], start_time + target_time)
+    if keyframe_time is None:
+        return None
+    return max(0.0, keyframe_time - start_time)
+
+
+def preceding_keyframe(keyframe_times: list[float], target_time: float) -> float | None:
+    """昇順のキーフレーム時刻からtarget_time以前で最も近いものを返す。無い場合はNone"""
+    index = bisect.bisect_right(keyframe_times, target_time)
+    if index == 0:
+        return None
+    return keyframe_times[index - 1]
+
+
+def parse_ratio(value) -> float | None:
+    """ "16:9" や "30000/1001" 形式の比を数値に変換する。変換できない・0の場合はNone"""
+    try:
+        numerator, _, denominator = str(value).replace("/", ":").partition(":")
+        ratio = float(numerator) / float(denominator or 1)
+        return ratio if ratio > 0 else None
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def probe_media(input_path: str) -> dict | None:
+    """ffprobeで動画の情報を取得する
+
+    Returns:
+        dict | None: 以下のキーを持つ情報。ffprobeを実行できない場合はNone
+            - format_name: コンテナ名（例: "mov,mp4,m4a,3gp,3g2,mj2"）
+            - container_ok: ffprobeがエラーなく読み込めたかどうか
+            - start_time: 開始時刻（秒）。パケットのタイムスタンプと入力側の-ssの差
+            - duration: 長さ（秒）
+            - bit_rate: 全体のビットレート（bps）
+            - video: 最初の映像ストリームの codec_name / width / height /
+                sample_aspect_ratio / display_aspect_ratio / pix_fmt。映像が無い場合はNone
+            - audio_codecs: 音声ストリームのコーデック名のリスト
+
+        キーフレームの位置はファイル全体のパケットを読む必要があるため含めない。
+        切り取りでは find_preceding_keyframe() で開始時刻の手前だけを調べる
+    """
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=format_name,start_time,duration,bit_rate:"
+                "stream=codec_type,codec_name,width,height,"
+                "sample_aspect_ratio,display_aspect_ratio,pix_fmt",
+                "-of",
+                "json",
+                input_path,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        probed = json.loads(result.stdout or "{}")
+    except Exception as e:
+        print(f"probe_media関数でエラーが発生しました: {e}")
+        return None
+
+    format_info = probed.get("format", {})
+    streams = probed.get("streams", [])
+    video_streams = [stream for stream in streams if stream.get("codec_type") == "video"]
+    video = None
+    if video_streams:
+        video = {
+            key: video_streams[0].get(key)
+            for key in (
+                "codec_name",
+                "width",
+                "height",
+                "sample_aspect_ratio",
+                "display_aspect_ratio",
+                "pix_fmt",
+            )
+        }
+
+    def to_float(value) -> float | None:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    return {
+        "format_name": format_info.get("format_name", ""),
+        "container_ok": result.returncode == 0 and not result.stderr.strip(),
+        "start_time": to_float(format_info.get("start_time")),
+        "duration": to_float(format_info.get("duration")),
+        "bit_rate": to_float(format_info.get("bit_rate")),
+        "video": video,
+        "audio_codecs": [
+            stream.get("codec_name")
+            for stream in streams
+            if stream.get("codec_type") == "audio"
+        ],
+    }
+
+
+def display_aspect_ratio(media_info: dict | None) -> float | None:
+    """映像の表示アスペクト比を返す。不明な場合はNone"""
+    video = (media_info or {}).get("video")
+    if not video or not video.get("width") or not video.get("height"):
+        return None
+    # SARが未設定（"0:1"やN/A）の場合は正方形ピクセルとみなす
+    sample_aspect_ratio = parse_ratio(video.get("sample_aspect_ratio")) or 1.0
+    return video["width"] * sample_aspect_ratio / video["height"]
+
+
+class MediaProbeCache:
+    """コンテンツハッシュをキーにしたprobe結果のキャッシュ
+
+    1つの結果は cache_dir/<ハッシュ>.json として保存し、max_entriesを超えた場合は
+    最も長く使われていない結果から削除する（LRU）
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # ハッシュ -> probe結果。先頭が最も長く使われていない結果
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_entries()
+
+    def _load_entries(self):
+        """ディスク上の結果を最終利用時刻の古い順に読み込む"""
+        found = []
+        for file_name in os.listdir(self.cache_dir):
+            file_path = os.path.join(self.cache_dir, file_name)
+            if not file_name.endswith(".json"):
+                # 書き込み途中で終了した一時ファイルは削除する
+                os.remove(file_path)
+                continue
+            try:
+                with open(file_path, encoding="utf-8") as f:
+                    media_info = json.load(f)
+                found.append((os.path.getmtime(file_path), file_name[:-5], media_info))
+            except (OSError, ValueError):
+                # 書き込み途中で終了した結果などは削除する
+                os.remove(file_path)
+        for _, content_hash, media_info in sorted(found, key=lambda entry: entry[0]):
+            self._entries[content_hash] = media_info
+        with self._lock:
+            self._evict()
+
+    def get(self, content_hash: str, input_path: str) -> dict | None:
+        """content_hashのprobe結果を返す。キャッシュに無い場合はinput_pathをprobeして保存する"""
+        with self._lock:
+            media_info = self._entries.get(content_hash)
+            if media_info is not None:
+                self._entries.move_to_end(content_hash)
+                try:
+                    # 最終利用時刻を更新する
+                    os.utime(os.path.join(self.cache_dir, f"{content_hash}.json"))
+                except OSError:
+                    pass
+                return media_info
+
+        media_info = probe_media(input_path)
+        if media_info is None:
+            return None
+        file_path = os.path.join(self.cache_dir, f"{content_hash}.json")
+        tmp_path = f"{file_path}.tmp{threading.get_ident()}"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(media_info, f)
+            os.replace(tmp_path, file_path)
+        except OSError as e:
+            print(f"probe結果の保存に失敗しました: {e}")
+        with self._lock:
+            self._entries[content_hash] = media_info
+            self._entries.move_to_end(content_hash)
+            self._evict()
+        return media_info
+
+    def _evict(self):
+        """件数が上限以下になるまで最も長く使われていない結果を削除する（ロック取得済みで呼ぶ）"""
+        while len(self._entries) > self.max_entries:
+            content_hash, _ = self._entries.popitem(last=False)
+            try:
+                os.remove(os.path.join(self.cache_dir, f"{content_hash}.json"))
+            except OSError:
+                continue
+
+
+def estimate_output_seconds(json_data: dict, media_info: dict | None) -> float | None:
+    """処理結果の動画の長さ（秒）を見積もる。切り取りの場合は切り取る長さ。不明な場合はNone"""
+    duration = (media_info or {}).get("duration")
+    operations = json_data.get("operations") or [json_data]
+    trim_operation = operations[-1] if operations[-1].get("action") == "5" else None
+    if trim_operation is None:
+        return duration
+
+    start_seconds = parse_timestamp(trim_operation.get("start_time"))
+    trim_seconds = parse_timestamp(trim_operation.get("duration"))
+    if trim_seconds is None:
+        return duration
+    if duration is not None and start_seconds is not None:
+        return max(0.0, min(trim_seconds, duration - start_seconds))
+    return trim_seconds
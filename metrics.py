@@ -0,0 +1,273 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+サーバーのメトリクス
+リクエストの各段階（accept・ヘッダー受信・ボディ受信・一時ファイル書き込み・ffmpeg処理・
+レスポンス送信・後片付け）の所要時間のヒストグラムや、送受信バイト数、処理中のジョブ数などを記録し、
+ローカルのHTTPエンドポイントからPrometheusのテキスト形式で公開します。
+エンドポイントは既定では無効です。.envのmetrics_portにポート番号を設定すると公開します。
+    metrics_port = 9100
+    curl http://127.0.0.1:9100/metrics
+"""
+
+# ヒストグラムのバケット（秒）
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+    1800.0,
+)
+
+
+def _format_labels(labelnames: tuple, labelvalues: tuple, extra: str = "") -> str:
+    """ラベルをPrometheusのテキスト形式（{name="value",...}）にする"""
+    pairs = [
+        name
+        + '="'
+        + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for name, value in zip(labelnames, labelvalues)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    """ラベルごとの値を持つメトリクスの基底クラス"""
+
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines += self._render_value(key, value)
+        return lines
+
+    def _render_value(self, key: tuple, value) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+        ]
+
+
+class Counter(_Metric):
+    """増加だけする値（バイト数、失敗回数など）"""
+
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """増減する値（処理中のジョブ数など）"""
+
+    metric_type = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """値の分布（所要時間など）"""
+
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # [各バケットの件数（累積ではない）..., 合計, 件数]
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def totals(self) -> dict[tuple, tuple[float, int]]:
+        """ラベルごとの (合計, 件数) を返す（ベンチマークで前後の差分を取るために使う）"""
+        with self._lock:
+            return {key: (entry[-2], entry[-1]) for key, entry in self._values.items()}
+
+    @contextmanager
+    def time(self, **labels):
+        """withブロックの所要時間を記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key: tuple, value) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float("inf")), value):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(value[-2])}")
+        lines.append(f"{self.name}_count{labels} {value[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """メトリクスをまとめてPrometheusのテキスト形式で出力する"""
+
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def _register(self, metric: _Metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(
+    registry: MetricsRegistry, port: int, host: str = "127.0.0.1"
+) -> ThreadingHTTPServer:
+    """GET /metrics でメトリクスを返すHTTPサーバーをデーモンスレッドで起動する"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # アクセスログは出力しない
+            pass
+
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    print(f"メトリクスを公開しています: http://{host}:{port}/metrics")
+    return http_server
+
+
+# サーバーのメトリクス
+REGISTRY = MetricsRegistry()
+PHASE_SECONDS = REGISTRY.histogram(
+    "mmp_request_phase_seconds",
+    "リクエストの各段階の所要時間（accept, header_read, admission, body_receive, temp_write, "
+    "queue_wait, ffmpeg, first_chunk, response_send, cleanup）",
+    ("phase",),
+)
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "mmp_job_queue_wait_seconds",
+    "見積もりコストの分類（short, medium, long）ごとのジョブのキュー待ち時間",
+    ("job_class",),
+)
+FFMPEG_SECONDS = REGISTRY.histogram(
+    "mmp_ffmpeg_seconds", "actionごとのffmpeg処理の所要時間", ("action",)
+)
+FFMPEG_FAILURES = REGISTRY.counter(
+    "mmp_ffmpeg_failures_total", "actionごとのffmpeg処理の失敗回数", ("action",)
+)
+FFMPEG_SPEED = REGISTRY.histogram(
+    "mmp_ffmpeg_speed_ratio",
+    "ffmpeg処理の実時間に対する速度（-progressのspeed）",
+    ("action",),
+    (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0),
+)
+RECEIVED_BYTES = REGISTRY.counter(
+    "mmp_received_bytes_total", "受信したペイロードのバイト数"
+)
+SENT_BYTES = REGISTRY.counter("mmp_sent_bytes_total", "送信したペイロードのバイト数")
+CONNECTIONS_IN_FLIGHT = REGISTRY.gauge("mmp_connections_in_flight", "処理中の接続数")
+JOBS_IN_FLIGHT = REGISTRY.gauge(
+    "mmp_jobs_in_flight", "ワーカーのキューに積まれているか処理中のジョブ数"
+)
+ADMITTED_BYTES = REGISTRY.gauge(
+    "mmp_admitted_bytes", "受け入れて受信中か処理中のジョブのペイロードの合計"
+)
+REQUESTS = REGISTRY.counter("mmp_requests_total", "結果ごとのリクエスト数", ("status",))
+MESSAGES_PACKED = REGISTRY.counter(
+    "mmp_messages_packed_total", "パックしたMMPメッセージ数"
+)
+MESSAGES_UNPACKED = REGISTRY.counter(
+    "mmp_messages_unpacked_total", "アンパックしたMMPメッセージ数"
+)
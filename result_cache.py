@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+"""
+処理結果のキャッシュ
+受信したペイロードのハッシュと、正規化した処理パラメータ（json_data）からキーを作成し、
+ffmpegの処理結果をディスクに保存します。
+同じ動画を同じ設定で再送信された場合はffmpegを実行せずに保存済みの結果を返します。
+合計サイズが上限を超えた場合は、最も長く使われていない結果から削除します（LRU）。
+"""
+
+# 処理結果に影響するjson_dataのキー
+CACHE_PARAM_KEYS = (
+    "action",
+    "quality",
+    "resolution",
+    "aspect_ratio",
+    "fit_mode",
+    "trim",
+    "start_time",
+    "duration",
+)
+
+
+def normalize_cache_params(json_data: dict) -> dict:
+    """処理結果に影響するキーだけを取り出し、値を文字列に揃える"""
+    return {
+        key: str(json_data[key]).strip()
+        for key in CACHE_PARAM_KEYS
+        if json_data.get(key) is not None
+    }
+
+
+def make_cache_key(payload_hash: str, json_data: dict, media_type: str) -> str:
+    """ペイロードのハッシュと処理パラメータからキャッシュキーを作成する
+
+    パラメータは処理結果に影響するキーだけを取り出し、値を文字列に揃えて
+    キー順に並べてからハッシュするため、順序や型の違いでキーが変わることはない
+    """
+    params = normalize_cache_params(json_data)
+    # 複数操作のパイプラインは各操作のパラメータを順序どおりに含める
+    if json_data.get("operations"):
+        params["operations"] = [
+            normalize_cache_params(operation) for operation in json_data["operations"]
+        ]
+    # ストリーミング応答の出力（フラグメント化したmp4やlibmp3lameのmp3）は通常の出力と異なるため、
+    # 実際にストリーミングで処理される場合（名前付きパイプが使える環境）はキーを分ける
+    if json_data.get("stream") and hasattr(os, "mkfifo"):
+        params["stream"] = "1"
+    # mp3変換はメディアタイプを出力フォーマットとして使うのでキーに含める
+    params["media_type"] = media_type
+    normalized = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(f"{payload_hash}:{normalized}".encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """サイズ上限付きのLRU結果キャッシュ
+
+    1つの結果は cache_dir/<キー>/<ファイル名> として保存する。
+    最終利用時刻はファイルの更新時刻に記録するため、再起動後もLRUの順序が保たれる。
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # キー -> (ファイル名, サイズ)。先頭が最も長く使われていない結果
+        self._entries: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._total_bytes = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_entries()
+
+    def _load_entries(self):
+        """ディスク上の結果を最終利用時刻の古い順に読み込む"""
+        found = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if not os.path.isdir(entry_dir):
+                continue
+            file_names = os.listdir(entry_dir)
+            if len(file_names) != 1:
+                # 書き込み途中で終了した結果などは削除する
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            stat = os.stat(os.path.join(entry_dir, file_names[0]))
+            found.append((stat.st_mtime, key, file_names[0], stat.st_size))
+        for _, key, file_name, size in sorted(found):
+            self._entries[key] = (file_name, size)
+            self._total_bytes += size
+        self._evict()
+
+    def get(self, key: str, dest_dir: str) -> str | None:
+        """キャッシュされた結果をdest_dirに取り出す
+
+        ジョブの作業ディレクトリへハードリンク（できない場合はコピー）するため、
+        送信中に結果が追い出されても送信は影響を受けない
+
+        Returns:
+            str | None: 取り出したファイルのパス。キャッシュに無い場合はNone
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            file_name, _ = entry
+            cached_path = os.path.join(self.cache_dir, key, file_name)
+            dest_path = os.path.join(dest_dir, file_name)
+            try:
+                try:
+                    os.link(cached_path, dest_path)
+                except OSError:
+                    shutil.copyfile(cached_path, dest_path)
+                # 最終利用時刻を更新する
+                os.utime(cached_path)
+            except OSError as e:
+                print(f"キャッシュの取り出しに失敗しました: {e}")
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dest_path
+
+    def put(self, key: str, file_path: str):
+        """処理結果をキャッシュに保存し、上限を超えた分を古い順に削除する"""
+        size = os.path.getsize(file_path)
+        if size > self.max_bytes:
+            return
+        file_name = os.path.basename(file_path)
+        entry_dir = os.path.join(self.cache_dir, key)
+        # 書き込み途中の結果が見えないよう一時ディレクトリに作成してから置き換える
+        tmp_dir = f"{entry_dir}.tmp{threading.get_ident()}"
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            shutil.copyfile(file_path, os.path.join(tmp_dir, file_name))
+            with self._lock:
+                if key in self._entries:
+                    return
+                os.replace(tmp_dir, entry_dir)
+                self._entries[key] = (file_name, size)
+                self._total_bytes += size
+                self._evict()
+        except OSError as e:
+            print(f"キャッシュへの保存に失敗しました: {e}")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def stats(self) -> dict:
+        """ヒット数・ミス数などの統計を返す"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+            }
+
+    def _evict(self):
+        """合計サイズが上限以下になるまで最も長く使われていない結果を削除する（ロック取得済みで呼ぶ）"""
+        while self._total_bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        """結果を1つ削除する（ロック取得済みで呼ぶ）"""
+        _, size = self._entries.pop(key)
+        self._total_bytes -= size
+        shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
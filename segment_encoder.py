@@ -0,0 +1,241 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ffmpeg_runner import get_progress_callback, run_ffmpeg
+
+"""
+セグメント並列エンコード
+1つのlibx264プロセスは数コアを超えるとスケールしないため、長い動画は次の手順で並列にエンコードします。
+    1. ストリームコピーでキーフレーム位置ごとにセグメントへ分割する（再エンコードなし）
+    2. 各セグメントを同じ設定で別々のffmpegプロセスとして同時にエンコードする
+    3. concat demuxerでストリームコピーのまま連結し、必要であれば元の音声を多重化する
+各セグメントのエンコードはrun_ffmpegで実行し、進捗は動画全体の進捗にまとめて通知する。
+"""
+
+
+class SegmentProgress:
+    """並列にエンコードしている各セグメントの進捗を、動画全体の進捗にまとめて通知する
+
+    frameとout_timeは各セグメントの値の合計、fpsとspeedはそれをエンコード開始からの
+    経過時間で割った値（1プロセスでエンコードした場合と同じ意味の値）にする
+    """
+
+    def __init__(self, count: int, callback):
+        self.callback = callback
+        self._progress: list[dict | None] = [None] * count
+        self._started_at = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def callback_for(self, index: int):
+        """index番目のセグメントのrun_ffmpegに渡すコールバックを返す"""
+        return lambda progress: self.update(index, progress)
+
+    def update(self, index: int, progress: dict):
+        with self._lock:
+            self._progress[index] = progress
+            reported = [progress for progress in self._progress if progress]
+            frame = sum(progress["frame"] for progress in reported)
+            out_time = sum(progress["out_time"] or 0.0 for progress in reported)
+            elapsed = time.perf_counter() - self._started_at
+            self.callback(
+                {
+                    "frame": frame,
+                    "fps": frame / elapsed if elapsed > 0 else None,
+                    "out_time": out_time,
+                    "speed": out_time / elapsed if elapsed > 0 else None,
+                }
+            )
+
+
+def probe_duration(input_path: str) -> float | None:
+    """ffprobeで動画の長さ（秒）を取得する。取得できない場合はNone"""
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration",
+                "-of",
+                "default=noprint_wrappers=1:nokey=1",
+                input_path,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            return None
+        return float(result.stdout.strip())
+
+    except Exception as e:
+        print(f"probe_duration関数でエラーが発生しました: {e}")
+        return None
+
+
+def encode_video_in_segments(
+    input_path: str,
+    output_path: str,
+    video_args: list[str],
+    keep_audio: bool,
+    segment_count: int,
+    min_segment_seconds: float,
+    duration: float | None = None,
+) -> bool | None:
+    """動画をキーフレームで分割し、セグメントごとに並列エンコードして連結する
+
+    Args:
+        input_path: 入力動画ファイルのパス
+        output_path: 出力ファイルのパス（mp4）
+        video_args: 各セグメントに適用するffmpegの映像エンコード引数
+            例: ["-vf", "scale=1280:720", "-c:v", "libx264", "-crf", "23"]
+        keep_audio: Trueの場合は元の音声をストリームコピーで出力に含める
+        segment_count: 同時にエンコードするセグメント数の上限
+        min_segment_seconds: 1セグメントの最短の長さ（秒）。短い動画は分割しない
+        duration: 動画の長さ（秒）。probe結果が無くNoneの場合はffprobeで取得する
+
+    Returns:
+        bool | None: 成功時True、失敗時False。分割するほど長くない場合はNone（呼び出し元で通常の処理を行う）
+    """
+    if duration is None:
+        duration = probe_duration(input_path)
+    if duration is None or min_segment_seconds <= 0:
+        return None
+    count = min(segment_count, int(duration // min_segment_seconds))
+    if count < 2:
+        return None
+
+    work_dir = tempfile.mkdtemp(
+        prefix="segments_", dir=os.path.dirname(os.path.abspath(output_path))
+    )
+    try:
+        source_paths = split_at_keyframes(input_path, work_dir, duration, count)
+        if not source_paths:
+            return False
+        print(f"{len(source_paths)}個のセグメントを並列にエンコードします: {input_path}")
+
+        encoded_paths = [
+            os.path.join(work_dir, f"encoded_{index:03d}.mp4")
+            for index in range(len(source_paths))
+        ]
+        callback = get_progress_callback()
+        progress = SegmentProgress(len(source_paths), callback) if callback else None
+        with ThreadPoolExecutor(max_workers=len(source_paths)) as executor:
+            results = list(
+                executor.map(
+                    encode_segment,
+                    source_paths,
+                    encoded_paths,
+                    [video_args] * len(source_paths),
+                    [
+                        progress.callback_for(index) if progress else None
+                        for index in range(len(source_paths))
+                    ],
+                )
+            )
+        if not all(results):
+            return False
+
+        return concat_segments(
+            encoded_paths,
+            input_path if keep_audio else None,
+            output_path,
+            os.path.join(work_dir, "concat.txt"),
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def split_at_keyframes(
+    input_path: str, work_dir: str, duration: float, count: int
+) -> list[str]:
+    """映像をストリームコピーでcount個程度のセグメントへ分割する
+
+    ストリームコピーの分割は指定時刻以降の最初のキーフレームで行われるため、
+    各セグメントは必ずキーフレームから始まり、単独でデコードできる
+
+    Returns:
+        list[str]: 分割したセグメントのパス（時刻順）。失敗した場合は空のリスト
+    """
+    segment_times = ",".join(
+        f"{duration * index / count:.3f}" for index in range(1, count)
+    )
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-i",
+            input_path,
+            "-map",
+            "0:v:0",
+            "-c",
+            "copy",
+            "-f",
+            "segment",
+            "-segment_times",
+            segment_times,
+            "-segment_format",
+            "mp4",
+            "-reset_timestamps",
+            "1",
+            os.path.join(work_dir, "source_%03d.mp4"),
+        ],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(f"split_at_keyframes関数でffmpegエラーが発生しました: {result.stderr}")
+        return []
+    return sorted(
+        os.path.join(work_dir, file_name)
+        for file_name in os.listdir(work_dir)
+        if file_name.startswith("source_")
+    )
+
+
+def encode_segment(
+    source_path: str, output_path: str, video_args: list[str], progress_callback=None
+) -> bool:
+    """1つのセグメントをエンコードする（音声は連結時に元の動画から多重化する）
+
+    progress_callbackを指定した場合は、このセグメントの進捗をそれへ渡す
+    """
+    result = run_ffmpeg(
+        ["ffmpeg", "-i", source_path, *video_args, "-an", "-f", "mp4", "-y", output_path],
+        progress_callback,
+    )
+    if result.returncode != 0:
+        print(f"encode_segment関数でffmpegエラーが発生しました: {result.stderr}")
+        return False
+    return True
+
+
+def concat_segments(
+    segment_paths: list[str],
+    audio_source_path: str | None,
+    output_path: str,
+    list_file_path: str,
+) -> bool:
+    """エンコード済みのセグメントをconcat demuxerでストリームコピーのまま連結する
+
+    audio_source_pathを指定した場合は、その動画の音声をストリームコピーで多重化する
+    """
+    with open(list_file_path, "w", encoding="utf-8") as f:
+        for segment_path in segment_paths:
+            escaped_path = os.path.abspath(segment_path).replace("'", "'\\''")
+            f.write(f"file '{escaped_path}'\n")
+
+    command = ["ffmpeg", "-f", "concat", "-safe", "0", "-i", list_file_path]
+    if audio_source_path:
+        command += ["-i", audio_source_path, "-map", "0:v", "-map", "1:a?"]
+    command += ["-c", "copy", "-f", "mp4", "-y", output_path]
+
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"concat_segments関数でffmpegエラーが発生しました: {result.stderr}")
+        return False
+    return True
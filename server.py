@@ -1,199 +1,984 @@
+import hashlib
 import os
+import queue
+import re
+import select
+import shutil
 import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 
-from custom_protocol import pack_mmp_message, unpack_mmp_message
-from ffmpeg_function import (
-    change_video_aspect_ratio,
-    compress_video_file,
-    convert_to_mp3file,
-    decode_and_save_video,
-    resize_video_resolution,
-    trim_video_to_gif_webm,
+import metrics
+from admission import (
+    ADMISSION_ADMITTED,
+    ADMISSION_TOO_LARGE,
+    AdmissionController,
 )
+from custom_protocol import (
+    MMPConnectionClosed,
+    MMPSocketReader,
+    MMPSocketWriter,
+    set_mmp_hooks,
+)
+from ffmpeg_function import stream_output_file_name
+from job_worker import TranscodeWorkerPool
+from media_probe import MediaProbeCache, estimate_output_seconds
+from result_cache import ResultCache, make_cache_key
+from striped_upload import MAX_UPLOAD_SIZE, StripedUploadStore, is_valid_upload_id
+from transport import DEFAULT_RECV_BUFFER_BYTES, BufferPool, configure_socket
+from upload_store import UploadStore, is_valid_upload_hash
 
 # 環境変数を読み込む
 load_dotenv()
 
 
+def input_file_extension(media_type: str) -> str:
+    """メディアタイプから入力ファイルの拡張子を作る（パスとして安全な文字だけにする）"""
+    return re.sub(r"[^0-9A-Za-z]", "", media_type)[:16] or "bin"
+
+
+def action_label(json_data: dict) -> str:
+    """メトリクスのラベルに使うaction。複数操作のパイプラインは "pipeline" """
+    operations = json_data.get("operations")
+    if operations:
+        if len(operations) > 1:
+            return "pipeline"
+        json_data = operations[0]
+    return str(json_data.get("action"))
+
+
+# ストリーミング応答で1回に読み込んで送るサイズの上限
+STREAM_CHUNK_BYTES = 1024 * 1024
+
+
+def with_request_id(json_data: dict, request_id) -> dict:
+    """keep-aliveのリクエストに対する応答にrequest_idを付ける（無い場合はそのまま）"""
+    if request_id is not None:
+        json_data["request_id"] = request_id
+    return json_data
+
+
 class Server:
     def __init__(self):
         self.server_running = True
-        # バッファサイズ
-        self.header_bytes: int = int(os.getenv("header_bytes", 8))
+        # 受信バッファサイズ（1回に受信する最小のサイズ）
         self.body_bytes: int = int(os.getenv("body_bytes", 1400))
+        # 受信サイズを増やす上限。接続ごとの受信バッファはこのサイズでプールから使い回す
+        self.recv_buffer_bytes: int = int(
+            os.getenv("recv_buffer_bytes", DEFAULT_RECV_BUFFER_BYTES)
+        )
+        # ソケットのバッファサイズ（0の場合はOSの既定値）とNagleアルゴリズムの無効化
+        self.socket_rcvbuf: int = int(os.getenv("socket_rcvbuf", 0))
+        self.socket_sndbuf: int = int(os.getenv("socket_sndbuf", 0))
+        self.tcp_nodelay: bool = os.getenv("tcp_nodelay", "0") == "1"
         # TCP設定
         self.tcp_port: int = int(os.getenv("port", 8888))
         self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # 再利用許可
         self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # acceptしたソケットはlistenしているソケットの設定を引き継ぐ
+        configure_socket(
+            self.tcp_socket, self.socket_rcvbuf, self.socket_sndbuf, self.tcp_nodelay
+        )
         self.tcp_socket.bind(("0.0.0.0", self.tcp_port))
         # 接続を待機状態
         self.tcp_socket.listen()
+        # 並行処理設定
+        # ffmpeg処理を同時に実行するワーカープロセス数（未設定の場合はCPUコア数）
+        self.max_concurrent_jobs: int = int(
+            os.getenv("max_concurrent_jobs", os.cpu_count() or 1)
+        )
+        # 受信済みでワーカーの空きを待つジョブの最大数
+        self.job_queue_size: int = int(
+            os.getenv("job_queue_size", self.max_concurrent_jobs)
+        )
+        # キューが満杯の場合にビジー応答を返すまで待つ秒数
+        self.job_queue_timeout: float = float(os.getenv("job_queue_timeout", 30))
+        # 同時に受信・送信を行う接続数
+        self.max_connections: int = int(
+            os.getenv("max_connections", self.max_concurrent_jobs + self.job_queue_size)
+        )
+        self.job_slots = threading.BoundedSemaphore(self.max_connections)
+        # 受信が途絶えた接続を切断するまでの秒数（0の場合は待ち続ける）。
+        # 無言で切れた接続がアップロードのハッシュを受信中のまま持ち続けないようにする
+        self.client_timeout: float = float(os.getenv("client_timeout", 60))
+        # keep-aliveの1つの接続で同時に処理するリクエスト数
+        self.max_requests_per_connection: int = int(
+            os.getenv("max_requests_per_connection", 4)
+        )
+        self.executor = ThreadPoolExecutor(max_workers=self.max_connections)
+        self.recv_buffer_pool = BufferPool(self.recv_buffer_bytes, self.max_connections)
+        # 長い動画をキーフレームで分割して並列にエンコードする設定（1の場合は分割しない）
+        self.segment_count: int = int(os.getenv("segment_count", 1))
+        self.segment_min_seconds: float = float(os.getenv("segment_min_seconds", 30))
+        # キューから取り出す順（"sjf"は見積もりコストが小さい順、"fifo"は受信順）と、
+        # sjfでキューで1秒待つごとに見積もりコストから割り引く秒数と、
+        # この秒数以上待ったジョブはコストによらず積んだ順に先に取り出す（待ち時間の上限）
+        self.worker_pool = TranscodeWorkerPool(
+            self.max_concurrent_jobs,
+            self.job_queue_size,
+            os.getenv("job_scheduler", "sjf"),
+            float(os.getenv("job_aging_rate", 0.1)),
+            float(os.getenv("job_max_wait", 600)),
+        )
+        # ジョブごとの作業ディレクトリを作成する親ディレクトリ
+        self.output_dir: str = os.getenv("output_dir", "./output")
+        os.makedirs(self.output_dir, exist_ok=True)
+        # 分割アップロードの受信先（放棄されたアップロードを破棄するまでの秒数）
+        # アップロード全体のサイズで受け入れ、ジョブに渡さずに破棄した場合はここで解放する
+        self.striped_uploads = StripedUploadStore(
+            os.path.join(self.output_dir, "stripes"),
+            float(os.getenv("stripe_timeout", 300)),
+            self.release_admission,
+        )
+        # ボディを受信する前に、ペイロードの合計とディスクの空き容量でジョブを受け入れるか決める
+        self.admission = AdmissionController(
+            self.output_dir,
+            int(os.getenv("admission_max_bytes", 8 * 1024**3)),
+            int(os.getenv("admission_min_free_bytes", 1024**3)),
+            float(os.getenv("admission_timeout", 10)),
+        )
+        # 中断・重複アップロードの保管設定（保持する秒数）
+        self.upload_store = UploadStore(
+            os.getenv("upload_store_dir", "./uploads"),
+            float(os.getenv("upload_ttl", 24 * 60 * 60)),
+        )
+        # 処理結果キャッシュの設定（上限0の場合はキャッシュしない）
+        self.cache_max_bytes: int = int(os.getenv("cache_max_bytes", 10 * 1024**3))
+        self.result_cache = (
+            ResultCache(os.getenv("cache_dir", "./cache"), self.cache_max_bytes)
+            if self.cache_max_bytes > 0
+            else None
+        )
+        # 動画のprobe結果のキャッシュ（保持する件数）
+        self.probe_cache = MediaProbeCache(
+            os.getenv("probe_cache_dir", "./probe_cache"),
+            int(os.getenv("probe_cache_max_entries", 10000)),
+        )
+        # メトリクスを公開するHTTPエンドポイントのポート（0の場合は公開しない）
+        self.metrics_port: int = int(os.getenv("metrics_port", 0))
+        if self.metrics_port > 0:
+            metrics.start_metrics_server(metrics.REGISTRY, self.metrics_port)
+            set_mmp_hooks(
+                lambda payload_size: metrics.MESSAGES_PACKED.inc(),
+                lambda payload_size: metrics.MESSAGES_UNPACKED.inc(),
+            )
 
     def server_start(self):
         """サーバーを起動する"""
         try:
-            print(f"サーバー起動中....: {self.tcp_port}")
+            print(
+                f"サーバー起動中....: {self.tcp_port} "
+                f"(ワーカー数: {self.max_concurrent_jobs}, 同時接続数: {self.max_connections})"
+            )
             while self.server_running:
-                client_socket, client_address = self.tcp_socket.accept()
+                # 空きスロットが無い間はacceptせず、新しい接続はバックログで待機させる
+                self.job_slots.acquire()
+                try:
+                    client_socket, client_address = self.tcp_socket.accept()
+                except BaseException:
+                    self.job_slots.release()
+                    raise
                 print(f"クライアント:{client_address}とのソケットを受け付けました")
-
-                # ヘッダーを取得
-                header_data_bytes = client_socket.recv(self.header_bytes)
-                # ヘッダーから各サイズを取得
-                json_size = int.from_bytes(header_data_bytes[0:2], byteorder="big")
-                media_type_size = int.from_bytes(header_data_bytes[2:3], byteorder="big")
-                payload_size = int.from_bytes(header_data_bytes[3:9], byteorder="big")
-                body_data_size = json_size + media_type_size + payload_size
-
-                # 動画データ受信
-                # 設計として基本的に1400バイトずつ受信する
-                body_data = b""
-                remaining = body_data_size
-                while remaining > 0:
-                    # 効率よく受信するため受信データの残りが設定値より小さい場合そちらを採用
-                    received_data = client_socket.recv(min(remaining, self.body_bytes))
-                    remaining -= len(received_data)
-                    body_data += received_data
-                print(
-                    f"動画データの受信完了しました。動画データのサイズ: {len(body_data)} bytes"
+                # 受信→ffmpeg処理→送信はスレッドプール上で並行して行う
+                self.executor.submit(
+                    self.handle_client,
+                    client_socket,
+                    client_address,
+                    time.perf_counter(),
                 )
 
-                # ボディデータを解析
-                json_data, media_type, payload_data = unpack_mmp_message(
-                    body_data, json_size, media_type_size, payload_size
-                )
+        except KeyboardInterrupt:
+            print("ctrl + c 操作を受け付けました")
+            self.server_running = False
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            self.server_running = False
+        finally:
+            # 処理中のジョブの完了を待たずにTCPサーバーを閉じる
+            self.executor.shutdown(wait=False)
+            self.worker_pool.shutdown()
+            self.tcp_socket.close()
+
+    def handle_client(
+        self,
+        client_socket: socket.socket,
+        client_address,
+        accepted_at: float | None = None,
+    ):
+        """1つの接続についてリクエストの受信→ffmpeg処理→送信を行う
+
+        スレッドプール上で実行される。ジョブごとに専用の作業ディレクトリを作成するため、
+        同時に複数のジョブを処理してもファイルパスが衝突しない。
+        JSONデータのkeep_aliveがtrueのリクエストは、受信を終えた時点で別スレッドに処理を任せて
+        同じ接続で次のリクエストを受信する。応答はrequest_idを付けて処理が終わった順に返すため、
+        音声抽出のような小さいジョブが大きい圧縮ジョブの後ろで待たされない。
+        keep_aliveが無いリクエストは従来どおり1回の応答で接続を閉じる。
+        ボディを受信する前にadmit()でペイロードのサイズを確認し、受け入れの上限を超える間は待たせるか
+        ビジー応答を返すため、大きなアップロードが重なってもディスクを使い切らない。
+        各段階の所要時間はmetricsのmmp_request_phase_secondsに記録する
+        """
+        if accepted_at is not None:
+            # acceptしてからスレッドプールで処理が始まるまでの時間
+            metrics.PHASE_SECONDS.observe(
+                time.perf_counter() - accepted_at, phase="accept"
+            )
+        metrics.CONNECTIONS_IN_FLIGHT.inc()
+        client_socket.settimeout(self.client_timeout or None)
+        reader = MMPSocketReader(client_socket, self.body_bytes, self.recv_buffer_pool)
+        # 応答は複数のスレッドから送るため、メッセージ単位で排他して送信する
+        writer = MMPSocketWriter(client_socket)
+        # 1つの接続で同時に処理するリクエスト数の上限
+        request_slots = threading.BoundedSemaphore(self.max_requests_per_connection)
+        request_threads: list[threading.Thread] = []
+        idle = False
+        try:
+            while True:
+                try:
+                    # keep-aliveで次のリクエストを待っている時間はヘッダー受信に含めない
+                    if idle:
+                        json_data, media_type, payload_size = reader.read_prefix()
+                    else:
+                        with metrics.PHASE_SECONDS.time(phase="header_read"):
+                            json_data, media_type, payload_size = reader.read_prefix()
+                except MMPConnectionClosed:
+                    break
+                except TimeoutError:
+                    # メッセージの途中で途絶えた場合は切断する
+                    if not reader.parser.at_message_boundary():
+                        raise
+                    # 次のリクエストを待っている間は、処理中のリクエストがあれば待ち続ける
+                    if any(thread.is_alive() for thread in request_threads):
+                        continue
+                    print(
+                        f"クライアント:{client_address}からの受信が無いため接続を閉じます"
+                    )
+                    break
+                # 事前確認の場合は、アップロードの状態を返してから続くジョブを受信する
+                if json_data.get("action") == "preflight":
+                    reader.read_payload()
+                    self.handle_preflight(writer, json_data)
+                    idle = False
+                    continue
+                # 分割アップロードの範囲の場合は、受信して応答を返してから次のメッセージを待つ
+                if json_data.get("action") == "stripe":
+                    self.handle_stripe(reader, writer, json_data, payload_size)
+                    idle = True
+                    continue
                 # デバッグ
                 print(f"json_data: {json_data}")
                 print(f"media_type: {media_type}")
-                print(f"payload_data: {len(payload_data)}")
 
-                # 動画データを確認して問題が無ければ、ffmpegを使用してバイナリデータから動画ファイルに変換して保存する
-                if not payload_data:
-                    print(
-                        f"動画データが存在していません。クライアント:{client_address}とのソケットを閉じます"
+                if not json_data.get("keep_alive"):
+                    if self.admit(reader, writer, json_data, payload_size):
+                        request = self.receive_admitted_request(
+                            reader, json_data, media_type, payload_size
+                        )
+                        self.process_request(writer, request, client_address)
+                    break
+
+                # 処理中のリクエストが上限に達している間は次のペイロードを受信しない
+                request_slots.acquire()
+                try:
+                    if not self.admit(reader, writer, json_data, payload_size):
+                        request_slots.release()
+                        idle = True
+                        continue
+                    request = self.receive_admitted_request(
+                        reader, json_data, media_type, payload_size
+                    )
+                except BaseException:
+                    request_slots.release()
+                    raise
+                thread = threading.Thread(
+                    target=self.process_request,
+                    args=(writer, request, client_address, request_slots),
+                    daemon=True,
+                )
+                thread.start()
+                request_threads.append(thread)
+                idle = True
+
+        except Exception as e:
+            print(f"クライアント:{client_address}の処理中にエラーが発生しました: {e}")
+        finally:
+            # 処理中のリクエストの応答を送り終えてから接続を閉じる
+            for thread in request_threads:
+                thread.join()
+            print("ソケットを閉じます")
+            client_socket.close()
+            reader.close()
+            metrics.CONNECTIONS_IN_FLIGHT.dec()
+            self.job_slots.release()
+
+    def admit(
+        self,
+        reader: MMPSocketReader,
+        writer: MMPSocketWriter,
+        json_data: dict,
+        payload_size: int,
+    ) -> bool:
+        """ヘッダーのペイロードサイズでジョブを受け入れるか決める
+
+        受け入れない場合は、ボディを受信する前にビジー応答（上限を超えるサイズの場合は
+        エラー応答）を返し、届くペイロードはディスクに書かずに読み捨てる。
+        受け入れた場合は、処理が終わったらrelease_admission()を呼ぶ
+
+        Returns:
+            bool: 受け入れた場合はTrue
+        """
+        # 放棄された分割アップロードが受け入れの上限を使い続けないよう、待つ前に破棄して解放する
+        self.striped_uploads.expire()
+        with metrics.PHASE_SECONDS.time(phase="admission"):
+            admission = self.admission.acquire(payload_size)
+        if admission == ADMISSION_ADMITTED:
+            metrics.ADMITTED_BYTES.set(self.admission.admitted_bytes)
+            return True
+        self.reject_admission(reader, writer, json_data, admission, payload_size)
+        return False
+
+    def reject_admission(
+        self,
+        reader: MMPSocketReader,
+        writer: MMPSocketWriter,
+        json_data: dict,
+        admission: str,
+        payload_size: int,
+    ):
+        """受け入れなかったリクエストにビジー応答かエラー応答を返し、ペイロードを読み捨てる"""
+        if admission == ADMISSION_TOO_LARGE:
+            print(f"ペイロードが受け入れの上限を超えています: {payload_size} bytes")
+            response_json_data = {
+                "status_id": "400",
+                "message": "ファイルサイズがサーバーの上限を超えています。",
+                "solution": "ファイルを小さくして再度送信してください。",
+            }
+        else:
+            print(
+                f"受け入れの上限に達しているためビジー応答を返します: {payload_size} bytes"
+            )
+            response_json_data = {
+                "status_id": "503",
+                "message": "サーバーが混雑しています。",
+                "solution": "時間をおいて再度送信してください。",
+            }
+        writer.send_message(
+            with_request_id(response_json_data, json_data.get("request_id")), "0"
+        )
+        metrics.REQUESTS.inc(status=admission)
+        # 同じ接続で次のメッセージを読めるよう、ペイロードは最後まで読み捨てる
+        for _ in reader.iter_payload():
+            pass
+
+    def release_admission(self, payload_size: int):
+        """admit()で受け入れたペイロードの分を解放する"""
+        self.admission.release(payload_size)
+        metrics.ADMITTED_BYTES.set(self.admission.admitted_bytes)
+
+    def receive_admitted_request(
+        self,
+        reader: MMPSocketReader,
+        json_data: dict,
+        media_type: str,
+        payload_size: int,
+    ) -> dict:
+        """受け入れたリクエストを受信する。受信に失敗した場合は受け入れた分を解放する"""
+        try:
+            request = self.receive_request(reader, json_data, media_type, payload_size)
+        except BaseException:
+            self.release_admission(payload_size)
+            raise
+        request["admitted_bytes"] = payload_size + request.pop("upload_admitted_bytes")
+        return request
+
+    def receive_request(
+        self,
+        reader: MMPSocketReader,
+        json_data: dict,
+        media_type: str,
+        payload_size: int,
+    ) -> dict:
+        """リクエストのペイロードをジョブ専用の作業ディレクトリへ受信する
+
+        受信中にエラーが発生した場合は作業ディレクトリを削除して例外を送出する
+
+        Returns:
+            dict: json_data, media_type, workspace_dir, spool_file_path,
+                payload_digest（受信したペイロードのハッシュ）, received_size,
+                retry_later（途中からのペイロードを再開に使えないか、分割アップロードの範囲が
+                揃っておらず、再送が必要な場合にTrue）,
+                upload_admitted_bytes（分割アップロードを受け入れたバイト数）を持つリクエスト
+        """
+        workspace_dir = tempfile.mkdtemp(prefix="job_", dir=self.output_dir)
+        upload_admitted_bytes = 0
+        try:
+            # ペイロードはメモリに溜めずにジョブの入力ファイルへ直接書き込む
+            spool_file_path = os.path.join(
+                workspace_dir, f"input.{input_file_extension(media_type)}"
+            )
+            receive_start = time.perf_counter()
+            write_seconds_before = reader.write_seconds
+            upload_hash = json_data.get("upload_hash")
+            upload_offset = int(json_data.get("upload_offset", 0))
+            retry_later = False
+            if is_valid_upload_id(json_data.get("upload_id")):
+                # 分割アップロードはstripeのメッセージで受信済みの範囲を入力ファイルにする
+                payload_digest, upload_admitted_bytes = self.receive_striped_upload(
+                    reader, json_data, spool_file_path
+                )
+                # 範囲が断られたか期限切れで破棄されて揃わなかった場合は、送り直してもらう
+                retry_later = not payload_digest
+            elif is_valid_upload_hash(upload_hash) and self.upload_store.begin(
+                upload_hash
+            ):
+                # コンテンツハッシュ付きのアップロードは保管場所へ書き込み、途中で切れても再開できるようにする
+                try:
+                    payload_digest = self.receive_resumable_upload(
+                        reader, json_data, spool_file_path
+                    )
+                finally:
+                    self.upload_store.end(upload_hash)
+                if payload_digest is None:
+                    retry_later = True
+                    payload_digest = ""
+            elif upload_offset > 0:
+                # 途中から後ろだけが届いたが、同じハッシュを別の接続が受信中のため
+                # 受信途中のファイルに続けられない。末尾だけを入力として処理しないよう読み捨てる
+                print(f"同じアップロードを別の接続が受信中です: {upload_hash}")
+                for _ in reader.iter_payload():
+                    pass
+                retry_later = True
+                payload_digest = ""
+            else:
+                # 結果キャッシュのキーに使うハッシュは受信しながら計算する
+                payload_hash = hashlib.sha256()
+                reader.read_payload_to_file(spool_file_path, payload_hash.update)
+                payload_digest = payload_hash.hexdigest()
+            received_size = os.path.getsize(spool_file_path) if payload_digest else 0
+            # ボディ受信の時間は一時ファイルへの書き込み時間を除いて記録する
+            write_seconds = reader.write_seconds - write_seconds_before
+            metrics.PHASE_SECONDS.observe(
+                time.perf_counter() - receive_start - write_seconds,
+                phase="body_receive",
+            )
+            metrics.PHASE_SECONDS.observe(write_seconds, phase="temp_write")
+            metrics.RECEIVED_BYTES.inc(payload_size)
+            print(
+                f"動画データの受信完了しました。動画データのサイズ: {received_size} bytes"
+            )
+        except BaseException:
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+            if upload_admitted_bytes:
+                self.release_admission(upload_admitted_bytes)
+            raise
+        return {
+            "json_data": json_data,
+            "media_type": media_type,
+            "workspace_dir": workspace_dir,
+            "spool_file_path": spool_file_path,
+            "payload_digest": payload_digest,
+            "received_size": received_size,
+            "retry_later": retry_later,
+            "upload_admitted_bytes": upload_admitted_bytes,
+        }
+
+    def process_request(
+        self,
+        writer: MMPSocketWriter,
+        request: dict,
+        client_address,
+        request_slots: threading.BoundedSemaphore | None = None,
+    ):
+        """受信済みのリクエストをffmpegで処理して応答を送り、作業ディレクトリを削除する
+
+        request_slotsを指定した場合は、処理が終わった時点で1つ解放する
+        """
+        json_data = request["json_data"]
+        media_type = request["media_type"]
+        workspace_dir = request["workspace_dir"]
+        spool_file_path = request["spool_file_path"]
+        payload_digest = request["payload_digest"]
+        # keep-aliveの接続では応答がどのリクエストに対するものかをrequest_idで示す
+        request_id = json_data.get("request_id")
+        request_status = "error"
+        stream_fd = None
+        try:
+            if request["retry_later"]:
+                # 再開に使えないペイロードか、揃っていない分割アップロードだったため、
+                # 送信からやり直してもらう
+                writer.send_message(
+                    with_request_id(
+                        {
+                            "status_id": "503",
+                            "message": "アップロードを完了できませんでした。",
+                            "solution": "時間をおいて再度送信してください。",
+                        },
+                        request_id,
+                    ),
+                    "0",
+                )
+                request_status = "busy"
+                return
+
+            # 動画データを確認して問題が無ければ処理する
+            if request["received_size"] == 0:
+                print(f"動画データが存在していません。クライアント:{client_address}")
+                writer.send_message(
+                    with_request_id(
+                        {
+                            "status_id": "400",
+                            "message": "動画データを受信できませんでした。",
+                            "solution": "ファイルを確認して再度送信してください。",
+                        },
+                        request_id,
+                    ),
+                    "0",
+                )
+                request_status = "empty"
+                return
+
+            # 同じ動画を同じ設定で処理した結果があればffmpegを実行せずに返す
+            cache_key = make_cache_key(payload_digest, json_data, media_type)
+            uploaded_processed_file_path = (
+                self.result_cache.get(cache_key, workspace_dir)
+                if self.result_cache
+                else None
+            )
+            if uploaded_processed_file_path:
+                print(f"キャッシュされた処理結果を返します: {self.result_cache.stats()}")
+                status = "success"
+            else:
+                # 動画の情報はコンテンツハッシュごとにキャッシュされ、再送信時はprobeしない
+                media_info = self.probe_cache.get(payload_digest, spool_file_path)
+                progress_queue = self.worker_pool.create_progress_queue()
+                job = {
+                    "json_data": json_data,
+                    "media_type": media_type,
+                    "spool_file_path": spool_file_path,
+                    "workspace_dir": workspace_dir,
+                    "segment_count": self.segment_count,
+                    "segment_min_seconds": self.segment_min_seconds,
+                    "media_info": media_info,
+                    "progress_queue": progress_queue,
+                }
+                # ストリーミング応答の場合、ffmpegは名前付きパイプへ書き出し、
+                # サーバーはそこから読みながら送信する（名前付きパイプが無い環境では通常の応答）
+                stream_file_name = (
+                    stream_output_file_name(json_data)
+                    if json_data.get("stream") and hasattr(os, "mkfifo")
+                    else None
+                )
+                if stream_file_name:
+                    job["stream_path"] = os.path.join(
+                        workspace_dir, f"stream_{stream_file_name}"
                     )
-                    client_socket.close()
+                    os.mkfifo(job["stream_path"])
+                    # 書き込み側より先に開いておき、ffmpegが開く前に失敗しても待ち続けないようにする
+                    stream_fd = os.open(job["stream_path"], os.O_RDONLY | os.O_NONBLOCK)
+                # 受信が完了したジョブをワーカーのキューに積む
+                future = self.worker_pool.submit(job, self.job_queue_timeout)
+                if future is None:
+                    status = "busy"
                 else:
-                    uploaded_file_path: str = "./output/output.mp4"
-                    if decode_and_save_video(payload_data, uploaded_file_path):
-                        # 動画ファイルに対する処理内容を確認して処理する
-                        if json_data.get("action") == "1":
-                            # 動画ファイルの自動圧縮
-                            uploaded_processed_file_path = (
-                                "./output/output_compressed.mp4"
-                            )
-                            if compress_video_file(
-                                uploaded_file_path,
-                                json_data.get("quality"),
-                                uploaded_processed_file_path,
-                            ):
-                                status = "success"
-                            else:
-                                status = "failure"
-                        elif json_data.get("action") == "2":
-                            # 動画の解像度変更
-                            uploaded_processed_file_path = "./output/output_resized.mp4"
-                            if resize_video_resolution(
-                                uploaded_file_path,
-                                json_data.get("resolution"),
-                                uploaded_processed_file_path,
-                            ):
-                                status = "success"
-                            else:
-                                status = "failure"
-                        elif json_data.get("action") == "3":
-                            # 動画のアスペクト比変更
-                            uploaded_processed_file_path = (
-                                "./output/output_aspect_ratio.mp4"
+                    metrics.JOBS_IN_FLIGHT.inc()
+                    try:
+                        if stream_fd is not None:
+                            uploaded_processed_file_path = os.path.join(
+                                workspace_dir, stream_file_name
                             )
-                            if change_video_aspect_ratio(
-                                uploaded_file_path,
-                                json_data.get("aspect_ratio"),
-                                uploaded_processed_file_path,
-                                json_data.get("fit_mode"),
-                            ):
-                                status = "success"
-                            else:
-                                status = "failure"
-                        elif json_data.get("action") == "4":
-                            # mp4ファイルをmp3ファイルに変換
-                            uploaded_processed_file_path = "./output/output.mp3"
-                            if convert_to_mp3file(
-                                uploaded_file_path,
+                            result = self.stream_job_output(
+                                writer,
+                                future,
+                                progress_queue,
+                                stream_fd,
                                 uploaded_processed_file_path,
                                 media_type,
-                            ):
-                                status = "success"
-                            else:
-                                status = "failure"
-                        elif json_data.get("action") == "5":
-                            # 動画を切り取る
-                            uploaded_processed_file_path = (
-                                "./output/output_trimmed.gif"
-                                if json_data.get("trim") == "gif"
-                                else "./output/output_trimmed.webm"
+                                request_id,
                             )
-                            if trim_video_to_gif_webm(
-                                uploaded_file_path,
-                                json_data.get("start_time"),
-                                json_data.get("duration"),
-                                uploaded_processed_file_path,
-                                json_data.get("trim"),
-                            ):
-                                status = "success"
-                            else:
-                                status = "failure"
-
-                # レスポンスを返す
-                # 動画データ
-                if status == "success":
-                    with open(uploaded_processed_file_path, "rb") as f:
-                        response_file_data = f.read()
-                    # ファイルタイプデータ
-                    response_file_type = media_type
-                    # jsonデータ
+                        else:
+                            result = self.wait_for_job(
+                                writer,
+                                future,
+                                progress_queue,
+                                estimate_output_seconds(json_data, media_info),
+                                request_id,
+                            )
+                            uploaded_processed_file_path = result["output_path"]
+                    finally:
+                        metrics.JOBS_IN_FLIGHT.dec()
+                    self.record_job_metrics(json_data, result)
+                    status = result["status"]
+                    if status == "success" and self.result_cache:
+                        self.result_cache.put(cache_key, uploaded_processed_file_path)
+
+            # レスポンスを返す
+            response_start = time.perf_counter()
+            if status == "success" and stream_fd is not None:
+                # ストリーミング応答の終わりを示すメッセージ（ペイロードは無い）
+                writer.send_message(
+                    with_request_id(
+                        {
+                            "status_id": "200",
+                            "file_name": os.path.basename(uploaded_processed_file_path),
+                            "stream": "end",
+                            "stream_size": result["stream_size"],
+                        },
+                        request_id,
+                    ),
+                    media_type,
+                )
+            elif status == "success":
+                # 処理後のファイルはメモリに読み込まずsendfileで送信する
+                sent_size = writer.send_file(
+                    with_request_id(
+                        {
+                            "status_id": "200",
+                            "file_name": os.path.basename(uploaded_processed_file_path),
+                        },
+                        request_id,
+                    ),
+                    media_type,
+                    uploaded_processed_file_path,
+                )
+                metrics.SENT_BYTES.inc(sent_size)
+            else:
+                if status == "busy":
+                    print("ジョブキューが満杯のためビジー応答を返します")
                     response_json_data = {
-                        "status_id": "200",
-                        "file_name": uploaded_processed_file_path.split("/")[-1],
+                        "status_id": "503",
+                        "message": "サーバーが混雑しています。",
+                        "solution": "時間をおいて再度送信してください。",
                     }
-                elif status == "failure":
-                    response_file_data = b""
-                    response_file_type = "0"
+                else:
                     response_json_data = {
                         "status_id": "400",
                         "message": "エラーが発生しました。以下の解決方法を参考にしてください。",
                         "solution": "動画データを確認してください。設定値を確認してください。",
                     }
-
-                # レスポンスデータのヘッダーとボディデータを作成
-                response_data = pack_mmp_message(
-                    response_json_data, response_file_type, response_file_data
-                )
+                if stream_fd is not None:
+                    # 途中まで送ったストリーミング応答は破棄させる
+                    response_json_data["stream"] = "end"
                 # レスポンスデータを送信
-                client_socket.sendall(response_data)
-                print("レスポンスを返しました")
-                print("ソケットを閉じます")
-                client_socket.close()
-
-                # サーバーに一時動画したファイルを削除する
-                if os.path.exists(uploaded_file_path):
-                    os.remove(uploaded_file_path)
-                if os.path.exists(uploaded_processed_file_path):
-                    os.remove(uploaded_processed_file_path)
-                print("動画ファイルを削除しました")
+                writer.send_message(with_request_id(response_json_data, request_id), "0")
+            metrics.PHASE_SECONDS.observe(
+                time.perf_counter() - response_start, phase="response_send"
+            )
+            request_status = status
+            print("レスポンスを返しました")
 
-        except KeyboardInterrupt:
-            print("ctrl + c 操作を受け付けました")
-            self.server_running = False
         except Exception as e:
-            print(f"エラーが発生しました: {e}")
-            self.server_running = False
+            print(f"クライアント:{client_address}の処理中にエラーが発生しました: {e}")
         finally:
-            # TCPサーバー閉じる
-            self.tcp_socket.close()
+            cleanup_start = time.perf_counter()
+            if stream_fd is not None:
+                # 読み込み側を閉じると、処理中のffmpegは書き込みに失敗して終了する
+                os.close(stream_fd)
+            # サーバーに一時保存した動画ファイルを作業ディレクトリごと削除する
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+            print("動画ファイルを削除しました")
+            metrics.PHASE_SECONDS.observe(
+                time.perf_counter() - cleanup_start, phase="cleanup"
+            )
+            metrics.REQUESTS.inc(status=request_status)
+            if "admitted_bytes" in request:
+                self.release_admission(request["admitted_bytes"])
+            if request_slots is not None:
+                request_slots.release()
+
+    def wait_for_job(
+        self,
+        writer: MMPSocketWriter | None,
+        future,
+        progress_queue,
+        total_seconds: float | None,
+        request_id=None,
+    ) -> dict:
+        """ジョブの完了を待ちながら、ffmpegの進捗を途中経過のMMPメッセージとしてクライアントへ送る
+
+        途中経過は status_id "102" のメッセージで、progressに frame / fps / out_time / speed と
+        処理結果の長さの見積もり total_seconds を含む。送信に失敗した場合も処理は続ける
+
+        Returns:
+            dict: ジョブの処理結果
+        """
+        last_progress = None
+        while not future.done():
+            try:
+                progress = progress_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            last_progress = progress
+            if writer is None:
+                continue
+            try:
+                writer.send_message(
+                    with_request_id(
+                        {
+                            "status_id": "102",
+                            "progress": {**progress, "total_seconds": total_seconds},
+                        },
+                        request_id,
+                    ),
+                    "0",
+                )
+            except OSError as e:
+                print(f"進捗を送信できませんでした: {e}")
+                writer = None
+
+        # ジョブの完了と入れ違いに届いた進捗は送らずに最終値としてだけ使う
+        while True:
+            try:
+                last_progress = progress_queue.get_nowait()
+            except queue.Empty:
+                break
+
+        result = future.result()
+        if last_progress and last_progress.get("speed"):
+            # 実時間に対する処理速度（ジョブごとの処理能力の見積もりに使う）
+            print(f"ジョブの処理速度: x{last_progress['speed']:.2f}")
+            result = {**result, "speed": last_progress["speed"]}
+        return result
+
+    def stream_job_output(
+        self,
+        writer: MMPSocketWriter,
+        future,
+        progress_queue,
+        stream_fd: int,
+        output_path: str,
+        media_type: str,
+        request_id=None,
+    ) -> dict:
+        """ffmpegが名前付きパイプへ書き出した処理結果を、届いた順にチャンクのMMPメッセージで送る
+
+        チャンクは status_id "206" のメッセージで、ペイロードに処理結果の続きを含む。
+        MMPのヘッダーには全体のサイズを書けないため、終わりは呼び出し元が送る
+        status_id "200"（stream: "end"）のメッセージで示す。
+        送ったデータは結果キャッシュに登録できるようoutput_pathにも書き込む
+
+        Returns:
+            dict: ジョブの処理結果。stream_sizeに送ったバイト数を含む
+        """
+        file_name = os.path.basename(output_path)
+        started_at = time.perf_counter()
+        stream_size = 0
+        last_progress = None
+        with open(output_path, "wb") as f:
+            while True:
+                readable, _, _ = select.select([stream_fd], [], [], 0.5)
+                data = b""
+                if readable:
+                    try:
+                        data = os.read(stream_fd, STREAM_CHUNK_BYTES)
+                    except BlockingIOError:
+                        pass
+                while True:
+                    try:
+                        last_progress = progress_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if data:
+                    if stream_size == 0:
+                        metrics.PHASE_SECONDS.observe(
+                            time.perf_counter() - started_at, phase="first_chunk"
+                        )
+                    writer.send_message(
+                        with_request_id(
+                            {
+                                "status_id": "206",
+                                "file_name": file_name,
+                                "stream": "chunk",
+                            },
+                            request_id,
+                        ),
+                        media_type,
+                        data,
+                    )
+                    f.write(data)
+                    stream_size += len(data)
+                elif future.done():
+                    # ffmpegは終了しているため、読み込みが0バイトならすべて送り終えている
+                    break
+                elif readable:
+                    # 書き込み側が開かれる前と閉じた後は、読み込みがすぐに0バイトで戻るため少し待つ
+                    time.sleep(0.05)
+        metrics.SENT_BYTES.inc(stream_size)
+
+        result = {**future.result(), "stream_size": stream_size}
+        if last_progress and last_progress.get("speed"):
+            print(f"ジョブの処理速度: x{last_progress['speed']:.2f}")
+            result["speed"] = last_progress["speed"]
+        print(f"ストリーミング応答を送信しました: {stream_size} bytes")
+        return result
+
+    @staticmethod
+    def record_job_metrics(json_data: dict, result: dict):
+        """ジョブのキュー待ち時間（全体と見積もりコストの分類ごと）、ffmpegの処理時間と速度、
+        失敗回数を記録する"""
+        action = action_label(json_data)
+        metrics.PHASE_SECONDS.observe(
+            result.get("queue_seconds", 0.0), phase="queue_wait"
+        )
+        metrics.QUEUE_WAIT_SECONDS.observe(
+            result.get("queue_seconds", 0.0), job_class=result.get("job_class", "unknown")
+        )
+        metrics.PHASE_SECONDS.observe(result.get("run_seconds", 0.0), phase="ffmpeg")
+        metrics.FFMPEG_SECONDS.observe(result.get("run_seconds", 0.0), action=action)
+        if result.get("speed"):
+            metrics.FFMPEG_SPEED.observe(result["speed"], action=action)
+        if result["status"] != "success":
+            metrics.FFMPEG_FAILURES.inc(action=action)
+
+    def handle_preflight(self, writer: MMPSocketWriter, json_data: dict):
+        """アップロード前の事前確認に応答する
+
+        クライアントが送ったコンテンツハッシュとサイズから、保管済み（送信不要）、
+        途中まで受信済み（オフセットから再開）、未受信（すべて送信）のいずれかを返す
+        """
+        upload_hash = json_data.get("upload_hash")
+        upload_size = int(json_data.get("upload_size", 0))
+        if is_valid_upload_hash(upload_hash):
+            upload_status, upload_offset = self.upload_store.lookup(
+                upload_hash, upload_size
+            )
+        else:
+            upload_status, upload_offset = "none", 0
+        print(f"事前確認: {upload_status} (オフセット: {upload_offset})")
+        writer.send_message(
+            with_request_id(
+                {
+                    "status_id": "200",
+                    "upload_status": upload_status,
+                    "upload_offset": upload_offset,
+                },
+                json_data.get("request_id"),
+            ),
+            "0",
+        )
+
+    def receive_resumable_upload(
+        self, reader: MMPSocketReader, json_data: dict, spool_file_path: str
+    ) -> str | None:
+        """コンテンツハッシュ付きのアップロードを保管場所に受信して作業ディレクトリへ取り出す
+
+        ペイロードは upload_offset から後ろの部分で、受信途中のファイルに追記する。
+        受信中に接続が切れた場合も受信済みの部分は保管場所に残る
+
+        Returns:
+            str | None: 検証済みのハッシュ。検証に失敗した場合は空文字列。
+                受信途中のファイルがupload_offsetより短い（期限切れなど）場合はNone
+        """
+        upload_hash = json_data["upload_hash"]
+        upload_size = int(json_data.get("upload_size", 0))
+        upload_offset = int(json_data.get("upload_offset", 0))
+
+        if not os.path.exists(self.upload_store.complete_path(upload_hash)):
+            try:
+                f, hasher = self.upload_store.open_part(upload_hash, upload_offset)
+            except ValueError as e:
+                print(e)
+                for _ in reader.iter_payload():
+                    pass
+                return None
+            with f:
+                reader.read_payload_into(f, hasher.update)
+            if not self.upload_store.complete(
+                upload_hash, upload_size, hasher.hexdigest()
+            ):
+                return ""
+        else:
+            # 保管済みの場合はペイロードは送られてこないが、送られてきた場合は読み捨てる
+            for _ in reader.iter_payload():
+                pass
+
+        self.upload_store.link_to(upload_hash, spool_file_path)
+        return upload_hash
+
+    def handle_stripe(
+        self,
+        reader: MMPSocketReader,
+        writer: MMPSocketWriter,
+        json_data: dict,
+        payload_size: int,
+    ):
+        """分割アップロードの1つの範囲を受信し、受信したバイト数を返す
+
+        範囲はジョブのリクエストを送った接続とは別の接続で届き、
+        最終サイズで確保したファイルのstripe_offsetの位置へ書き込む。
+        受け入れ制御はアップロードIDごとに、最初の範囲が届いたときにアップロード全体のサイズで
+        1回だけ行い、ジョブの処理が終わるか、アップロードを破棄するまで解放しない
+        """
+        upload_id = json_data.get("upload_id")
+        if not is_valid_upload_id(upload_id):
+            raise ValueError(f"不正なupload_id: {upload_id}")
+        upload_size = int(json_data.get("upload_size", 0))
+        stripe_offset = int(json_data.get("stripe_offset", 0))
+        if not 0 < upload_size <= MAX_UPLOAD_SIZE:
+            # 領域を確保する前に、プロトコルの上限を超えるサイズを断る
+            self.reject_admission(
+                reader, writer, json_data, ADMISSION_TOO_LARGE, upload_size
+            )
+            return
+        if stripe_offset < 0 or stripe_offset + payload_size > upload_size:
+            raise ValueError(
+                f"不正な範囲です: {stripe_offset} + {payload_size} / {upload_size}"
+            )
+        # 作成を引き受けた接続だけが受け入れを待ち、同じアップロードの他の範囲は作成を待つ
+        if self.striped_uploads.reserve(upload_id):
+            try:
+                admitted = self.admit(reader, writer, json_data, upload_size)
+            except BaseException:
+                self.striped_uploads.cancel_create(upload_id)
+                raise
+            if not admitted:
+                self.striped_uploads.cancel_create(upload_id)
+                return
+            try:
+                self.striped_uploads.create(upload_id, upload_size)
+            except BaseException:
+                self.release_admission(upload_size)
+                raise
+        received_size = self.striped_uploads.receive_range(
+            upload_id, upload_size, stripe_offset, payload_size, reader
+        )
+        metrics.RECEIVED_BYTES.inc(received_size)
+        writer.send_message(
+            with_request_id(
+                {"status_id": "200", "received_size": received_size},
+                json_data.get("request_id"),
+            ),
+            "0",
+        )
+
+    def receive_striped_upload(
+        self,
+        reader: MMPSocketReader,
+        json_data: dict,
+        spool_file_path: str,
+    ) -> tuple[str, int]:
+        """すべての範囲が揃った分割アップロードを入力ファイルとして作業ディレクトリへ移動する
+
+        クライアントはすべての範囲をstripeのメッセージで送り終えてから、ペイロードの無い
+        ジョブのリクエストを送る。ジョブの接続で他の接続の範囲を待つと、接続数の上限に
+        達したときに範囲を送る接続を受け付けられず止まってしまうため、揃っていない場合は待たずに失敗させる。
+        ペイロードが付いている場合は読み捨てる
+
+        Returns:
+            tuple[str, int]: 結果キャッシュのキーに使うハッシュと、アップロードを受け入れたバイト数
+                （ジョブの処理が終わったら解放する）。範囲が揃っていない場合は ("", 0)
+        """
+        for _ in reader.iter_payload():
+            pass
+        upload_id = json_data["upload_id"]
+        payload_digest = self.striped_uploads.complete_digest(upload_id)
+        if not payload_digest:
+            self.striped_uploads.discard(upload_id)
+            return "", 0
+        return payload_digest, self.striped_uploads.take(upload_id, spool_file_path)
 
     def response_data(self, _client_socket):
         """レスポンスを返す
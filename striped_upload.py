@@ -0,0 +1,242 @@
+import hashlib
+import os
+import re
+import threading
+import time
+
+"""
+分割アップロードの受信
+クライアントは1つのファイルをバイト範囲（ストライプ）に分け、同じアップロードIDで複数の接続から並行して送ります。
+サーバーはアップロードIDごとに最終サイズで確保したファイルを用意し、各接続が受信した範囲を
+os.pwriteでそれぞれのオフセットへ書き込みます。すべての範囲が揃った時点でジョブの入力ファイルになります。
+"""
+
+# アップロードIDは32桁の16進数（uuid4().hex）のみを受け付ける（パスとして安全な文字だけにする）
+UPLOAD_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+# 分割アップロードで受け付ける最大サイズ（クライアントが送信できるファイルの上限と同じ4GB）
+MAX_UPLOAD_SIZE = 4 * 1024 * 1024 * 1024
+
+
+def is_valid_upload_id(upload_id) -> bool:
+    """分割アップロードのIDとして使える文字列かどうか"""
+    return isinstance(upload_id, str) and bool(UPLOAD_ID_PATTERN.match(upload_id))
+
+
+def combine_stripe_digests(ranges: dict[int, tuple[int, str]]) -> str:
+    """ストライプごとのハッシュから、結果キャッシュのキーに使うハッシュを作る
+
+    ファイル全体を読み直さずに済むよう、各範囲を受信しながら計算したSHA-256を
+    オフセット順につなげてハッシュする。同じファイルでも分割の仕方が違えば別の値になるが、
+    異なる内容が同じ値になることはない
+    """
+    hasher = hashlib.sha256(b"striped")
+    for offset in sorted(ranges):
+        length, digest = ranges[offset]
+        hasher.update(f"{offset}:{length}:{digest};".encode("ascii"))
+    return hasher.hexdigest()
+
+
+class StripedUpload:
+    """1つの分割アップロード（最終サイズで確保したファイルと受信済みの範囲）"""
+
+    def __init__(self, file_path: str, upload_size: int):
+        self.file_path = file_path
+        self.upload_size = upload_size
+        self.fd = os.open(file_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        # 書き込み中に容量不足にならないよう、最終サイズの領域を先に確保する
+        try:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(self.fd, 0, upload_size)
+            else:
+                os.ftruncate(self.fd, upload_size)
+        except OSError:
+            os.close(self.fd)
+            os.remove(file_path)
+            raise
+        # 受信を終えた範囲（オフセット -> (長さ, SHA-256)）
+        self.ranges: dict[int, tuple[int, str]] = {}
+        # 受信中の接続数。受信中のアップロードは期限切れにしない
+        self.writers = 0
+        self.updated_at = time.monotonic()
+
+    def is_complete(self) -> bool:
+        """受信済みの範囲がファイル全体を隙間なく覆っているかどうか"""
+        position = 0
+        for offset in sorted(self.ranges):
+            if offset > position:
+                return False
+            position = max(position, offset + self.ranges[offset][0])
+        return position >= self.upload_size
+
+
+class StripedUploadStore:
+    """アップロードIDごとの分割アップロードを管理する
+
+    クライアントはすべての範囲の受信応答を受け取ってからジョブのリクエストを送るため、
+    ジョブのリクエストを受けた接続は complete_digest() で揃っていることを確認して
+    take() で入力ファイルを受け取る。ジョブの接続が他の接続の範囲を待つことは無いので、
+    接続数の上限に達していても互いに待ち合って止まることはない。
+    アップロードは最初の範囲が届いたときに reserve() で作成する役を1つの接続だけが引き受け、
+    create() でファイル全体の領域を確保する。同じアップロードの他の範囲は作成が終わるまで待つ。
+    take() せずに破棄した場合（期限切れを含む）は、確保したサイズを引数にon_removeを呼ぶ
+    （受け入れ制御の解放に使う）。期限切れのアップロードは expire() を呼んだときに破棄する
+    """
+
+    def __init__(self, spool_dir: str, timeout: float, on_remove=None):
+        self.spool_dir = spool_dir
+        self.on_remove = on_remove
+        # 最後の受信からこの秒数を過ぎたアップロードは、放棄されたものとして破棄する
+        self.timeout = timeout
+        self._uploads: dict[str, StripedUpload] = {}
+        # reserve()で作成を引き受け、まだcreate()していないアップロードID
+        self._creating: set[str] = set()
+        self._condition = threading.Condition()
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+    def reserve(self, upload_id: str) -> bool:
+        """アップロードを作成する役を引き受ける。作成済みの場合はFalse
+
+        別の接続が作成を引き受けている間は、create()かcancel_create()されるまで待つ。
+        Trueを返した場合は、必ずcreate()かcancel_create()を呼ぶ
+        """
+        with self._condition:
+            while upload_id in self._creating:
+                self._condition.wait()
+            if upload_id in self._uploads:
+                return False
+            self._creating.add(upload_id)
+            return True
+
+    def create(self, upload_id: str, upload_size: int):
+        """reserve()したアップロードを、最終サイズで領域を確保して作成する
+
+        失敗した場合も引き受けは取り消す
+
+        Raises:
+            ValueError: サイズがMAX_UPLOAD_SIZEを超える場合
+        """
+        try:
+            if not 0 < upload_size <= MAX_UPLOAD_SIZE:
+                raise ValueError(f"不正なアップロードのサイズです: {upload_size}")
+            upload = StripedUpload(
+                os.path.join(self.spool_dir, f"{upload_id}.stripe"), upload_size
+            )
+            with self._condition:
+                self._uploads[upload_id] = upload
+        finally:
+            self.cancel_create(upload_id)
+
+    def cancel_create(self, upload_id: str):
+        """reserve()で引き受けた作成を取りやめ、待っている他の接続に引き継ぐ"""
+        with self._condition:
+            self._creating.discard(upload_id)
+            self._condition.notify_all()
+
+    def expire(self):
+        """途中で放棄された（最後の受信からtimeout秒を過ぎた）アップロードを破棄する"""
+        with self._condition:
+            now = time.monotonic()
+            expired = [
+                self._uploads.pop(upload_id)
+                for upload_id, upload in list(self._uploads.items())
+                if upload.writers == 0 and now - upload.updated_at > self.timeout
+            ]
+        for upload in expired:
+            print(f"期限切れの分割アップロードを破棄します: {upload.file_path}")
+            self._remove(upload)
+
+    def receive_range(
+        self, upload_id: str, upload_size: int, offset: int, payload_size: int, reader
+    ) -> int:
+        """ペイロード（offsetから始まる範囲）を受信してファイルの該当位置へ書き込む
+
+        Returns:
+            int: 受信したバイト数
+
+        Raises:
+            ValueError: 範囲がファイルの外にある場合や、アップロードが作成されていない場合、
+                同じIDでサイズが異なる場合
+        """
+        if offset < 0 or offset + payload_size > upload_size:
+            raise ValueError(f"不正な範囲です: {offset} + {payload_size} / {upload_size}")
+        upload = self._acquire_writer(upload_id, upload_size)
+
+        hasher = hashlib.sha256()
+        position = offset
+        try:
+            for chunk in reader.iter_payload():
+                # 受信した断片はバッファを使い回すため、次の受信の前に書き込む
+                written = 0
+                while written < len(chunk):
+                    written += os.pwrite(upload.fd, chunk[written:], position + written)
+                hasher.update(chunk)
+                position += len(chunk)
+                upload.updated_at = time.monotonic()
+        finally:
+            with self._condition:
+                upload.writers -= 1
+                upload.updated_at = time.monotonic()
+
+        with self._condition:
+            upload.ranges[offset] = (position - offset, hasher.hexdigest())
+            self._condition.notify_all()
+        return position - offset
+
+    def complete_digest(self, upload_id: str) -> str:
+        """すべての範囲が揃っている場合は、結果キャッシュのキーに使うハッシュを返す
+
+        揃っていない場合（受信中の範囲がある場合を含む）は待たずに空文字列を返す
+        """
+        with self._condition:
+            upload = self._uploads.get(upload_id)
+            if upload is None or upload.writers > 0 or not upload.is_complete():
+                print(f"分割アップロードの範囲が揃っていません: {upload_id}")
+                return ""
+            return combine_stripe_digests(upload.ranges)
+
+    def take(self, upload_id: str, dest_path: str) -> int:
+        """揃ったファイルをジョブの入力ファイルとして移動する
+
+        on_removeは呼ばないため、確保したサイズの受け入れはジョブの処理が終わってから解放する
+
+        Returns:
+            int: ファイルのサイズ
+        """
+        with self._condition:
+            upload = self._uploads.pop(upload_id)
+        try:
+            os.replace(upload.file_path, dest_path)
+        except OSError:
+            self._remove(upload)
+            raise
+        os.close(upload.fd)
+        return upload.upload_size
+
+    def discard(self, upload_id: str):
+        """分割アップロードを破棄する（受信中の接続がある場合は期限切れで破棄されるのを待つ）"""
+        with self._condition:
+            upload = self._uploads.get(upload_id)
+            if upload is None or upload.writers > 0:
+                return
+            del self._uploads[upload_id]
+        self._remove(upload)
+
+    def _acquire_writer(self, upload_id: str, upload_size: int) -> StripedUpload:
+        with self._condition:
+            upload = self._uploads.get(upload_id)
+            if upload is None:
+                raise ValueError(f"アップロードが作成されていません: {upload_id}")
+            if upload.upload_size != upload_size:
+                raise ValueError(f"アップロードのサイズが一致しません: {upload_id}")
+            upload.writers += 1
+        return upload
+
+    def _remove(self, upload: StripedUpload):
+        os.close(upload.fd)
+        try:
+            os.remove(upload.file_path)
+        except OSError:
+            pass
+        if self.on_remove is not None:
+            self.on_remove(upload.upload_size)
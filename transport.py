@@ -0,0 +1,98 @@
+import socket
+import threading
+
+"""
+ソケット転送の共通処理
+受信は使い回すbytearrayへのrecv_intoで行い、受信のたびにbytesオブジェクトを作らないようにします。
+    BufferPool       : 接続をまたいで使い回す受信バッファのプール
+    AdaptiveChunkSize: 1回のrecv_intoで要求するサイズを受信状況に合わせて増減する
+    configure_socket : SO_RCVBUF / SO_SNDBUF / TCP_NODELAY の設定（.envで指定する）
+"""
+
+# 受信バッファの既定のサイズ
+DEFAULT_RECV_BUFFER_BYTES = 1024 * 1024
+# 受信サイズを増やす・減らす判定の連続回数
+GROW_AFTER = 2
+SHRINK_AFTER = 8
+
+
+class BufferPool:
+    """同じサイズのbytearrayを使い回すプール
+
+    接続ごとに大きな受信バッファを確保・解放し直さないよう、使い終わったバッファを
+    最大max_buffers個まで保持して次の接続に渡す。プールが空の場合は新しく確保する
+    """
+
+    def __init__(self, buffer_size: int, max_buffers: int):
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self._buffers: list[bytearray] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        """バッファを1つ取り出す"""
+        with self._lock:
+            if self._buffers:
+                return self._buffers.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer: bytearray):
+        """使い終わったバッファをプールに戻す（上限を超える分は破棄する）"""
+        if len(buffer) != self.buffer_size:
+            return
+        with self._lock:
+            if len(self._buffers) < self.max_buffers:
+                self._buffers.append(buffer)
+
+
+class AdaptiveChunkSize:
+    """1回の受信で要求するサイズ
+
+    要求したサイズを満たす受信がGROW_AFTER回続いた場合は倍に増やし、
+    4分の1未満の受信がSHRINK_AFTER回続いた場合は半分に減らす。
+    大きなペイロードの転送ではシステムコールの回数が減り、小さいメッセージでは
+    無駄に大きな領域を要求しない
+    """
+
+    def __init__(self, min_size: int, max_size: int):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.size = min_size
+        self._full_count = 0
+        self._short_count = 0
+
+    def update(self, requested: int, received: int):
+        """受信結果を反映する"""
+        # 要求がsizeより小さい（メッセージの残りが少ない）場合は判定に使わない
+        if requested < self.size:
+            return
+        if received >= requested:
+            self._full_count += 1
+            self._short_count = 0
+            if self._full_count >= GROW_AFTER and self.size < self.max_size:
+                self.size = min(self.size * 2, self.max_size)
+                self._full_count = 0
+        elif received < requested // 4:
+            self._short_count += 1
+            self._full_count = 0
+            if self._short_count >= SHRINK_AFTER and self.size > self.min_size:
+                self.size = max(self.size // 2, self.min_size)
+                self._short_count = 0
+        else:
+            self._full_count = 0
+            self._short_count = 0
+
+
+def configure_socket(
+    sock: socket.socket, rcvbuf: int = 0, sndbuf: int = 0, nodelay: bool = False
+):
+    """ソケットオプションを設定する（0の場合はOSの既定値のまま）
+
+    SO_RCVBUFはウィンドウスケールの交渉に影響するため、listen / connect の前に設定する
+    """
+    if rcvbuf > 0:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if sndbuf > 0:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    if nodelay:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
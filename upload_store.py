@@ -0,0 +1,166 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+
+"""
+アップロードの保管場所
+クライアントが送ったコンテンツハッシュをキーに、受信途中・受信済みのアップロードを一定時間保持します。
+    <ハッシュ>.part     : 受信途中のアップロード。接続が切れても削除せず、続きから受信できる
+    <ハッシュ>.complete : ハッシュを検証済みのアップロード。同じファイルは再送不要になる
+最終更新から ttl 秒経過したファイルは削除します。
+"""
+
+# SHA-256の16進数表記のみをキーとして受け付ける（パスとして安全な文字だけにする）
+UPLOAD_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# 事前確認（preflight）の応答で返すアップロード状態
+UPLOAD_STATUS_COMPLETE = "complete"
+UPLOAD_STATUS_PARTIAL = "partial"
+UPLOAD_STATUS_NONE = "none"
+UPLOAD_STATUS_RECEIVING = "receiving"
+
+# 期限切れファイルの削除を行う最短間隔（秒）
+CLEANUP_INTERVAL = 60
+
+# 受信済み部分のハッシュを計算する際の読み込みサイズ
+HASH_READ_BYTES = 1024 * 1024
+
+
+def is_valid_upload_hash(upload_hash) -> bool:
+    """アップロードのキーとして使えるハッシュかどうか"""
+    return isinstance(upload_hash, str) and bool(UPLOAD_HASH_PATTERN.match(upload_hash))
+
+
+class UploadStore:
+    """コンテンツハッシュをキーとした受信途中・受信済みアップロードの保管場所"""
+
+    def __init__(self, store_dir: str, ttl: float):
+        self.store_dir = store_dir
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # 受信中のハッシュ。同じファイルを同時に書き込まないようにする
+        self._receiving: set[str] = set()
+        self._last_cleanup = 0.0
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def part_path(self, upload_hash: str) -> str:
+        return os.path.join(self.store_dir, f"{upload_hash}.part")
+
+    def complete_path(self, upload_hash: str) -> str:
+        return os.path.join(self.store_dir, f"{upload_hash}.complete")
+
+    def lookup(self, upload_hash: str, upload_size: int) -> tuple[str, int]:
+        """アップロードの状態と、クライアントが送信を始めるべきオフセットを返す
+
+        Returns:
+            tuple[str, int]: "complete"（送信不要）/ "partial"（オフセットから再開）/
+                "none"（すべて送信）/ "receiving"（他の接続が受信中。時間をおいて確認し直す）と、
+                送信を始めるオフセット
+        """
+        self.cleanup_expired()
+        with self._lock:
+            complete_path = self.complete_path(upload_hash)
+            if (
+                os.path.exists(complete_path)
+                and os.path.getsize(complete_path) == upload_size
+            ):
+                return UPLOAD_STATUS_COMPLETE, upload_size
+            # 他の接続が受信中の場合は、その接続が終わるか切断を検知するまで再開させない
+            if upload_hash in self._receiving:
+                return UPLOAD_STATUS_RECEIVING, 0
+            part_path = self.part_path(upload_hash)
+            if os.path.exists(part_path):
+                offset = os.path.getsize(part_path)
+                if 0 < offset <= upload_size:
+                    return UPLOAD_STATUS_PARTIAL, offset
+        return UPLOAD_STATUS_NONE, 0
+
+    def begin(self, upload_hash: str) -> bool:
+        """受信を開始する。同じハッシュを他の接続が受信中の場合はFalse"""
+        with self._lock:
+            if upload_hash in self._receiving:
+                return False
+            self._receiving.add(upload_hash)
+            return True
+
+    def end(self, upload_hash: str):
+        """受信を終了する。受信途中のファイルは削除せずに残す"""
+        with self._lock:
+            self._receiving.discard(upload_hash)
+
+    def open_part(self, upload_hash: str, offset: int):
+        """受信途中のファイルをoffsetから書き込めるように開く
+
+        offsetより後ろに書かれていた内容は切り捨てる。受信済み部分のハッシュを
+        計算したhashlibオブジェクトも返すので、続きを受信しながら更新すれば
+        全体を読み直さずに検証できる
+
+        Returns:
+            tuple: 書き込み用に開いたファイルと、受信済み部分で初期化したsha256オブジェクト
+
+        Raises:
+            ValueError: offsetが受信済みのサイズより大きい場合
+        """
+        part_path = self.part_path(upload_hash)
+        if offset == 0:
+            f = open(part_path, "wb")
+            return f, hashlib.sha256()
+
+        if not os.path.exists(part_path) or os.path.getsize(part_path) < offset:
+            raise ValueError(f"再開位置が受信済みのサイズを超えています: {offset}")
+        hasher = hashlib.sha256()
+        f = open(part_path, "r+b")
+        remaining = offset
+        while remaining > 0:
+            data = f.read(min(remaining, HASH_READ_BYTES))
+            hasher.update(data)
+            remaining -= len(data)
+        f.truncate(offset)
+        f.seek(offset)
+        return f, hasher
+
+    def complete(self, upload_hash: str, upload_size: int, digest: str) -> bool:
+        """受信が終わったファイルを検証し、受信済みとして保存する
+
+        サイズかハッシュが一致しない場合は受信途中のファイルを削除する
+        """
+        part_path = self.part_path(upload_hash)
+        if os.path.getsize(part_path) != upload_size or digest != upload_hash:
+            print(f"アップロードの検証に失敗しました: {upload_hash}")
+            os.remove(part_path)
+            return False
+        os.replace(part_path, self.complete_path(upload_hash))
+        return True
+
+    def link_to(self, upload_hash: str, dest_path: str):
+        """受信済みのファイルをジョブの作業ディレクトリへハードリンク（できない場合はコピー）する"""
+        complete_path = self.complete_path(upload_hash)
+        try:
+            os.link(complete_path, dest_path)
+        except OSError:
+            shutil.copyfile(complete_path, dest_path)
+        # 利用されたファイルは期限を延長する
+        os.utime(complete_path)
+
+    def cleanup_expired(self):
+        """最終更新からttl秒経過したファイルを削除する（CLEANUP_INTERVAL秒に1回だけ行う）"""
+        now = time.time()
+        with self._lock:
+            if now - self._last_cleanup < CLEANUP_INTERVAL:
+                return
+            self._last_cleanup = now
+            receiving = set(self._receiving)
+        for file_name in os.listdir(self.store_dir):
+            upload_hash = file_name.split(".", 1)[0]
+            if upload_hash in receiving:
+                continue
+            file_path = os.path.join(self.store_dir, file_name)
+            try:
+                if now - os.path.getmtime(file_path) > self.ttl:
+                    os.remove(file_path)
+            except OSError:
+                # 他のスレッドが同時に削除・置き換えた場合は無視する
+                continue